@@ -6,12 +6,26 @@ from django.utils import timezone
 
 class CallConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        self.signaling = CallSignaling(self.send)
         await self.accept()
         print("✅ Call WebSocket connected")
 
     async def disconnect(self, close_code):
         print("❌ Call WebSocket disconnected")
 
+    async def receive(self, text_data):
+        await self.signaling.receive(text_data)
+
+
+class CallSignaling:
+    """معالجة إطارات المكالمات - تستخدمها CallConsumer وقناة call في الاتصال المتعدد
+
+    send: دالة async تستقبل text_data مثل AsyncWebsocketConsumer.send
+    """
+
+    def __init__(self, send):
+        self.send = send
+
     async def receive(self, text_data):
         try:
             text_data_json = json.loads(text_data)
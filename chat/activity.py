@@ -0,0 +1,87 @@
+# chat/activity.py
+from collections import defaultdict
+
+from django.db.models import F, Q
+
+from .models import Message, RoomActivity
+
+PREVIEW_LENGTH = 100
+
+
+def ensure_room_activity(room_id):
+    """إنشاء سجل النشاط للغرفة إذا لم يكن موجوداً"""
+    RoomActivity.objects.get_or_create(room_id=room_id)
+
+
+def record_messages(messages):
+    """تحديث عدادات الغرف لمجموعة رسائل جديدة
+
+    العداد يُحدّث بـ F() في استعلام UPDATE واحد لكل غرفة، لذلك لا توجد
+    قراءة ثم كتابة ولا تضيع الزيادات عند الكتابة المتزامنة في الغرفة العامة.
+    """
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+
+    for room_id, room_messages in by_room.items():
+        updated = RoomActivity.objects.filter(room_id=room_id).update(
+            message_count=F('message_count') + len(room_messages)
+        )
+        if not updated:
+            # غرفة أُنشئت قبل وجود جدول النشاط
+            ensure_room_activity(room_id)
+            RoomActivity.objects.filter(room_id=room_id).update(
+                message_count=F('message_count') + len(room_messages)
+            )
+
+        # آخر رسالة: التحديث مشروط حتى لا تكتب رسالة أقدم فوق أحدث منها
+        last = max(room_messages, key=lambda m: (m.timestamp, str(m.id)))
+        RoomActivity.objects.filter(room_id=room_id).filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.timestamp)
+        ).update(
+            last_message_id=last.id,
+            last_message_preview=(last.content or '')[:PREVIEW_LENGTH],
+            last_message_sender_id=last.sender_id,
+            last_message_at=last.timestamp,
+        )
+
+
+def record_message(message):
+    """تحديث عدادات الغرفة لرسالة جديدة واحدة"""
+    record_messages([message])
+
+
+def forget_message(message):
+    """تحديث العدادات بعد حذف رسالة"""
+    RoomActivity.objects.filter(room_id=message.room_id, message_count__gt=0).update(
+        message_count=F('message_count') - 1
+    )
+
+    # إعادة حساب آخر رسالة فقط إذا كانت المحذوفة هي الأخيرة
+    if RoomActivity.objects.filter(room_id=message.room_id, last_message_id=message.id).exists():
+        last = Message.objects.filter(room_id=message.room_id).order_by('-timestamp').first()
+        RoomActivity.objects.filter(room_id=message.room_id).update(
+            last_message_id=last.id if last else None,
+            last_message_preview=(last.content or '')[:PREVIEW_LENGTH] if last else '',
+            last_message_sender_id=last.sender_id if last else None,
+            last_message_at=last.timestamp if last else None,
+        )
+
+
+def adjust_participant_count(room_ids, delta):
+    """زيادة أو إنقاص عدد المشاركين بشكل ذري"""
+    if delta >= 0:
+        RoomActivity.objects.filter(room_id__in=room_ids).update(
+            participant_count=F('participant_count') + delta
+        )
+    else:
+        RoomActivity.objects.filter(room_id__in=room_ids, participant_count__gte=-delta).update(
+            participant_count=F('participant_count') + delta
+        )
+
+
+def refresh_participant_count(room):
+    """إعادة حساب عدد المشاركين بالكامل (بعد clear مثلاً)"""
+    RoomActivity.objects.filter(room_id=room.pk).update(
+        participant_count=room.participants.count()
+    )
@@ -3,9 +3,28 @@ from .models import ChatRoom, Message
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ('name', 'created_at')
+    list_display = ('name', 'message_count', 'participant_count', 'last_message_at', 'created_at')
+    list_select_related = ('activity',)
     search_fields = ('name',)
     readonly_fields = ('created_at',)
+    
+    def message_count(self, obj):
+        activity = getattr(obj, 'activity', None)
+        return activity.message_count if activity else 0
+    message_count.short_description = 'عدد الرسائل'
+    message_count.admin_order_field = 'activity__message_count'
+    
+    def participant_count(self, obj):
+        activity = getattr(obj, 'activity', None)
+        return activity.participant_count if activity else 0
+    participant_count.short_description = 'عدد المشاركين'
+    participant_count.admin_order_field = 'activity__participant_count'
+    
+    def last_message_at(self, obj):
+        activity = getattr(obj, 'activity', None)
+        return activity.last_message_at if activity else None
+    last_message_at.short_description = 'آخر رسالة'
+    last_message_at.admin_order_field = 'activity__last_message_at'
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
@@ -17,4 +36,4 @@ class MessageAdmin(admin.ModelAdmin):
     
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
-    content_preview.short_description = 'المحتوى'
\ No newline at end of file
+    content_preview.short_description = 'المحتوى'
@@ -0,0 +1,163 @@
+# chat/broadcast.py
+import json
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from . import replay
+from .pagination import encode_cursor
+from .serializers import get_display_name, reply_preview
+
+
+def room_group_name(room_id):
+    """اسم مجموعة الغرفة في channel layer (نفس الاسم الذي يستخدمه ChatConsumer)"""
+    return f'chat_{room_id}'
+
+
+def encode_frame(payload):
+    """ترميز إطار WebSocket مرة واحدة فقط"""
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def group_event(handler, payload, **extra):
+    """حدث مجموعة يحمل الإطار مرمّزاً مسبقاً في 'text'
+
+    الترميز يتم مرة واحدة عند المرسل، وكل مستهلك في الغرفة يمرر النص
+    كما هو بدلاً من إعادة بناء القاموس واستدعاء json.dumps لكل متصل.
+    أحداث الغرف تحمل room (نص UUID) حتى يوجهها الاتصال المتعدد إلى القناة الصحيحة.
+    """
+    return {'type': handler, 'text': encode_frame(payload), **extra}
+
+
+def user_group_name(user_id):
+    """مجموعة خاصة بكل مستخدم لأحداث الإبطال (تغيير الملف، إزالة العضوية)"""
+    return f'user_{user_id}'
+
+
+def unread_group_name(user_id):
+    """مجموعة تحديثات عدد غير المقروء للمستخدم (الصفحة الرئيسية)"""
+    return f'unread_{user_id}'
+
+
+def room_notify_group_name(room_id):
+    """مجموعة خفيفة للغرفة: معرف الغرفة والمرسل فقط بدون محتوى الرسالة
+
+    الصفحة الرئيسية تشترك فيها لتحديث شارات غير المقروء بدلاً من استقبال
+    كل إطارات الغرفة (الرسائل، الكتابة، الانضمام).
+    """
+    return f'notify_{room_id}'
+
+
+def room_activity_event(message):
+    return {
+        'type': 'room_activity',
+        'room_id': str(message.room_id),
+        'sender_id': message.sender_id
+    }
+
+
+def send_to_user(user_id, event):
+    """إرسال حدث إلى كل اتصالات المستخدم من كود متزامن"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(user_group_name(user_id), event)
+    except Exception as e:
+        print(f"Error sending event to user {user_id}: {e}")
+
+
+def message_payload(message, display_name=None, reply=None):
+    """إطار الرسالة كما يصل إلى المتصفح عبر WebSocket أو SSE
+
+    reply: معاينة الرد إذا كانت معروفة مسبقاً، وإلا يجب أن تكون
+    reply_to.sender محملة (select_related) لأن الإطار يُبنى أحياناً داخل async.
+    """
+    if reply is None and message.reply_to_id:
+        reply = reply_preview(message.reply_to)
+    return {
+        'type': 'message',
+        'message': message.content,
+        'message_id': str(message.id),
+        'message_type': message.message_type,
+        'sender': message.sender.email,
+        'display_name': display_name or get_display_name(message.sender),
+        'timestamp': message.timestamp.isoformat(),
+        'cursor': encode_cursor(message),
+        # None في وضع الحفظ المؤجل - الرقم يُخصص عند حفظ الدفعة
+        'seq': message.seq,
+        'reply_to': reply,
+        'image_url': message.image.url if message.image else None,
+        'image': message.image_data() if message.image else None,
+        'file_url': message.file.url if message.file else None,
+        'file_name': message.file_name,
+    }
+
+
+def message_event(message, display_name=None, reply=None):
+    """حدث chat_message لمجموعة الغرفة (الإطار مرمّز مسبقاً)"""
+    return group_event(
+        'chat_message',
+        message_payload(message, display_name, reply),
+        room=str(message.room_id),
+        cursor=encode_cursor(message),
+        message_id=str(message.id),
+        preview=reply_preview(message)
+    )
+
+
+def message_changed_event(kind, message):
+    """حدث تعديل ('edit') أو حذف ('delete') أو اكتمال أحجام الصورة ('image') لرسالة
+
+    بنفس seq الذي تُرجعه المزامنة.
+    """
+    if kind == 'delete':
+        payload = {'type': 'message_deleted', 'message_id': str(message.id)}
+    elif kind == 'image':
+        payload = {
+            'type': 'image_ready',
+            'message_id': str(message.id),
+            'image': message.image_data(),
+        }
+    else:
+        payload = {
+            'type': 'message_edited',
+            'message_id': str(message.id),
+            'message': message.content,
+            'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        }
+    payload['seq'] = message.changed_seq
+    return group_event(
+        'message_changed', payload,
+        room=str(message.room_id),
+        message_id=str(message.id)
+    )
+
+
+def broadcast_message_change(kind, message):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = message_changed_event(kind, message)
+    replay.record(message.room_id, event)
+    try:
+        async_to_sync(channel_layer.group_send)(room_group_name(message.room_id), event)
+    except Exception as e:
+        print(f"Error broadcasting {kind} for message {message.id}: {e}")
+
+
+def broadcast_message(message, display_name=None):
+    """إرسال رسالة محفوظة عبر HTTP إلى المتصلين بالغرفة (WebSocket و SSE)"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = message_event(message, display_name)
+    replay.record(message.room_id, event)
+    try:
+        async_to_sync(channel_layer.group_send)(room_group_name(message.room_id), event)
+        async_to_sync(channel_layer.group_send)(
+            room_notify_group_name(message.room_id),
+            room_activity_event(message)
+        )
+    except Exception as e:
+        print(f"Error broadcasting message {message.id}: {e}")
@@ -1,64 +1,122 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import ChatRoom, OnlineUser, CustomUser
+from .models import ChatRoom, CustomUser
+from . import drain, presence, receipts, replay, typing_indicator, writebehind
+from .outbox import EPHEMERAL, MESSAGE, OVERFLOW_CLOSE_CODE, STATE, Outbox, write_buffer_probe
+from .presence import get_presence
+from .broadcast import (
+    group_event, message_event, room_activity_event, room_group_name,
+    room_notify_group_name, unread_group_name, user_group_name
+)
+from .serializers import get_display_name, reply_preview
+from .pagination import decode_cursor
+from .queries import UNREAD_CAP, format_unread, get_unread_counts
+from django.core.exceptions import ValidationError
 import uuid
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+# عدد الرسائل الأخيرة التي يحتفظ بها كل اتصال لمعاينة الردود بدون استعلام
+RECENT_MESSAGES_LIMIT = 200
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group_name(self.room_id)
         self.user = self.scope["user"]
+        self.joined = False
 
-        # التحقق من صحة المستخدم والغرفة
-        if self.user.is_anonymous:
+        # التحقق من صحة المستخدم والغرفة (ولا اتصالات جديدة أثناء إيقاف العملية)
+        if self.user.is_anonymous or drain.is_draining():
+            await self.close()
+            return
+
+        # الغرفة والصلاحية والاسم المعروض تُقرأ مرة واحدة عند الاتصال
+        context = await self.load_context()
+        if not context:
             await self.close()
             return
+        self.room, self.display_name = context
+        self.recent_messages = OrderedDict()
+        # نفس صيغة المعرف التي تستخدمها الأحداث المرسلة من HTTP
+        self.room_id = str(self.room.id)
+        self.room_group_name = room_group_name(self.room_id)
+        # الرسائل التي أُرسلت من ذاكرة الاستئناف - لا تُكرر إذا وصلت من المجموعة بعدها
+        self.replayed = set()
 
-        room = await self.get_room()
-        if not room or not await self.can_join_room():
+        # تسجيل المستخدم كمتصّل - قبل الانضمام للمجموعات حتى لا يبقى شيء عند الفشل
+        try:
+            await self.add_online_user()
+        except presence.PresenceLockTimeout as e:
+            print(f"Error registering presence for room {self.room_id}: {e}")
             await self.close()
             return
 
-        # الانضمام إلى مجموعة الغرفة
+        # الحلقة تسجل قبل الانضمام للمجموعة حتى لا يفوتها حدث
+        replay.subscribe(self.room_id)
+        # الانضمام إلى مجموعة الغرفة ومجموعة المستخدم (لأحداث الإبطال)
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-
-        # تسجيل المستخدم كمتصّل
-        await self.add_online_user()
+        await self.join_user_group()
+        self.joined = True
 
         await self.accept()
+        self.open_outbox()
+        drain.install_signal_handler()
+        drain.register(self)
+        # إعادة الاتصال: ما فات منذ آخر مؤشر قبل أي حدث جديد
+        self.resume_from, resumed = self.resume_state()
+        await self.resume(self.resume_from)
 
-        # إرسال إشعار انضمام
+        if resumed:
+            # عودة بعد إيقاف عملية سابقة - لم يُبث user_left عند المغادرة
+            return
+
+        # إرسال إشعار انضمام - العدد يُحسب مرة واحدة هنا وليس عند كل مستقبل
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
+            group_event('user_joined', {
                 'type': 'user_joined',
                 'user': self.user.email,
-                'display_name': await self.get_display_name()
-            }
+                'display_name': self.display_name,
+                'online_count': await self.get_online_count()
+            }, room=self.room_id)
         )
 
     async def disconnect(self, close_code):
-        # إزالة المستخدم من المتصلين
+        # اتصال مرفوض لم يُسجل أصلاً
+        if not getattr(self, 'joined', False):
+            return
+
+        if getattr(self, 'outbox', None) is not None:
+            self.outbox.close()
+
+        drain.unregister(self)
+        replay.unsubscribe(self.room_id)
+        # إزالة المستخدم من المتصلين والكاتبين
+        typing_indicator.clear_typing(self.room_id, self.user.id, self.channel_name)
         await self.remove_online_user()
 
-        # إرسال إشعار مغادرة
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_left',
-                'user': self.user.email
-            }
-        )
+        # إرسال إشعار مغادرة - إلا أثناء إيقاف العملية (العميل سيعود برمز استئناف)
+        if not drain.is_draining():
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                group_event('user_left', {
+                    'type': 'user_left',
+                    'user': self.user.email,
+                    'online_count': await self.get_online_count()
+                }, room=self.room_id)
+            )
 
-        # مغادرة مجموعة الغرفة
+        # مغادرة مجموعة الغرفة ومجموعة المستخدم
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.leave_user_group()
 
     async def receive(self, text_data):
         try:
@@ -80,129 +138,338 @@ class ChatConsumer(AsyncWebsocketConsumer):
         reply_to = data.get('reply_to')
         
         if message:
-            # حفظ الرسالة في قاعدة البيانات
-            message_obj = await self.save_message(message, reply_to)
+            # إرسال الرسالة ينهي حالة الكتابة
+            typing_indicator.clear_typing(self.room_id, self.user.id, self.channel_name)
+            reply = await self.resolve_reply(reply_to) if reply_to else None
+            
+            if writebehind.is_enabled():
+                # الرسالة تُبث فوراً وتُحفظ لاحقاً ضمن دفعة
+                message_obj = self.build_message(message, reply)
+            else:
+                # حفظ الرسالة فوراً: حجز seq والإدراج فقط. العدادات والبحث ونافذة
+                # الذاكرة تُطبق على دفعات بعد البث (writebehind.record_saved)
+                message_obj = await self.save_message(message, reply)
             
-            # إرسال الرسالة إلى مجموعة الغرفة
+            # إرسال الرسالة إلى مجموعة الغرفة (نفس الحدث الذي يستقبله بث SSE)
+            event = message_event(message_obj, self.display_name, reply)
+            replay.record(self.room_id, event)
+            await self.channel_layer.group_send(self.room_group_name, event)
             await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'message_id': str(message_obj.id),
-                    'sender': self.user.email,
-                    'display_name': await self.get_display_name(),
-                    'timestamp': message_obj.timestamp.isoformat(),
-                    'reply_to': reply_to
-                }
+                room_notify_group_name(self.room_id),
+                room_activity_event(message_obj)
             )
+            
+            if writebehind.is_enabled():
+                await writebehind.get_writer().enqueue(message_obj)
+            else:
+                await writebehind.get_writer(writebehind.record_saved).enqueue(message_obj)
 
     async def handle_typing(self, data):
-        # إرسال إشعار الكتابة
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_typing',
-                'user': self.user.email,
-                'display_name': await self.get_display_name(),
-                'is_typing': data.get('is_typing', False)
-            }
+        # تحديث حالة الكتابة فقط - البث مجمّع ومحدود المعدل لكل غرفة
+        typing_indicator.set_typing(
+            self.room_id,
+            self.user.id,
+            self.channel_name,
+            self.user.email,
+            self.display_name,
+            bool(data.get('is_typing', False))
         )
 
+    async def handle_read_receipt(self, data):
+        # المؤشر يُجمع في الذاكرة ويُحفظ ويُبث على دفعات - لا استعلام هنا
+        try:
+            timestamp, message_id = decode_cursor(data.get('cursor') or '')
+        except ValueError:
+            return
+        receipts.mark_read(self.user.id, self.room_id, timestamp, message_id)
+
+    def resume_state(self):
+        """(آخر مؤشر وصل للعميل قبل انقطاعه، هل يعود برمز استئناف صالح)
+
+        ?resume=<رمز> بعد إيقاف العملية، أو ?cursor=<مؤشر> بعد انقطاع عادي.
+        """
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        token = params.get('resume', [None])[0]
+        if token:
+            cursors = drain.read_resume_token(token, self.user.id)
+            if cursors is not None:
+                return cursors.get(self.stream_name()), True
+        return params.get('cursor', [None])[0], False
+
+    def stream_name(self):
+        # نفس اسم القناة في الاتصال المتعدد - رموز الاستئناف صالحة للنوعين
+        return f'room:{self.room_id}'
+
+    async def resume(self, cursor):
+        """إرسال الأحداث الفائتة بعد المؤشر - من الذاكرة إن أمكن وإلا من قاعدة البيانات"""
+        if not cursor:
+            return
+        events = replay.missed_events(self.room_id, cursor)
+        has_more = False
+        if events is None:
+            # الفجوة أكبر من الحلقة (أو عملية جديدة بعد النشر)
+            events, has_more = await self.load_missed_messages(cursor)
+
+        for event in events:
+            if event['type'] == 'chat_message':
+                self.replayed.add(event['message_id'])
+                await self.deliver_message(event)
+            else:
+                await self.deliver(event, MESSAGE)
+
+        if has_more:
+            # الباقي يُستكمل من get_messages بعد آخر مؤشر
+            await self.deliver(group_event('resume_incomplete', {
+                'type': 'resume_incomplete',
+                'cursor': events[-1]['cursor']
+            }), MESSAGE)
+
+    @database_sync_to_async
+    def load_missed_messages(self, cursor):
+        return replay.messages_after_cursor(self.user, self.room, cursor)
+
     async def chat_message(self, event):
-        # إرسال الرسالة إلى WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'message_id': event['message_id'],
-            'sender': event['sender'],
-            'display_name': event['display_name'],
-            'timestamp': event['timestamp'],
-            'reply_to': event.get('reply_to')
-        }))
+        message_id = event.get('message_id')
+        if message_id is not None and message_id in self.replayed:
+            # أُرسلت من ذاكرة الاستئناف قبل وصولها من المجموعة
+            self.replayed.discard(message_id)
+            return
+        await self.deliver_message(event)
+
+    async def deliver_message(self, event):
+        # حفظ معاينة الرسالة محلياً حتى لا يحتاج الرد عليها إلى استعلام
+        if 'preview' in event:
+            self.recent_messages[event['message_id']] = event['preview']
+            if len(self.recent_messages) > RECENT_MESSAGES_LIMIT:
+                self.recent_messages.popitem(last=False)
+        
+        # الإطار مرمّز مسبقاً عند المرسل - تمريره فقط
+        await self.deliver(event, MESSAGE)
+
+    async def profile_changed(self, event):
+        # إبطال الاسم المعروض المخزن في الاتصال
+        self.display_name = event['display_name']
+
+    async def membership_revoked(self, event):
+        # إعادة التحقق من الصلاحية عند إزالة المستخدم من الغرفة
+        if event.get('room_id') != str(self.room.id):
+            return
+        context = await self.load_context()
+        if not context:
+            await self.close()
+
+    async def message_changed(self, event):
+        # المعاينة المخزنة للرد أصبحت قديمة
+        self.recent_messages.pop(event.get('message_id'), None)
+        await self.deliver(event, MESSAGE)
 
     async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_joined',
-            'user': event['user'],
-            'display_name': event['display_name'],
-            'online_count': await self.get_online_count()
-        }))
+        # العدد محسوب عند المرسل - لا استعلامات عند المستقبلين
+        await self.deliver(event, EPHEMERAL)
 
     async def user_left(self, event):
+        await self.deliver(event, EPHEMERAL)
+
+    async def user_typing(self, event):
+        # لقطة الكتابة الأحدث من نفس العملية تحل محل السابقة إذا لم تُرسل بعد
+        await self.deliver(event, EPHEMERAL, key=('typing', event.get('source')))
+
+    async def read_receipts(self, event):
+        await self.deliver(event, STATE, key='read_receipts')
+
+    def open_outbox(self):
+        self.outbox = Outbox(
+            self.send,
+            self.close_slow_connection,
+            on_error=self.close,
+            write_buffer=write_buffer_probe(self.scope)
+        )
+
+    async def deliver(self, event, kind, key=None):
+        """وضع الإطار في طابور الإرسال - لا ينتظر العميل البطيء"""
+        self.outbox.put(event['text'], kind, key, event.get('cursor'))
+
+    async def close_slow_connection(self, cursors):
+        """العميل لا يقرأ - إغلاق مع تلميح للاستئناف من آخر رسالة وصلته"""
         await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'user': event['user'],
-            'online_count': await self.get_online_count()
+            'type': 'resume',
+            'reason': 'slow_consumer',
+            'cursor': cursors.get(None)
         }))
+        await self.close(code=OVERFLOW_CLOSE_CODE)
 
-    async def user_typing(self, event):
+    async def drain(self, retry_after):
+        """إيقاف العملية - إغلاق مع موعد عودة عشوائي ورمز استئناف من آخر رسالة وصلت"""
+        cursor = self.outbox.cursors.get(None) or self.resume_from
+        self.outbox.close()
         await self.send(text_data=json.dumps({
-            'type': 'user_typing',
-            'user': event['user'],
-            'display_name': event['display_name'],
-            'is_typing': event['is_typing']
+            'type': 'reconnect',
+            'retry_after': retry_after,
+            'resume': drain.make_resume_token(
+                self.user.id,
+                {self.stream_name(): cursor} if cursor else {}
+            )
         }))
+        await self.close(code=drain.DRAIN_CLOSE_CODE)
 
-    @database_sync_to_async
-    def get_room(self):
-        try:
-            return ChatRoom.objects.get(id=self.room_id)
-        except ChatRoom.DoesNotExist:
-            return None
+    async def join_user_group(self):
+        await self.channel_layer.group_add(
+            user_group_name(self.user.id),
+            self.channel_name
+        )
+
+    async def leave_user_group(self):
+        await self.channel_layer.group_discard(
+            user_group_name(self.user.id),
+            self.channel_name
+        )
 
     @database_sync_to_async
-    def can_join_room(self):
+    def load_context(self):
+        """الغرفة والاسم المعروض إذا كان المستخدم يستطيع الدخول، وإلا None"""
         try:
             room = ChatRoom.objects.get(id=self.room_id)
-            return room.can_join(self.user)
-        except ChatRoom.DoesNotExist:
-            return False
+        except (ChatRoom.DoesNotExist, ValueError, ValidationError):
+            return None
+        if not room.can_join(self.user):
+            return None
+        return room, get_display_name(self.user)
 
-    @database_sync_to_async
-    def add_online_user(self):
-        OnlineUser.objects.get_or_create(
-            user=self.user,
-            room_id=self.room_id,
-            defaults={'channel_name': self.channel_name}
-        )
+    async def add_online_user(self):
+        # التتبع في الذاكرة - last_seen يُحفظ دورياً بواسطة مهمة الصيانة
+        presence.ensure_maintenance()
+        await presence.run(get_presence().connect, self.user.id, self.room_id, self.user.email)
+        presence.register_connection(self.user.id, self.room_id)
 
-    @database_sync_to_async
-    def remove_online_user(self):
-        OnlineUser.objects.filter(
-            user=self.user,
-            room_id=self.room_id
-        ).delete()
+    async def remove_online_user(self):
+        presence.unregister_connection(self.user.id, self.room_id)
+        try:
+            await presence.run(get_presence().disconnect, self.user.id, self.room_id)
+        except presence.PresenceLockTimeout as e:
+            # بدون نبضات ينتهي الإدخال بعد TTL
+            print(f"Error removing presence for room {self.room_id}: {e}")
 
-    @database_sync_to_async
-    def get_online_count(self):
-        return OnlineUser.objects.filter(room_id=self.room_id).count()
+    async def get_online_count(self):
+        # يُستدعى مرة واحدة لكل انضمام/مغادرة عند المرسل فقط
+        return await presence.run(get_presence().online_count, self.room_id)
 
-    @database_sync_to_async
-    def get_display_name(self):
-        profile = getattr(self.user, 'chat_profile', None)
-        return profile.display_name if profile and profile.display_name else self.user.email
+    async def resolve_reply(self, reply_to):
+        """معاينة الرسالة المردود عليها - من الرسائل الأخيرة أولاً ثم من قاعدة البيانات"""
+        reply = self.recent_messages.get(str(reply_to))
+        if reply is None:
+            # رد على رسالة قديمة لم تمر على هذا الاتصال
+            reply = await self.get_reply_preview(reply_to)
+        return reply
 
     @database_sync_to_async
-    def save_message(self, content, reply_to=None):
+    def get_reply_preview(self, reply_to):
+        from .models import Message
+        try:
+            return reply_preview(
+                Message.objects.select_related('sender').get(id=reply_to, room_id=self.room.id)
+            )
+        except (Message.DoesNotExist, ValueError, ValidationError):
+            return None
+
+    def build_message(self, content, reply=None):
+        """رسالة غير محفوظة بمعرف جاهز"""
         from .models import Message
         from django.utils import timezone
         
-        room = ChatRoom.objects.get(id=self.room_id)
-        
-        message = Message.objects.create(
-            room=room,
+        return Message(
+            id=uuid.uuid4(),
+            room_id=self.room.id,
             sender=self.user,
             content=content,
-            timestamp=timezone.now()
+            timestamp=timezone.now(),
+            reply_to_id=reply['id'] if reply else None
         )
-        
-        if reply_to:
-            try:
-                reply_to_msg = Message.objects.get(id=reply_to)
-                message.reply_to = reply_to_msg
-                message.save()
-            except Message.DoesNotExist:
-                pass
-        
-        return message
\ No newline at end of file
+
+    @database_sync_to_async
+    def save_message(self, content, reply=None):
+        message = self.build_message(content, reply)
+        message.record_later = True
+        message.save(force_insert=True)
+        return message
+
+
+class UnreadConsumer(AsyncWebsocketConsumer):
+    """تحديث شارات غير المقروء في الصفحة الرئيسية بدون إعادة تحميل
+
+    العدد الأولي من استعلام واحد، ثم يزيد محلياً مع كل رسالة جديدة من غيري
+    ويُعاد حسابه لغرفة واحدة فقط عندما يحفظ المستخدم مؤشر القراءة.
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.room_ids = []
+
+        if self.user.is_anonymous or drain.is_draining():
+            await self.close()
+            return
+
+        self.counts = await self.load_counts()
+        self.room_ids = list(self.counts)
+
+        for room_id in self.room_ids:
+            await self.channel_layer.group_add(room_notify_group_name(room_id), self.channel_name)
+        await self.channel_layer.group_add(unread_group_name(self.user.id), self.channel_name)
+
+        await self.accept()
+        drain.install_signal_handler()
+        drain.register(self)
+        await self.send(text_data=json.dumps({
+            'type': 'unread_counts',
+            'rooms': {
+                room_id: {'count': count, 'display': format_unread(count)}
+                for room_id, count in self.counts.items()
+            }
+        }, ensure_ascii=False))
+
+    async def disconnect(self, close_code):
+        if self.user.is_anonymous:
+            return
+        drain.unregister(self)
+        for room_id in self.room_ids:
+            await self.channel_layer.group_discard(room_notify_group_name(room_id), self.channel_name)
+        await self.channel_layer.group_discard(unread_group_name(self.user.id), self.channel_name)
+
+    async def drain(self, retry_after):
+        # الأعداد الكاملة تُقرأ عند العودة - توزيعها على فترة بدلاً من استعلام الجميع معاً
+        await self.send(text_data=json.dumps({'type': 'reconnect', 'retry_after': retry_after}))
+        await self.close(code=drain.DRAIN_CLOSE_CODE)
+
+    async def room_activity(self, event):
+        room_id = event['room_id']
+        if event['sender_id'] == self.user.id or room_id not in self.counts:
+            return
+        if self.counts[room_id] > UNREAD_CAP:
+            # العرض "99+" لا يتغير
+            return
+        self.counts[room_id] += 1
+        await self.send_count(room_id)
+
+    async def room_read(self, event):
+        # غرفة عامة تُفتح لأول مرة تصبح من غرف المستخدم وتبدأ متابعتها
+        room_id = event['room_id']
+        counts = await self.load_counts([room_id])
+        if room_id not in counts:
+            return
+        if room_id not in self.counts:
+            self.room_ids.append(room_id)
+            await self.channel_layer.group_add(room_notify_group_name(room_id), self.channel_name)
+        self.counts[room_id] = counts[room_id]
+        await self.send_count(room_id)
+
+    async def send_count(self, room_id):
+        count = self.counts[room_id]
+        await self.send(text_data=json.dumps({
+            'type': 'unread',
+            'room_id': room_id,
+            'count': count,
+            'display': format_unread(count)
+        }))
+
+    @database_sync_to_async
+    def load_counts(self, room_ids=None):
+        return get_unread_counts(self.user, room_ids)
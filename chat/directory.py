@@ -0,0 +1,352 @@
+# chat/directory.py
+"""دليل الغرف: البحث بالاسم أثناء الكتابة وتصفح الغرف العامة صفحة بصفحة
+
+البحث (search_rooms) يُستدعى مع كل ضغطة مفتاح، لذلك بدلاً من icontains على
+الاسم والوصف مع DISTINCT على المشاركين:
+
+- المطابقة من الفهرس النصي للغرف (chat/search.py) بالبادئة وبعد تطبيع العربية
+- الترتيب حسب النشاط (آخر رسالة ثم عدد الرسائل) من RoomActivity
+- أفضل CANDIDATES غرفة لكل نص بحث مطبّع تُحفظ في الذاكرة TTL ثانية، وهي
+  نفسها لكل المستخدمين؛ منها تُعرض الغرف العامة فقط، وتُدمج معها غرف
+  المستخدم (مشارك أو منشئ) المطابقة لنفس الكلمات باستعلام واحد بنفس
+  الترتيب - غرفه الخاصة لا تضيع خلف أفضل CANDIDATES غرفة عامة
+- عدد المتصلين من التتبع في الذاكرة دفعة واحدة
+
+التصفح (directory_page) بثلاثة ترتيبات للغرف العامة: الأكثر نشاطاً، الأكثر
+اتصالاً، الأحدث. الترتيبات تُحسب معاً كل REFRESH ثانية في لقطة داخل العملية
+(استعلام واحد لكل الغرف العامة + أعداد المتصلين دفعة واحدة) بدلاً من الترتيب
+في كل طلب. النشاط = عدد الرسائل منذ لقطة عمرها ACTIVE_WINDOW تقريباً، لذلك
+يعكس النشاط الحالي وليس العدد الكلي. المؤشر يحمل مفتاح الترتيب نفسه (وليس
+رقم الصفحة)، فالصفحة التالية تبدأ بعد آخر غرفة عُرضت حتى لو تغيرت اللقطة.
+
+الإعدادات (اختيارية) في settings.CHAT_ROOM_DIRECTORY:
+    TTL: مدة حفظ نتيجة البحث بالثواني
+    MAX_QUERIES: أقصى عدد نصوص بحث محفوظة
+    CANDIDATES: عدد الغرف المرتبة المحفوظة لكل نص
+    RESULTS: عدد النتائج المُرجعة للمستخدم
+    REFRESH: عمر لقطة الترتيبات بالثواني
+    ACTIVE_WINDOW: فترة حساب النشاط بالثواني
+    PAGE_SIZE: عدد الغرف في صفحة الدليل
+"""
+import base64
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.db.models import Exists, F, OuterRef, Q
+
+from . import search
+from .models import ChatRoom
+from .presence import get_presence, room_key
+from .queries import annotate_room_summary, annotate_unread_counts, attach_online_counts, serialize_room_summary
+
+DEFAULTS = {
+    'TTL': 10,
+    'MAX_QUERIES': 1000,
+    'CANDIDATES': 100,
+    'RESULTS': 20,
+    'REFRESH': 30,
+    'ACTIVE_WINDOW': 3600,
+    'PAGE_SIZE': 20,
+}
+
+SORTS = ('active', 'online', 'newest')
+
+# طول مفتاح كل ترتيب في Snapshot مع room_id
+KEY_LENGTHS = {'active': 3, 'online': 4, 'newest': 2}
+
+
+def directory_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_ROOM_DIRECTORY', {})}
+
+
+class QueryCache:
+    """نتائج البحث لكل نص مطبّع مع انتهاء صلاحية وحد أقصى (LRU)"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = directory_settings()
+                _cache = QueryCache(config['TTL'], config['MAX_QUERIES'])
+    return _cache
+
+
+def invalidate():
+    """بعد إنشاء غرفة أو تعديل اسمها أو حذفها"""
+    global _general_room
+    get_cache().clear()
+    _rankings.expire()
+    _general_room = None
+
+
+GENERAL_ROOM_NAME = 'عام'
+_general_room = None
+
+
+def get_general_room(user):
+    """الغرفة العامة الافتراضية: (الغرفة، هل أُنشئت الآن)
+
+    تُقرأ (أو تُنشأ) مرة واحدة في العملية وتبقى في الذاكرة حتى invalidate،
+    بدلاً من get_or_create في كل تحميل للصفحة الرئيسية.
+    """
+    global _general_room
+    room = _general_room
+    if room is not None:
+        return room, False
+    room, created = ChatRoom.objects.get_or_create(
+        name=GENERAL_ROOM_NAME,
+        room_type='public',
+        defaults={
+            'created_by': user,
+            'description': 'الغرفة العامة للدردشة'
+        }
+    )
+    _general_room = room
+    return room, created
+
+
+def ranked_rooms(rooms, limit):
+    """أكثر الغرف نشاطاً (قواميس جاهزة للعرض)"""
+    rooms = rooms.select_related('created_by', 'activity').order_by(
+        F('activity__last_message_at').desc(nulls_last=True),
+        F('activity__message_count').desc(nulls_last=True),
+        'name'
+    )[:limit]
+    candidates = []
+    for room in rooms:
+        activity = getattr(room, 'activity', None)
+        last_message_at = activity.last_message_at if activity else None
+        candidates.append({
+            'id': str(room.id),
+            'name': room.name,
+            'description': room.description,
+            'type': room.room_type,
+            'room_type': room.get_room_type_display(),
+            'message_count': activity.message_count if activity else 0,
+            'last_message_at': last_message_at.timestamp() if last_message_at else None,
+            'created_by': room.created_by.email,
+        })
+    return candidates
+
+
+def candidate_rank(candidate):
+    """نفس ترتيب ranked_rooms لدمج القوائم في الذاكرة"""
+    last = candidate['last_message_at']
+    return (last is None, -(last or 0), -candidate['message_count'], candidate['name'])
+
+
+def ranked_candidates(terms):
+    """أكثر الغرف نشاطاً من التي تطابق الكلمات - مشتركة لكل المستخدمين"""
+    rooms = ChatRoom.objects.filter(is_active=True, id__in=search.matching_rooms(terms))
+    return ranked_rooms(rooms, directory_settings()['CANDIDATES'])
+
+
+def member_candidates(user, terms):
+    """غرف المستخدم التي تطابق الكلمات: نفس شرط available_rooms_queryset لغير العامة"""
+    rooms = ChatRoom.objects.filter(
+        Q(Exists(ChatRoom.participants.through.objects.filter(
+            chatroom_id=OuterRef('pk'),
+            customuser_id=user.id
+        ))) |
+        Q(created_by=user),
+        is_active=True,
+        id__in=search.matching_rooms(terms)
+    )
+    return ranked_rooms(rooms, directory_settings()['RESULTS'])
+
+
+def search_rooms(user, query):
+    """نتائج البحث للمستخدم مع عدد المتصلين"""
+    terms = search.query_terms(query)
+    if not terms:
+        return []
+    key = ' '.join(terms)
+    cache = get_cache()
+    candidates = cache.get(key)
+    if candidates is None:
+        candidates = ranked_candidates(terms)
+        cache.put(key, candidates)
+
+    # أي غرفة غير عامة يراها المستخدم هي من غرفه، وأفضل RESULTS منها تكفي
+    # لأن ما بعدها لا يدخل النتائج
+    merged = {candidate['id']: candidate for candidate in candidates if candidate['type'] == 'public'}
+    merged.update((candidate['id'], candidate) for candidate in member_candidates(user, terms))
+    results = sorted(merged.values(), key=candidate_rank)[:directory_settings()['RESULTS']]
+    counts = get_presence().online_counts([result['id'] for result in results])
+    return [
+        {
+            'id': result['id'],
+            'name': result['name'],
+            'description': result['description'],
+            'room_type': result['room_type'],
+            'online_count': counts.get(room_key(result['id']), 0),
+            'message_count': result['message_count'],
+            'created_by': result['created_by'],
+        }
+        for result in results
+    ]
+
+
+class Snapshot:
+    """الغرف العامة مرتبة بكل ترتيب: قائمة مفاتيح تصاعدية لكل ترتيب
+
+    المفتاح (قيم الترتيب سالبة للتنازلي..., room_id) لذلك الموقع بعد مؤشر
+    يُحسب بـ bisect.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def page(self, sort, after, limit):
+        keys = self.keys[sort]
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+        page = keys[start:start + limit]
+        return page, start + limit < len(keys)
+
+
+class Rankings:
+    """لقطة الترتيبات الحالية مع سجل أعداد الرسائل لحساب النشاط الأخير"""
+
+    def __init__(self):
+        self.snapshot = None
+        self.built_at = None
+        # (الوقت، {room_id: message_count}) من اللقطات السابقة
+        self.history = deque()
+        self._lock = threading.Lock()
+
+    def expire(self):
+        self.built_at = None
+
+    def get(self):
+        config = directory_settings()
+        if self.built_at is not None and time.monotonic() - self.built_at < config['REFRESH']:
+            return self.snapshot
+        if not self._lock.acquire(blocking=self.snapshot is None):
+            # عملية بناء جارية - اللقطة السابقة صالحة للعرض
+            return self.snapshot
+        try:
+            self.snapshot = self.build(config)
+            self.built_at = time.monotonic()
+        finally:
+            self._lock.release()
+        return self.snapshot
+
+    def build(self, config):
+        rows = list(
+            ChatRoom.objects.filter(room_type='public', is_active=True).values_list(
+                'id', 'created_at', 'activity__last_message_at', 'activity__message_count'
+            )
+        )
+        now = time.monotonic()
+        counts = {str(room_id): message_count or 0 for room_id, _, _, message_count in rows}
+        self.history.append((now, counts))
+        # الاحتفاظ بأحدث لقطة أقدم من بداية الفترة كأساس للمقارنة
+        while len(self.history) > 1 and self.history[1][0] <= now - config['ACTIVE_WINDOW']:
+            self.history.popleft()
+        baseline = self.history[0][1]
+
+        online = get_presence().online_counts([room_id for room_id, _, _, _ in rows])
+        active, busiest, newest = [], [], []
+        for room_id, created_at, last_message_at, _ in rows:
+            room_id = str(room_id)
+            recent = counts[room_id] - baseline.get(room_id, 0)
+            last = -last_message_at.timestamp() if last_message_at else 0.0
+            active.append((-recent, last, room_id))
+            busiest.append((-online.get(room_key(room_id), 0), -recent, last, room_id))
+            newest.append((-created_at.timestamp(), room_id))
+        return Snapshot({
+            'active': sorted(active),
+            'online': sorted(busiest),
+            'newest': sorted(newest),
+        })
+
+
+_rankings = Rankings()
+
+
+def encode_directory_cursor(sort, key):
+    raw = json.dumps([sort, *key], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_directory_cursor(token, sort):
+    """مفتاح آخر غرفة في الصفحة السابقة - يرفع ValueError إذا كان غير صالح"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        cursor_sort, *key = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        # مفتاح بطول مختلف لا يقارن مع مفاتيح اللقطة في bisect
+        if len(key) != KEY_LENGTHS.get(sort):
+            raise ValueError
+        key[-1] = room_key(key[-1])
+        if not all(isinstance(value, (int, float)) for value in key[:-1]):
+            raise ValueError
+    except Exception:
+        raise ValueError('مؤشر غير صالح')
+    if cursor_sort != sort:
+        raise ValueError('مؤشر غير صالح')
+    return tuple(key)
+
+
+def directory_page(user, sort='active', cursor=None, limit=None):
+    """صفحة من الغرف العامة: (الغرف، next_cursor أو None)"""
+    if sort not in SORTS:
+        raise ValueError('ترتيب غير معروف')
+    limit = limit or directory_settings()['PAGE_SIZE']
+    after = decode_directory_cursor(cursor, sort) if cursor else None
+
+    keys, has_more = _rankings.get().page(sort, after, limit)
+    room_ids = [key[-1] for key in keys]
+    rooms = annotate_unread_counts(
+        annotate_room_summary(ChatRoom.objects.filter(id__in=room_ids, is_active=True), user),
+        user
+    )
+    by_id = {str(room.id): room for room in attach_online_counts(rooms)}
+    # غرفة حُذفت بعد اللقطة لا تظهر، والمؤشر يبقى على مفتاحها
+    rooms_data = [
+        serialize_room_summary(by_id[room_id], user, can_join=True)
+        for room_id in room_ids if room_id in by_id
+    ]
+    next_cursor = encode_directory_cursor(sort, keys[-1]) if has_more else None
+    return rooms_data, next_cursor
@@ -0,0 +1,145 @@
+# chat/drain.py
+"""إيقاف تدريجي لاتصالات WebSocket عند إعادة تشغيل العملية
+
+عند SIGTERM (إعادة تشغيل daphne أثناء النشر) تدخل العملية وضع التفريغ بدلاً
+من قطع كل الاتصالات معاً:
+
+1. الاتصالات الجديدة تُرفض - العميل يحاول مع عملية أخرى أو بعد قليل
+2. كل اتصال مفتوح يستلم إطار reconnect فيه retry_after عشوائي ورمز
+   استئناف موقّع (المستخدم وآخر مؤشر وصله) ثم يُغلق برمز 1012
+3. المغادرة أثناء التفريغ لا تُبث user_left، والعودة برمز استئناف صالح لا
+   تُبث user_joined - لا موجة حضور في كل غرفة
+4. بعد إغلاق الاتصالات تُحفظ الرسائل المنتظرة في الطابور المؤجل
+   (chat/writebehind.py)، ثم (بعد مهلة قصيرة) يُعاد SIGTERM إلى المعالج الأصلي
+
+توزيع العودة على RETRY_AFTER_MIN..RETRY_AFTER_MAX ثانية مع الاستئناف من
+الذاكرة (chat/replay.py) يمنع أن تعود كل الاتصالات إلى get_messages معاً.
+
+الإعدادات (اختيارية) في settings.CHAT_DRAIN:
+    ENABLED: تثبيت معالج SIGTERM
+    RETRY_AFTER_MIN / RETRY_AFTER_MAX: نطاق تأخير العودة بالثواني
+    TOKEN_MAX_AGE: صلاحية رمز الاستئناف بالثواني
+    GRACE: مهلة بعد إغلاق الاتصالات قبل إيقاف العملية
+"""
+import asyncio
+import os
+import random
+import signal
+import threading
+import weakref
+
+from django.conf import settings
+from django.core import signing
+
+from . import writebehind
+
+DEFAULTS = {
+    'ENABLED': True,
+    'RETRY_AFTER_MIN': 1.0,
+    'RETRY_AFTER_MAX': 15.0,
+    'TOKEN_MAX_AGE': 300,
+    'GRACE': 1.0,
+}
+
+# Service Restart (RFC 6455)
+DRAIN_CLOSE_CODE = 1012
+
+TOKEN_SALT = 'chat.resume'
+
+
+def drain_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_DRAIN', {})}
+
+
+_connections = weakref.WeakSet()
+_draining = False
+_installed = False
+_install_lock = threading.Lock()
+
+
+def is_draining():
+    return _draining
+
+
+def register(consumer):
+    """اتصال مفتوح يجب إغلاقه عند التفريغ - يحتاج دالة async drain(retry_after)"""
+    _connections.add(consumer)
+
+
+def unregister(consumer):
+    _connections.discard(consumer)
+
+
+def retry_after():
+    config = drain_settings()
+    return round(random.uniform(config['RETRY_AFTER_MIN'], config['RETRY_AFTER_MAX']), 1)
+
+
+def make_resume_token(user_id, cursors):
+    """رمز موقّع بآخر مؤشر لكل قناة {stream: cursor}"""
+    return signing.dumps({'u': user_id, 'c': cursors}, salt=TOKEN_SALT, compress=True)
+
+
+def read_resume_token(token, user_id):
+    """المؤشرات من رمز صالح لنفس المستخدم، وإلا None"""
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=drain_settings()['TOKEN_MAX_AGE'])
+    except signing.BadSignature:
+        return None
+    if data.get('u') != user_id or not isinstance(data.get('c'), dict):
+        return None
+    return data['c']
+
+
+async def drain():
+    """إغلاق كل الاتصالات المفتوحة مع تلميح إعادة الاتصال"""
+    global _draining
+    _draining = True
+    connections = list(_connections)
+    for index, consumer in enumerate(connections):
+        try:
+            await consumer.drain(retry_after())
+        except Exception as e:
+            print(f"Error draining connection: {e}")
+        if index % 100 == 99:
+            # عدم حجز الـ event loop أثناء إغلاق آلاف الاتصالات
+            await asyncio.sleep(0)
+    # بعد الإغلاق لا رسائل جديدة - حفظ ما ينتظر في الطابور
+    await writebehind.close_writer()
+    return len(connections)
+
+
+def install_signal_handler():
+    """تثبيت معالج SIGTERM مرة واحدة (من داخل event loop في الـ thread الرئيسي)"""
+    global _installed
+    if _installed or not drain_settings()['ENABLED']:
+        return
+    if threading.current_thread() is not threading.main_thread():
+        return
+    with _install_lock:
+        if _installed:
+            return
+        loop = asyncio.get_running_loop()
+        previous = signal.getsignal(signal.SIGTERM)
+        if previous is None:
+            previous = signal.SIG_DFL
+
+        async def drain_and_exit():
+            try:
+                count = await drain()
+                print(f"Drained {count} WebSocket connections")
+                await asyncio.sleep(drain_settings()['GRACE'])
+            finally:
+                # المعالج الأصلي (daphne/twisted) يكمل الإيقاف
+                signal.signal(signal.SIGTERM, previous)
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            if not _draining:
+                loop.call_soon_threadsafe(loop.create_task, drain_and_exit())
+
+        try:
+            signal.signal(signal.SIGTERM, handle_sigterm)
+        except ValueError:
+            return
+        _installed = True
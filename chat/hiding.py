@@ -0,0 +1,104 @@
+# chat/hiding.py
+"""إخفاء الرسائل لكل مستخدم ("حذف لدي" و"مسح المحادثة")
+
+بدلاً من جدول ربط بصف لكل (رسالة، مستخدم) و exclude(deleted_for=user) الذي
+يصبح استعلاماً فرعياً NOT IN مرتبطاً في كل استعلام سجل، يُحفظ لكل (مستخدم،
+غرفة) صف HiddenMessages واحد:
+
+- cleared_seq: كل رسالة تسلسلها <= هذا الرقم مخفية ("مسح المحادثة" كتابة واحدة)
+- hidden_seqs: أرقام تسلسل مرتبة للرسائل المخفية فردياً بعد cleared_seq
+
+القراءة تكلف استعلاماً واحداً على المفتاح (user, room)، ثم الفلترة بشرط
+seq > N و NOT IN على قائمة ثابتة صغيرة، أو في الذاكرة لنافذة الرسائل.
+"""
+from django.db import transaction
+from django.db.models import Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import HiddenMessages, Message, RoomActivity
+
+
+class HiddenState:
+    """ما أخفاه المستخدم في غرفة واحدة"""
+    __slots__ = ('cleared_seq', 'seqs')
+
+    def __init__(self, cleared_seq=0, seqs=()):
+        self.cleared_seq = cleared_seq
+        self.seqs = frozenset(seqs)
+
+    def __bool__(self):
+        return bool(self.cleared_seq or self.seqs)
+
+    def hides(self, seq):
+        if seq is None:
+            # رسالة في طابور الحفظ المؤجل - أحدث من أي إخفاء
+            return False
+        return seq <= self.cleared_seq or seq in self.seqs
+
+    def filter(self, queryset):
+        """استبعاد الرسائل المخفية من استعلام رسائل الغرفة"""
+        if self.cleared_seq:
+            queryset = queryset.filter(seq__gt=self.cleared_seq)
+        if self.seqs:
+            queryset = queryset.exclude(seq__in=sorted(self.seqs))
+        return queryset
+
+
+NOTHING_HIDDEN = HiddenState()
+
+
+def get_state(user, room_id):
+    row = HiddenMessages.objects.filter(user_id=user.id, room_id=room_id).values_list(
+        'cleared_seq', 'hidden_seqs'
+    ).first()
+    if row is None:
+        return NOTHING_HIDDEN
+    return HiddenState(*row)
+
+
+def visible_messages(queryset, user, room_id):
+    """رسائل الغرفة التي لم يخفها المستخدم"""
+    return get_state(user, room_id).filter(queryset)
+
+
+def exclude_hidden(queryset, user):
+    """استبعاد ما أخفاه المستخدم في كل غرفه - للاستعلامات عبر عدة غرف"""
+    hidden = Q()
+    rows = HiddenMessages.objects.filter(user_id=user.id).values_list('room_id', 'cleared_seq', 'hidden_seqs')
+    for room_id, cleared_seq, seqs in rows:
+        room_hidden = Q(seq__lte=cleared_seq)
+        if seqs:
+            room_hidden |= Q(seq__in=seqs)
+        hidden |= Q(room_id=room_id) & room_hidden
+    return queryset.exclude(hidden) if hidden else queryset
+
+
+def hide_messages(user, room_id, message_ids):
+    """حذف رسائل لدى المستخدم فقط - يُرجع عدد الرسائل التي أُخفيت"""
+    seqs = set(
+        Message.objects.filter(room_id=room_id, id__in=message_ids, seq__isnull=False)
+        .values_list('seq', flat=True)
+    )
+    if not seqs:
+        return 0
+    with transaction.atomic():
+        state, _ = HiddenMessages.objects.select_for_update().get_or_create(user=user, room_id=room_id)
+        seqs = {seq for seq in seqs if seq > state.cleared_seq}
+        state.hidden_seqs = sorted(set(state.hidden_seqs) | seqs)
+        state.save(update_fields=['hidden_seqs', 'updated_at'])
+    return len(seqs)
+
+
+def clear_history(user, room_id):
+    """مسح المحادثة لدى المستخدم: تحديث صف واحد مهما كان عدد الرسائل"""
+    last_seq = Coalesce(
+        Subquery(RoomActivity.objects.filter(room_id=room_id).values('last_seq')[:1]),
+        Value(0)
+    )
+    rows = HiddenMessages.objects.filter(user_id=user.id, room_id=room_id)
+    if rows.update(cleared_seq=last_seq, hidden_seqs=[]):
+        return
+    # أول إخفاء للمستخدم في الغرفة
+    with transaction.atomic():
+        HiddenMessages.objects.get_or_create(user=user, room_id=room_id)
+        rows.update(cleared_seq=last_seq, hidden_seqs=[])
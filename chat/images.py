@@ -0,0 +1,263 @@
+# chat/images.py
+"""معالجة الصور المرفوعة خارج مسار الطلب
+
+send_image يحفظ الأصل فقط ويرد مباشرة. بعد نجاح المعاملة تُرسل الصورة إلى
+مجموعة عمليات (ProcessPoolExecutor) حتى لا يحجز فك الصور وترميزها الخادم:
+
+- تصحيح الاتجاه من EXIF والتصغير إلى كل حجم في SIZES (أطول ضلع) بدون تكبير
+- ترميز كل حجم WebP و JPEG
+- حساب الأبعاد وصورة صغيرة جداً (data URI) تُعرض مكان الصورة حتى تُحمّل
+
+النتيجة تُسلم إلى event loop الخادم (لا يُعمل شيء في thread المجموعة)، ثم
+تُحفظ في Message.image_meta برقم تسلسل جديد (حتى يصل للمزامنة)، ثم
+يُبث حدث image_ready لمجموعة الغرفة. get_messages والبث يُرسلان روابط الأحجام
+(srcset) بدلاً من أن يحمّل كل عميل الأصل بحجمه الكامل.
+
+الإعدادات (اختيارية) في settings.CHAT_IMAGES:
+    WORKERS: عدد العمليات - 0 للمعالجة في نفس الـ thread (التطوير والاختبارات)
+    SIZES: {الاسم: أطول ضلع بالبكسل}
+    DEFAULT_SIZE: الحجم المستخدم في src
+    QUALITY: جودة WebP و JPEG
+    PLACEHOLDER_SIZE: أطول ضلع للصورة المؤقتة
+"""
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from asgiref.sync import SyncToAsync
+from channels.db import database_sync_to_async
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+DEFAULTS = {
+    'WORKERS': 2,
+    'SIZES': {'small': 320, 'medium': 800, 'large': 1600},
+    'DEFAULT_SIZE': 'medium',
+    'QUALITY': 80,
+    'PLACEHOLDER_SIZE': 16,
+}
+
+VARIANTS_DIR = 'chat_images/variants'
+
+FORMATS = (
+    ('webp', 'WEBP', {'method': 4}),
+    ('jpeg', 'JPEG', {'optimize': True, 'progressive': True}),
+)
+
+
+def image_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_IMAGES', {})}
+
+
+def _flatten(image):
+    """JPEG بدون شفافية - الخلفية بيضاء"""
+    if image.mode != 'RGBA':
+        return image
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def render_variants(source_path, media_root, prefix, sizes, quality, placeholder_size):
+    """قراءة الأصل وكتابة الأحجام - تعمل في عملية منفصلة بدون Django
+
+    يُرجع image_meta: الأبعاد، الصورة المؤقتة، وأسماء الملفات لكل حجم.
+    """
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    width, height = image.size
+
+    variants = {}
+    edges = set()
+    for name, edge in sorted(sizes.items(), key=lambda item: item[1]):
+        edge = min(edge, max(width, height))
+        if edge in edges:
+            # الأصل أصغر من هذا الحجم - نفس الملف السابق
+            continue
+        edges.add(edge)
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        entry = {'width': resized.width, 'height': resized.height}
+        for extension, image_format, options in FORMATS:
+            relative = f'{prefix}/{name}.{extension}'
+            path = os.path.join(media_root, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            output = resized if image_format == 'WEBP' else _flatten(resized)
+            output.save(path, image_format, quality=quality, **options)
+            entry[extension] = relative
+        variants[name] = entry
+
+    tiny = _flatten(image.copy())
+    tiny.thumbnail((placeholder_size, placeholder_size))
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'JPEG', quality=50)
+    placeholder = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+    return {
+        'width': width,
+        'height': height,
+        'placeholder': placeholder,
+        'variants': variants,
+    }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn: لا تُنسخ threads الخادم (daphne) إلى العمليات
+                _executor = ProcessPoolExecutor(
+                    max_workers=image_settings()['WORKERS'],
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _executor
+
+
+def schedule(message):
+    """معالجة صورة رسالة جديدة بعد نجاح المعاملة"""
+    if not message.image:
+        return
+    message_id, image_name = message.id, message.image.name
+    transaction.on_commit(lambda: process_image(message_id, image_name))
+
+
+def process_image(message_id, image_name):
+    config = image_settings()
+    try:
+        source_path = default_storage.path(image_name)
+    except NotImplementedError:
+        # تخزين بدون مسار محلي - العملاء يستخدمون الأصل
+        print(f"Image variants need local storage, skipping message {message_id}")
+        return
+    args = (
+        source_path,
+        settings.MEDIA_ROOT,
+        f'{VARIANTS_DIR}/{message_id.hex}',
+        config['SIZES'],
+        config['QUALITY'],
+        config['PLACEHOLDER_SIZE'],
+    )
+    if not config['WORKERS']:
+        try:
+            meta = render_variants(*args)
+        except Exception as e:
+            print(f"Error processing image for message {message_id}: {e}")
+            return
+        save_image_meta(message_id, meta)
+        return
+    future = get_executor().submit(render_variants, *args)
+    loop = server_loop()
+    if loop is not None:
+        future.add_done_callback(lambda done: _finish_on_loop(loop, message_id, done))
+    else:
+        future.add_done_callback(lambda done: _finish_in_thread(message_id, done))
+
+
+def server_loop():
+    """الـ event loop الذي يخدم الطلب الحالي (daphne)، أو None خارج ASGI
+
+    العرض المتزامن يعمل في thread من sync_to_async، وasgiref يحفظ فيه الـ loop الأصلي.
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    if getattr(SyncToAsync.threadlocal, 'main_event_loop_pid', None) != os.getpid():
+        return None
+    loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+    return loop if loop is not None and not loop.is_closed() else None
+
+
+def _finish_on_loop(loop, message_id, future):
+    """من thread إدارة المجموعة: لا عمل هنا، النتيجة تُسلم لـ loop الخادم
+
+    الحفظ يتم في threads قاعدة البيانات والبث عبر async_to_sync يعود إلى نفس
+    الـ loop - InMemoryChannelLayer لا يعمل من loop آخر، وthread الإدارة لا يُحجز.
+    """
+    try:
+        asyncio.run_coroutine_threadsafe(database_sync_to_async(_finish)(message_id, future), loop)
+    except RuntimeError as e:
+        # الـ loop أُغلق (إيقاف الخادم)
+        print(f"Error saving image variants for message {message_id}: {e}")
+
+
+def _finish_in_thread(message_id, future):
+    """خارج ASGI (أوامر manage.py): thread منفصل بدلاً من thread الإدارة"""
+    def run():
+        try:
+            _finish(message_id, future)
+        finally:
+            # اتصال هذا الـ thread فقط
+            connections.close_all()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _finish(message_id, future):
+    """حفظ نتيجة المعالجة المنتهية"""
+    try:
+        meta = future.result()
+    except Exception as e:
+        print(f"Error processing image for message {message_id}: {e}")
+        return
+    try:
+        save_image_meta(message_id, meta)
+    except Exception as e:
+        print(f"Error saving image variants for message {message_id}: {e}")
+
+
+def save_image_meta(message_id, meta):
+    """حفظ الأحجام برقم تسلسل جديد ثم بث image_ready"""
+    from .broadcast import broadcast_message_change
+    from .models import Message
+    from .sequence import allocate_seq
+
+    with transaction.atomic():
+        message = Message.objects.select_for_update().filter(id=message_id).first()
+        if message is None:
+            # حُذفت الرسالة أثناء المعالجة
+            return
+        message.image_meta = meta
+        message.changed_seq = allocate_seq(message.room_id)
+        message.save(update_fields=['image_meta', 'changed_seq'])
+        transaction.on_commit(lambda: broadcast_message_change('image', message))
+
+
+def image_data(message):
+    """روابط الأحجام للعميل، أو None قبل انتهاء المعالجة"""
+    meta = message.image_meta
+    if not meta or not meta.get('variants'):
+        return None
+    variants = {}
+    srcset = {extension: [] for extension, _, _ in FORMATS}
+    for name, entry in meta['variants'].items():
+        variant = {'width': entry['width'], 'height': entry['height']}
+        for extension in srcset:
+            url = default_storage.url(entry[extension])
+            variant[extension] = url
+            srcset[extension].append(f"{url} {entry['width']}w")
+        variants[name] = variant
+    default = variants.get(image_settings()['DEFAULT_SIZE']) or list(variants.values())[-1]
+    return {
+        'width': meta['width'],
+        'height': meta['height'],
+        'placeholder': meta['placeholder'],
+        'src': default['jpeg'],
+        'srcset': {extension: ', '.join(items) for extension, items in srcset.items()},
+        'variants': variants,
+    }
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.broadcast import group_event
+from chat.consumers import ChatConsumer
+from chat.outbox import Outbox
+
+
+class _SinkConsumer(ChatConsumer):
+    """مستهلك بدون اتصال فعلي - send لا يفعل شيئاً لقياس تكلفة المعالج فقط"""
+
+    def __init__(self):
+        super().__init__()
+        self.room_id = 'bench'
+        self.replayed = set()
+        self.recent_messages = OrderedDict()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.last_frame = text_data
+
+
+async def _legacy_chat_message(consumer, event):
+    """الطريقة السابقة: كل مستقبل يبني القاموس ويرمّزه بنفسه"""
+    await consumer.send(text_data=json.dumps({
+        'type': 'message',
+        'message': event['message'],
+        'message_id': event['message_id'],
+        'sender': event['sender'],
+        'display_name': event['display_name'],
+        'timestamp': event['timestamp'],
+        'reply_to': event.get('reply_to')
+    }))
+
+
+class Command(BaseCommand):
+    help = 'قياس تكلفة المعالج لبث رسالة واحدة إلى N متصل (ترميز لكل متصل مقابل ترميز مرة واحدة)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', nargs='+', type=int, default=[100, 1000, 5000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        payload = {
+            'type': 'message',
+            'message': 'مرحباً بالجميع في الغرفة العامة ' * 4,
+            'message_id': str(uuid.uuid4()),
+            'sender': 'sender@example.com',
+            'display_name': 'مرسل تجريبي',
+            'timestamp': timezone.now().isoformat(),
+            'reply_to': {'id': str(uuid.uuid4()), 'sender': 'other@example.com', 'message': 'رسالة سابقة'},
+        }
+        legacy_event = dict(payload, type='chat_message')
+
+        self.stdout.write(f"{'connections':>12} {'per-recipient ms':>18} {'serialize-once ms':>18} {'saved':>8}")
+        for count in options['connections']:
+            consumers = [_SinkConsumer() for _ in range(count)]
+            legacy = self._best_of(options['repeat'], self._run_legacy, consumers, legacy_event)
+            once = self._best_of(options['repeat'], self._run_once, consumers, payload)
+            saved = (1 - once / legacy) * 100 if legacy else 0
+            self.stdout.write(f"{count:>12} {legacy * 1000:>18.2f} {once * 1000:>18.2f} {saved:>7.1f}%")
+
+    def _best_of(self, repeat, runner, consumers, data):
+        # كل تشغيل يقيس وقت البث فقط بدون تهيئة الاتصالات
+        return min(asyncio.run(runner(consumers, data)) for _ in range(repeat))
+
+    async def _run_legacy(self, consumers, event):
+        start = time.process_time()
+        for consumer in consumers:
+            await _legacy_chat_message(consumer, event)
+        return time.process_time() - start
+
+    async def _run_once(self, consumers, payload):
+        # طابور الإرسال يُنشأ مرة واحدة لكل اتصال - خارج القياس
+        for consumer in consumers:
+            consumer.outbox = Outbox(consumer.send, None)
+
+        # الترميز عند المرسل مرة واحدة ثم التمرير لكل مستقبل عبر طابور الإرسال
+        start = time.process_time()
+        event = group_event('chat_message', payload)
+        for consumer in consumers:
+            await consumer.chat_message(event)
+        while any(len(consumer.outbox) for consumer in consumers):
+            await asyncio.sleep(0)
+        elapsed = time.process_time() - start
+
+        for consumer in consumers:
+            consumer.outbox.close()
+        return elapsed
@@ -0,0 +1,327 @@
+# chat/message_cache.py
+"""نافذة آخر الرسائل للغرف النشطة في ذاكرة العملية (LRU)
+
+room_detail يعرض آخر 100 رسالة و get_messages يُستدعى مع كل استعلام دوري،
+وكلاهما كان يقرأ نفس الرسائل من قاعدة البيانات في كل مرة. هنا تُحفظ آخر
+WINDOW رسالة لكل غرفة مقروءة مؤخراً مع المرسل والرد (كائنات Message جاهزة
+وقاموس get_messages):
+
+- الصلاحية: النافذة صالحة ما دام last_seq المحفوظ يساوي RoomActivity.last_seq
+  (يُقرأ مع الغرفة بـ select_related)، لذلك أي رسالة أو تعديل أو حذف من
+  عملية أخرى يؤدي لإعادة التحميل بدلاً من عرض نافذة قديمة
+- الكتابة: بعد حفظ رسالة (المستهلك، الإرسال عبر HTTP، الحفظ المؤجل) تُضاف
+  للنافذة الموجودة إذا كان رقمها التالي مباشرة، وإلا تُحذف النافذة
+- الحجم: تقدير تقريبي بالبايت لكل رسالة، والأقل استخداماً يُحذف عند تجاوز MAX_BYTES
+- الفلترة لكل مستخدم: الرسائل التي أخفاها (chat/hiding.py) تُستبعد عند القراءة
+
+الإعدادات (اختيارية) في settings.CHAT_MESSAGE_CACHE:
+    ENABLED: تفعيل الذاكرة
+    WINDOW: عدد الرسائل المحفوظة لكل غرفة
+    MAX_BYTES: الحجم التقريبي الأقصى لكل النوافذ
+"""
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+
+from .pagination import decode_cursor
+from .presence import room_key
+
+DEFAULTS = {
+    'ENABLED': True,
+    'WINDOW': 200,
+    'MAX_BYTES': 16 * 1024 * 1024,
+}
+
+# تقدير الحجم الثابت لكل رسالة (الكائن، المرسل، القاموس) بدون النص
+ENTRY_OVERHEAD = 2048
+
+
+def cache_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_MESSAGE_CACHE', {})}
+
+
+def message_position(message):
+    return (message.timestamp, str(message.id))
+
+
+class CachedMessage:
+    __slots__ = ('message', 'data', 'position', 'size')
+
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+        self.position = message_position(message)
+        self.size = ENTRY_OVERHEAD + 2 * len(message.content or '')
+
+
+class RoomWindow:
+    """آخر رسائل الغرفة بالترتيب الزمني
+
+    complete = True إذا كانت النافذة تحتوي كل رسائل الغرفة (لا يوجد أقدم منها).
+    """
+
+    def __init__(self, entries, last_seq, complete):
+        self.entries = list(entries)
+        self.last_seq = last_seq
+        self.complete = complete
+        self.size = sum(entry.size for entry in self.entries)
+
+    def visible(self, hidden):
+        """الرسائل التي لم يخفها المستخدم (HiddenState)"""
+        if not hidden:
+            return self.entries
+        return [entry for entry in self.entries if not hidden.hides(entry.message.seq)]
+
+    def covers(self, position):
+        """هل كل الرسائل بعد هذا الموقع موجودة في النافذة"""
+        if self.complete:
+            return True
+        return bool(self.entries) and position >= self.entries[0].position
+
+
+class MessageCache:
+    def __init__(self, window, max_bytes):
+        self.window = window
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room_id, last_seq):
+        """النافذة إذا كانت مطابقة لآخر تسلسل في قاعدة البيانات، وإلا None"""
+        key = room_key(room_id)
+        with self._lock:
+            window = self._rooms.get(key)
+            if window is None or window.last_seq != last_seq:
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(key)
+            self.hits += 1
+            return window
+
+    def put(self, room_id, window):
+        key = room_key(room_id)
+        with self._lock:
+            self._remove(key)
+            self._rooms[key] = window
+            self._bytes += window.size
+            self._evict()
+
+    def append(self, room_id, entries):
+        """إضافة رسائل جديدة (مرتبة بالتسلسل) إلى نافذة موجودة"""
+        key = room_key(room_id)
+        with self._lock:
+            window = self._rooms.get(key)
+            if window is None:
+                return
+            # النافذة حُمّلت بعد الحفظ وقبل هذا الاستدعاء - الرسالة فيها مسبقاً
+            existing = {entry.message.id for entry in window.entries}
+            entries = [entry for entry in entries if entry.message.id not in existing]
+            if not entries:
+                return
+            if entries[0].message.seq != window.last_seq + 1:
+                # فاتت النافذة رسالة (من عملية أخرى) - تُحمّل من جديد عند القراءة
+                self._remove(key)
+                return
+            merged = window.entries + entries
+            dropped = max(0, len(merged) - self.window)
+            updated = RoomWindow(
+                merged[dropped:],
+                entries[-1].message.seq,
+                window.complete and not dropped
+            )
+            self._bytes += updated.size - window.size
+            self._rooms[key] = updated
+            self._evict()
+
+    def invalidate(self, room_id=None):
+        with self._lock:
+            if room_id is None:
+                self._rooms.clear()
+                self._bytes = 0
+            else:
+                self._remove(room_key(room_id))
+
+    def invalidate_sender(self, user_id, display_name):
+        """حذف نوافذ الغرف التي فيها رسائل للمستخدم باسم معروض مختلف"""
+        with self._lock:
+            stale = [
+                key for key, window in self._rooms.items()
+                if any(
+                    entry.message.sender_id == user_id and entry.data['sender_display'] != display_name
+                    for entry in window.entries
+                )
+            ]
+            for key in stale:
+                self._remove(key)
+
+    def _remove(self, key):
+        window = self._rooms.pop(key, None)
+        if window is not None:
+            self._bytes -= window.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._rooms) > 1:
+            _, window = self._rooms.popitem(last=False)
+            self._bytes -= window.size
+
+    def __contains__(self, room_id):
+        return room_key(room_id) in self._rooms
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._rooms),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = cache_settings()
+                _cache = MessageCache(config['WINDOW'], config['MAX_BYTES'])
+    return _cache
+
+
+def is_enabled():
+    return cache_settings()['ENABLED']
+
+
+def build_entries(messages):
+    """تحويل رسائل مجلوبة عبر with_message_relations إلى عناصر النافذة"""
+    from .serializers import serialize_message
+
+    return [CachedMessage(message, serialize_message(message)) for message in messages]
+
+
+def load_window(room, last_seq):
+    """قراءة آخر WINDOW رسالة من قاعدة البيانات"""
+    from .models import Message
+    from .serializers import with_message_relations
+
+    size = get_cache().window
+    page = list(
+        with_message_relations(Message.objects.filter(room=room))
+        .order_by('-timestamp', '-id')[:size + 1]
+    )
+    complete = len(page) <= size
+    window = RoomWindow(build_entries(list(reversed(page[:size]))), last_seq, complete)
+    get_cache().put(room.id, window)
+    return window
+
+
+def room_last_seq(room):
+    activity = getattr(room, 'activity', None)
+    return activity.last_seq if activity is not None else None
+
+
+def get_window(room):
+    """نافذة الغرفة من الذاكرة أو من قاعدة البيانات - None إذا كانت الذاكرة معطلة
+
+    الغرفة يجب أن تكون مجلوبة مع activity (select_related) حتى لا يكلف التحقق استعلاماً.
+    """
+    if not is_enabled():
+        return None
+    last_seq = room_last_seq(room)
+    if last_seq is None:
+        return None
+    window = get_cache().get(room.id, last_seq)
+    if window is None:
+        window = load_window(room, last_seq)
+    return window
+
+
+def latest_page(room, hidden, limit):
+    """أحدث limit رسالة للمستخدم من النافذة: (العناصر، has_more) أو None"""
+    window = get_window(room)
+    if window is None:
+        return None
+    visible = window.visible(hidden)
+    if len(visible) <= limit and not window.complete:
+        # رسائل أقدم في قاعدة البيانات قد تكمل الصفحة
+        return None
+    page = visible[-limit:]
+    has_more = len(visible) > limit or not window.complete
+    return page, has_more
+
+
+def page_after(room, hidden, cursor, limit):
+    """الرسائل بعد المؤشر من النافذة: (العناصر، has_more) أو None إذا لم تغطه"""
+    try:
+        timestamp, message_id = decode_cursor(cursor)
+    except ValueError:
+        return None
+    position = (timestamp, str(message_id))
+    window = get_window(room)
+    if window is None or not window.covers(position):
+        return None
+    newer = [entry for entry in window.visible(hidden) if entry.position > position]
+    return newer[:limit], len(newer) > limit
+
+
+def page_after_id(room, hidden, message_id, limit):
+    """الطريقة القديمة (last_id): الرسائل بعد رسالة معروفة، أو None"""
+    window = get_window(room)
+    if window is None:
+        return None
+    for index, entry in enumerate(window.entries):
+        if str(entry.message.id) == str(message_id):
+            newer = [e for e in window.entries[index + 1:] if not hidden.hides(e.message.seq)]
+            return newer[:limit]
+    return None
+
+
+def record_messages(messages):
+    """إضافة رسائل محفوظة إلى نوافذ غرفها الموجودة (بعد نجاح المعاملة)"""
+    from .models import Message
+    from .serializers import with_message_relations
+
+    if not is_enabled():
+        return
+    cache = get_cache()
+    by_room = defaultdict(list)
+    for message in messages:
+        if message.room_id in cache:
+            by_room[message.room_id].append(message.id)
+    if not by_room:
+        return
+
+    # استعلام واحد للرسائل الجديدة مع المرسل والرد - بدلاً من استعلامات كل قارئ
+    loaded = with_message_relations(
+        Message.objects.filter(id__in=[pk for ids in by_room.values() for pk in ids])
+    ).order_by('seq')
+    entries = defaultdict(list)
+    for entry in build_entries(list(loaded)):
+        entries[entry.message.room_id].append(entry)
+    for room_id, room_entries in entries.items():
+        cache.append(room_id, room_entries)
+
+
+def invalidate_room(room_id):
+    get_cache().invalidate(room_id)
+
+
+def invalidate_all():
+    get_cache().invalidate()
+
+
+def invalidate_sender(user_id, display_name):
+    """الاسم المعروض محفوظ في قواميس النوافذ"""
+    get_cache().invalidate_sender(user_id, display_name)
+
+
+def stats():
+    return get_cache().stats()
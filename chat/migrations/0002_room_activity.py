@@ -0,0 +1,53 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_room_activity(apps, schema_editor):
+    """حساب ملخص النشاط للغرف الموجودة مسبقاً"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    RoomActivity = apps.get_model('chat', 'RoomActivity')
+
+    for room in ChatRoom.objects.all().iterator():
+        messages = Message.objects.filter(room=room)
+        last_message = messages.order_by('-timestamp').first()
+        RoomActivity.objects.create(
+            room=room,
+            message_count=messages.count(),
+            participant_count=room.participants.count(),
+            last_message_id=last_message.id if last_message else None,
+            last_message_preview=last_message.content[:100] if last_message else '',
+            last_message_sender_id=last_message.sender_id if last_message else None,
+            last_message_at=last_message.timestamp if last_message else None,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomActivity',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity', serialize=False, to='chat.chatroom')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('participant_count', models.PositiveIntegerField(default=0)),
+                ('last_message_id', models.UUIDField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=100)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_message_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'نشاط الغرفة',
+                'verbose_name_plural': 'نشاط الغرف',
+            },
+        ),
+        migrations.RunPython(backfill_room_activity, migrations.RunPython.noop),
+    ]
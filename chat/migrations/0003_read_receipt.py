@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_room_activity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_at', models.DateTimeField()),
+                ('last_read_message_id', models.UUIDField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_receipts', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_receipts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'مؤشر القراءة',
+                'verbose_name_plural': 'مؤشرات القراءة',
+                'indexes': [models.Index(fields=['room', 'last_read_at'], name='chat_readre_room_id_43ad8e_idx')],
+                'unique_together': {('user', 'room')},
+            },
+        ),
+    ]
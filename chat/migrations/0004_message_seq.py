@@ -0,0 +1,67 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:53
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_seq(apps, schema_editor):
+    """ترقيم الرسائل الموجودة لكل غرفة بترتيب (timestamp, id)"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    RoomActivity = apps.get_model('chat', 'RoomActivity')
+    for room_id in ChatRoom.objects.values_list('id', flat=True).iterator():
+        messages = list(Message.objects.filter(room_id=room_id).order_by('timestamp', 'id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = message.changed_seq = seq
+        Message.objects.bulk_update(messages, ['seq', 'changed_seq'], batch_size=500)
+        RoomActivity.objects.update_or_create(room_id=room_id, defaults={'last_seq': len(messages)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_read_receipt'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.UUIDField()),
+                ('seq', models.PositiveBigIntegerField()),
+                ('message_id', models.UUIDField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='changed_seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='roomactivity',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'changed_seq'], name='chat_messag_room_id_8cad0f_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_message_room_seq'),
+        ),
+        migrations.AddIndex(
+            model_name='messagetombstone',
+            index=models.Index(fields=['room_id', 'seq'], name='chat_messag_room_id_6b8840_idx'),
+        ),
+    ]
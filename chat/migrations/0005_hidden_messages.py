@@ -0,0 +1,58 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:05
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copy_deleted_for(apps, schema_editor):
+    """نقل صفوف deleted_for إلى قائمة hidden_seqs لكل (مستخدم، غرفة)"""
+    Message = apps.get_model('chat', 'Message')
+    HiddenMessages = apps.get_model('chat', 'HiddenMessages')
+    hidden = defaultdict(set)
+    rows = Message.deleted_for.through.objects.filter(
+        message__seq__isnull=False
+    ).values_list('customuser_id', 'message__room_id', 'message__seq')
+    for user_id, room_id, seq in rows.iterator():
+        hidden[(user_id, room_id)].add(seq)
+    HiddenMessages.objects.bulk_create(
+        [
+            HiddenMessages(user_id=user_id, room_id=room_id, hidden_seqs=sorted(seqs))
+            for (user_id, room_id), seqs in hidden.items()
+        ],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HiddenMessages',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cleared_seq', models.PositiveBigIntegerField(default=0)),
+                ('hidden_seqs', models.JSONField(blank=True, default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hidden_messages', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hidden_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'الرسائل المخفية',
+                'verbose_name_plural': 'الرسائل المخفية',
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(copy_deleted_for, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='deleted_for',
+        ),
+    ]
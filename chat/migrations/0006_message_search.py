@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from chat.search import document_text, get_backend
+
+
+def build_search_index(apps, schema_editor):
+    """فهرسة الرسائل الموجودة ثم إنشاء الفهرس النصي حسب قاعدة البيانات"""
+    Message = apps.get_model('chat', 'Message')
+    MessageSearchDocument = apps.get_model('chat', 'MessageSearchDocument')
+    documents = []
+    messages = Message.objects.only('id', 'content', 'file_name', 'message_type')
+    for message in messages.iterator(chunk_size=1000):
+        body = document_text(message)
+        if body:
+            documents.append(MessageSearchDocument(message_id=message.id, body=body))
+        if len(documents) >= 1000:
+            MessageSearchDocument.objects.bulk_create(documents)
+            documents = []
+    MessageSearchDocument.objects.bulk_create(documents)
+    get_backend(schema_editor.connection.vendor).install(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    get_backend(schema_editor.connection.vendor).uninstall(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_hidden_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='chat.message')),
+            ],
+            options={
+                'verbose_name': 'فهرس البحث',
+                'verbose_name_plural': 'فهرس البحث',
+            },
+        ),
+        migrations.RunPython(build_search_index, drop_search_index),
+    ]
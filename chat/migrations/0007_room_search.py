@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from chat.models import RoomSearchDocument as CurrentRoomSearchDocument
+from chat.search import get_backend, normalize
+
+
+def build_room_index(apps, schema_editor):
+    """فهرسة أسماء الغرف الموجودة ثم إنشاء الفهرس النصي"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    RoomSearchDocument = apps.get_model('chat', 'RoomSearchDocument')
+    RoomSearchDocument.objects.bulk_create(
+        [
+            RoomSearchDocument(room_id=room.id, body=normalize(f"{room.name} {room.description or ''}"))
+            for room in ChatRoom.objects.only('id', 'name', 'description').iterator()
+        ],
+        batch_size=1000
+    )
+    get_backend(schema_editor.connection.vendor, CurrentRoomSearchDocument).install(schema_editor)
+
+
+def drop_room_index(apps, schema_editor):
+    get_backend(schema_editor.connection.vendor, CurrentRoomSearchDocument).uninstall(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='chat.chatroom')),
+            ],
+            options={
+                'verbose_name': 'فهرس بحث الغرف',
+                'verbose_name_plural': 'فهرس بحث الغرف',
+            },
+        ),
+        migrations.RunPython(build_room_index, drop_room_index),
+    ]
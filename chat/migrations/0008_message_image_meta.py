@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_room_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='image_meta',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
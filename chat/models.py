@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from accounts.models import CustomUser
 from django.utils import timezone
 import uuid
@@ -37,44 +37,26 @@ class ChatRoom(models.Model):
         return f"{self.name} ({self.get_room_type_display()})"
     
     def get_online_count(self):
-        """الحصول على عدد المستخدمين المتصلين في الغرفة"""
-        try:
-            # استخدام OnlineUser model للعد
-            return self.online_users.filter(
-                onlineuser__is_online=True
-            ).distinct().count()
-        except Exception as e:
-            print(f"Error in get_online_count: {e}")
-            return 0
+        """الحصول على عدد المستخدمين المتصلين في الغرفة (من الذاكرة)"""
+        from .presence import get_presence
+        return get_presence().online_count(self.id)
+        
+    def get_online_user_ids(self):
+        """معرفات المستخدمين المتصلين في الغرفة (من الذاكرة)"""
+        from .presence import get_presence
+        return get_presence().online_user_ids(self.id)
         
     def add_online_user(self, user):
         """إضافة مستخدم إلى قائمة المتصلين"""
-        try:
-            online_user, created = OnlineUser.objects.get_or_create(
-                user=user,
-                room=self,
-                defaults={'is_online': True}
-            )
-            if not created:
-                online_user.is_online = True
-                online_user.last_seen = timezone.now()
-                online_user.save()
-            return True
-        except Exception as e:
-            print(f"Error adding online user: {e}")
-            return False
+        from .presence import get_presence
+        get_presence().connect(user.id, self.id, user.email)
+        return True
     
     def remove_online_user(self, user):
         """إزالة مستخدم من قائمة المتصلين"""
-        try:
-            OnlineUser.objects.filter(
-                user=user,
-                room=self
-            ).update(is_online=False, last_seen=timezone.now())
-            return True
-        except Exception as e:
-            print(f"Error removing online user: {e}")
-            return False
+        from .presence import get_presence
+        get_presence().disconnect(user.id, self.id)
+        return True
     
     def can_join(self, user):
         if self.room_type == 'public':
@@ -139,21 +121,44 @@ class Message(models.Model):
     edited_at = models.DateTimeField(blank=True, null=True)
     reply_to = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True)
     
-    # لحذف الرسائل بشكل انتقائي
-    deleted_for = models.ManyToManyField(CustomUser, related_name='deleted_messages', blank=True)
+    # تسلسل الغرفة: رقم متصل بدون فجوات يُخصص عند الإدراج في نفس المعاملة
+    seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+    # رقم آخر تغيير (الإنشاء أو آخر تعديل) - للمزامنة "كل ما بعد seq N"
+    changed_seq = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+    # أحجام الصورة بعد المعالجة (chat/images.py) - فارغ حتى تنتهي
+    image_meta = models.JSONField(blank=True, null=True, editable=False)
     
     class Meta:
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['room', 'timestamp']),
             models.Index(fields=['sender', 'timestamp']),
+            models.Index(fields=['room', 'changed_seq']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_message_room_seq'),
         ]
     
     def __str__(self):
         return f"{self.sender.email}: {self.content[:20]}"
     
+    def save(self, *args, **kwargs):
+        if self.seq is None and self._state.adding:
+            from .sequence import allocate_seq
+            # التخصيص والإدراج في معاملة واحدة - التراجع لا يترك فجوة
+            with transaction.atomic():
+                self.seq = self.changed_seq = allocate_seq(self.room_id)
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
+    
     def is_deleted_for_user(self, user):
-        return self.deleted_for.filter(id=user.id).exists()
+        from .hiding import get_state
+        return get_state(user, self.room_id).hides(self.seq)
+    
+    def image_data(self):
+        from .images import image_data
+        return image_data(self)
 
 class UserProfile(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, related_name='chat_profile')
@@ -175,6 +180,148 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.email} Profile"
 
+class RoomActivity(models.Model):
+    """ملخص نشاط الغرفة - يتم تحديثه عند كل رسالة بدلاً من COUNT على جدول الرسائل"""
+    room = models.OneToOneField(ChatRoom, on_delete=models.CASCADE, primary_key=True, related_name='activity')
+    message_count = models.PositiveIntegerField(default=0)
+    participant_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.UUIDField(blank=True, null=True)
+    last_message_preview = models.CharField(max_length=100, blank=True, default='')
+    last_message_sender = models.ForeignKey(
+        CustomUser,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+'
+    )
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    # آخر رقم في تسلسل الغرفة (الرسائل والتعديلات والحذف)
+    last_seq = models.PositiveBigIntegerField(default=0)
+    
+    class Meta:
+        verbose_name = 'نشاط الغرفة'
+        verbose_name_plural = 'نشاط الغرف'
+    
+    def __str__(self):
+        return f"{self.room.name}: {self.message_count} رسالة"
+
+class MessageTombstone(models.Model):
+    """أثر رسالة محذوفة حتى تعرف المزامنة بالحذف بعد seq معين
+
+    room_id بدون مفتاح أجنبي لأن الحذف قد يحدث أثناء حذف الغرفة نفسها.
+    """
+    room_id = models.UUIDField()
+    seq = models.PositiveBigIntegerField()
+    message_id = models.UUIDField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_id', 'seq']),
+        ]
+
+    def __str__(self):
+        return f"{self.message_id} (seq {self.seq})"
+
+class HiddenMessages(models.Model):
+    """الرسائل التي أخفاها المستخدم عن نفسه في غرفة - صف واحد لكل (مستخدم، غرفة)
+
+    "مسح المحادثة" يحفظ cleared_seq فقط (كل ما قبله مخفي) بدلاً من صف لكل رسالة،
+    والحذف الفردي يضيف أرقام التسلسل إلى قائمة مرتبة بعد cleared_seq.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='hidden_messages')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='hidden_messages')
+    cleared_seq = models.PositiveBigIntegerField(default=0)
+    hidden_seqs = models.JSONField(default=list, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['user', 'room']
+        verbose_name = 'الرسائل المخفية'
+        verbose_name_plural = 'الرسائل المخفية'
+
+    def __str__(self):
+        return f"{self.user.email} - {self.room.name} (حتى {self.cleared_seq} + {len(self.hidden_seqs)})"
+
+class ReadReceipt(models.Model):
+    """آخر رسالة قرأها المستخدم في الغرفة - صف واحد لكل (مستخدم، غرفة) وليس لكل رسالة
+
+    الموقع (last_read_at, last_read_message_id) بنفس ترتيب مؤشرات الترقيم،
+    وكل الرسائل حتى هذا الموقع تعتبر مقروءة.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='read_receipts')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_receipts')
+    last_read_at = models.DateTimeField()
+    last_read_message_id = models.UUIDField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['user', 'room']
+        indexes = [
+            models.Index(fields=['room', 'last_read_at']),
+        ]
+        verbose_name = 'مؤشر القراءة'
+        verbose_name_plural = 'مؤشرات القراءة'
+
+    def __str__(self):
+        return f"{self.user.email} - {self.room.name} ({self.last_read_at})"
+
+class MessageSearchDocument(models.Model):
+    """نص الرسالة بعد التطبيع للبحث - الفهرس النصي نفسه يُبنى عليه (chat/search.py)
+
+    في SQLite جدول FTS5 بمحتوى خارجي من هذا الجدول (تحدثه triggers)، وفي
+    PostgreSQL فهرس GIN على to_tsvector لعمود body.
+    """
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='search_document')
+    body = models.TextField()
+
+    class Meta:
+        verbose_name = 'فهرس البحث'
+        verbose_name_plural = 'فهرس البحث'
+
+    def __str__(self):
+        return f"{self.message_id}: {self.body[:20]}"
+
+class RoomSearchDocument(models.Model):
+    """اسم الغرفة ووصفها بعد التطبيع - لبحث دليل الغرف بنفس الفهرس النصي"""
+    room = models.OneToOneField(ChatRoom, on_delete=models.CASCADE, related_name='search_document')
+    body = models.TextField()
+
+    class Meta:
+        verbose_name = 'فهرس بحث الغرف'
+        verbose_name_plural = 'فهرس بحث الغرف'
+
+    def __str__(self):
+        return f"{self.room_id}: {self.body[:20]}"
+
+class FileUpload(models.Model):
+    """رفع ملف على أجزاء قابل للاستئناف (chat/uploads.py)
+
+    الأجزاء تُكتب مباشرة في ملف مؤقت على القرص، و received عدد البايتات
+    المحفوظة منه - العميل يكمل من هذا الموقع بعد انقطاع الاتصال. عند الإنهاء
+    يُنقل الملف إلى chat_files/ وتُنشأ رسالة الملف في نفس المعاملة.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='uploads')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='uploads')
+    file_name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    # الرسالة بعد الإنهاء - إعادة طلب الإنهاء تُرجعها بدلاً من رسالة ثانية
+    message = models.OneToOneField(Message, on_delete=models.SET_NULL, blank=True, null=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at']),
+        ]
+        verbose_name = 'رفع ملف'
+        verbose_name_plural = 'رفع الملفات'
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received}/{self.size})"
+
 # في chat/models.py - تأكد من نموذج OnlineUser
 class OnlineUser(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
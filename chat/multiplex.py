@@ -0,0 +1,329 @@
+# chat/multiplex.py
+"""اتصال WebSocket واحد لكل مستخدم يحمل عدة قنوات (غرف دردشة وإشارات المكالمات)
+
+بدلاً من اتصال لكل غرفة (ws/chat/room/<id>/) واتصال للمكالمات (ws/call/)،
+كل منها بمصافحة وجلسة ومصادقة خاصة، يشترك العميل في القنوات عبر اتصال واحد:
+
+    من العميل:
+        {"action": "subscribe", "stream": "room:<room_id>", "window": 100, "cursor": "<آخر مؤشر>"}
+        {"action": "unsubscribe", "stream": "room:<room_id>"}
+        {"action": "credit", "stream": "room:<room_id>", "frames": 50}
+        {"stream": "room:<room_id>", "payload": {"type": "message", "message": "..."}}
+        {"action": "subscribe", "stream": "call"}
+        {"stream": "call", "payload": {"type": "start_call", ...}}
+
+    من الخادم:
+        {"stream": "room:<room_id>", "payload": {...نفس إطارات ChatConsumer...}}
+        {"stream": "...", "payload": {"type": "subscribed" | "unsubscribed" | "stream_lagged" | "error"}}
+
+التحكم في التدفق لكل قناة: إذا حدد العميل window يُرسل الخادم هذا العدد من
+الإطارات فقط ثم ينتظر credit. ما يصل أثناء الانتظار يُحفظ حتى MAX_PENDING
+إطار، وبعدها تُهمل الإطارات المعلقة ويُرسل stream_lagged ليستكمل العميل من
+آخر مؤشر عبر get_messages. القناة البطيئة لا توقف باقي القنوات.
+
+عند إعادة الاتصال يرسل العميل cursor في subscribe فيصله ما فاته من ذاكرة
+الاستئناف (chat/replay.py) قبل الأحداث الجديدة. عند إيقاف العملية يصل
+{"type": "reconnect", "retry_after", "streams", "resume"} ويعود العميل إلى
+ws/chat/mux/?resume=<رمز> ويشترك في نفس القنوات (chat/drain.py).
+"""
+import json
+from collections import deque
+from urllib.parse import parse_qs
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from calls.consumers import CallSignaling
+
+from . import drain
+from .consumers import ChatConsumer
+from .outbox import MESSAGE, OVERFLOW_CLOSE_CODE, Outbox, write_buffer_probe
+from .presence import room_key
+from .broadcast import user_group_name
+
+# أقصى عدد قنوات في الاتصال الواحد
+MAX_STREAMS = 50
+
+# أقصى عدد إطارات معلقة لقناة استنفدت رصيدها
+MAX_PENDING = 500
+
+
+class Stream:
+    """حالة التدفق لقناة واحدة"""
+
+    def __init__(self, name, window=None):
+        self.name = name
+        # None = بدون تحكم في التدفق
+        self.credits = window
+        self.pending = deque()
+        self.lagged = False
+        # RoomStream لقنوات الغرف
+        self.room = None
+
+    def can_send(self):
+        return self.credits is None or self.credits > 0
+
+
+class RoomStream(ChatConsumer):
+    """ChatConsumer كقناة داخل اتصال متعدد
+
+    يستخدم channel_name الخاص بالاتصال الأب، ويُرسل إطاراته عبره بدلاً من WebSocket خاص.
+    """
+
+    def __init__(self, mux, stream, room_id, cursor=None, resumed=False):
+        super().__init__()
+        self.mux = mux
+        self.stream = stream
+        self.scope = {**mux.scope, 'url_route': {'kwargs': {'room_id': room_id}}}
+        self.channel_layer = mux.channel_layer
+        self.channel_name = mux.channel_name
+        self.accepted = False
+        self.cursor = cursor
+        self.resumed = resumed
+
+    def resume_state(self):
+        return self.cursor, self.resumed
+
+    async def drain(self, retry_after):
+        # الاتصال الأب يُغلق كل القنوات معاً برمز استئناف واحد
+        pass
+
+    async def accept(self, subprotocol=None, headers=None):
+        self.accepted = True
+
+    async def close(self, code=None, reason=None):
+        if self.accepted:
+            # إغلاق من داخل القناة (مثل إلغاء العضوية)
+            await self.mux.close_stream(self.stream.name, 'closed')
+        self.accepted = False
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.mux.send_stream(self.stream, text_data)
+
+    def open_outbox(self):
+        # طابور الإرسال للاتصال الأب مشترك بين كل القنوات
+        pass
+
+    async def deliver(self, event, kind, key=None):
+        await self.mux.send_stream(self.stream, event['text'], kind, key, event.get('cursor'))
+
+    async def join_user_group(self):
+        # مجموعة المستخدم يديرها الاتصال الأب مرة واحدة لكل القنوات
+        pass
+
+    async def leave_user_group(self):
+        pass
+
+
+class MultiplexConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.streams = {}
+        # room_key -> RoomStream
+        self.rooms = {}
+        self.call = None
+
+        if self.user.is_anonymous or drain.is_draining():
+            await self.close()
+            return
+
+        # ?resume=<رمز> بعد إيقاف عملية سابقة: مؤشر كل قناة والعودة بدون user_joined
+        self.resume_cursors = {}
+        params = parse_qs(self.scope.get('query_string', b'').decode())
+        token = params.get('resume', [None])[0]
+        if token:
+            self.resume_cursors = drain.read_resume_token(token, self.user.id) or {}
+
+        await self.channel_layer.group_add(user_group_name(self.user.id), self.channel_name)
+        await self.accept()
+        self.outbox = Outbox(
+            self.send,
+            self.close_slow_connection,
+            on_error=self.close,
+            write_buffer=write_buffer_probe(self.scope)
+        )
+        drain.install_signal_handler()
+        drain.register(self)
+
+    async def disconnect(self, close_code):
+        drain.unregister(self)
+        if getattr(self, 'outbox', None) is not None:
+            self.outbox.close()
+        for name in list(self.streams):
+            await self.remove_stream(name)
+        if not self.user.is_anonymous:
+            await self.channel_layer.group_discard(user_group_name(self.user.id), self.channel_name)
+
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+            action = data.get('action')
+            name = data.get('stream')
+
+            if action == 'subscribe':
+                await self.subscribe(name, data.get('window'), data.get('cursor'))
+            elif action == 'unsubscribe':
+                await self.close_stream(name, 'unsubscribed')
+            elif action == 'credit':
+                await self.add_credit(name, data.get('frames', 0))
+            elif name in self.streams:
+                await self.receive_stream(name, data.get('payload') or {})
+        except Exception as e:
+            print(f"Error receiving multiplexed frame: {e}")
+
+    async def subscribe(self, name, window=None, cursor=None):
+        if not isinstance(name, str) or name in self.streams:
+            return
+        if len(self.streams) >= MAX_STREAMS:
+            await self.send_control(name, 'error', message='عدد القنوات تجاوز الحد المسموح')
+            return
+        if window is not None:
+            try:
+                window = max(1, int(window))
+            except (TypeError, ValueError):
+                window = None
+
+        stream = Stream(name, window)
+        if name == 'call':
+            self.streams[name] = stream
+            self.call = CallSignaling(lambda text_data=None: self.send_stream(stream, text_data))
+        elif name.startswith('room:'):
+            resumed = name in self.resume_cursors
+            if not isinstance(cursor, str):
+                cursor = self.resume_cursors.get(name)
+            room = RoomStream(self, stream, name[len('room:'):], cursor, resumed)
+            self.streams[name] = stream
+            await room.connect()
+            if not room.accepted:
+                # نفس رفض ChatConsumer: مستخدم بدون صلاحية أو غرفة غير موجودة
+                del self.streams[name]
+                await self.send_control(name, 'error', message='لا يمكن الاشتراك في هذه الغرفة')
+                return
+            stream.room = room
+            self.rooms[room.room_id] = room
+        else:
+            await self.send_control(name, 'error', message='قناة غير معروفة')
+            return
+
+        await self.send_control(name, 'subscribed')
+
+    async def remove_stream(self, name):
+        stream = self.streams.pop(name, None)
+        if stream is None:
+            return None
+        room = stream.room
+        if room is not None:
+            self.rooms.pop(room.room_id, None)
+            room.accepted = False
+            await room.disconnect(1000)
+        elif name == 'call':
+            self.call = None
+        return stream
+
+    async def close_stream(self, name, reason):
+        if await self.remove_stream(name) is not None:
+            await self.send_control(name, reason)
+
+    async def receive_stream(self, name, payload):
+        stream = self.streams[name]
+        room = stream.room
+        if room is not None:
+            await room.receive(json.dumps(payload))
+        elif name == 'call' and self.call is not None:
+            await self.call.receive(json.dumps(payload))
+
+    async def send_stream(self, stream, text_data, kind=MESSAGE, key=None, cursor=None):
+        """إرسال إطار قناة مع احترام رصيدها"""
+        if stream.name not in self.streams:
+            return
+        frame = (text_data, kind, key, cursor)
+        if stream.can_send() and not stream.pending:
+            await self.send_frame(stream, frame)
+            return
+        stream.pending.append(frame)
+        if len(stream.pending) > MAX_PENDING:
+            # العميل لا يستهلك هذه القناة - يستكمل لاحقاً من آخر مؤشر
+            stream.pending.clear()
+            stream.lagged = True
+
+    async def send_frame(self, stream, frame):
+        text_data, kind, key, cursor = frame
+        if stream.credits is not None:
+            stream.credits -= 1
+        # الإطار مرمّز مسبقاً - يُغلف بدون إعادة ترميز
+        self.outbox.put(
+            f'{{"stream": {json.dumps(stream.name)}, "payload": {text_data}}}',
+            kind, key, cursor, stream.name
+        )
+
+    async def close_slow_connection(self, cursors):
+        """العميل لا يقرأ - إغلاق الاتصال مع آخر مؤشر وصل لكل قناة"""
+        await self.send(text_data=json.dumps({
+            'type': 'resume',
+            'reason': 'slow_consumer',
+            'cursors': cursors
+        }))
+        await self.close(code=OVERFLOW_CLOSE_CODE)
+
+    async def drain(self, retry_after):
+        """إيقاف العملية - رمز استئناف واحد بآخر مؤشر لكل قناة غرفة"""
+        cursors = {
+            name: self.outbox.cursors.get(name) or stream.room.resume_from
+            for name, stream in self.streams.items()
+            if stream.room is not None
+        }
+        self.outbox.close()
+        await self.send(text_data=json.dumps({
+            'type': 'reconnect',
+            'retry_after': retry_after,
+            'streams': list(self.streams),
+            'resume': drain.make_resume_token(self.user.id, cursors)
+        }))
+        await self.close(code=drain.DRAIN_CLOSE_CODE)
+
+    async def add_credit(self, name, frames):
+        stream = self.streams.get(name)
+        if stream is None or stream.credits is None:
+            return
+        try:
+            stream.credits += max(0, int(frames))
+        except (TypeError, ValueError):
+            return
+        await self.flush_stream(stream)
+
+    async def flush_stream(self, stream):
+        if stream.lagged and stream.can_send():
+            stream.lagged = False
+            await self.send_control(stream.name, 'stream_lagged')
+        while stream.pending and stream.can_send():
+            await self.send_frame(stream, stream.pending.popleft())
+
+    async def send_control(self, name, kind, **extra):
+        # عبر نفس الطابور حتى يبقى الترتيب مع إطارات القناة
+        self.outbox.put(json.dumps({
+            'stream': name,
+            'payload': {'type': kind, **extra}
+        }, ensure_ascii=False))
+
+    # أحداث الغرف - توجَّه إلى القناة حسب room
+    async def room_event(self, event):
+        room = self.rooms.get(room_key(event.get('room', '')))
+        if room is not None:
+            handler = getattr(room, event['type'])
+            await handler(event)
+
+    chat_message = room_event
+    message_changed = room_event
+    user_joined = room_event
+    user_left = room_event
+    user_typing = room_event
+    read_receipts = room_event
+
+    # أحداث مجموعة المستخدم
+    async def profile_changed(self, event):
+        for room in list(self.rooms.values()):
+            await room.profile_changed(event)
+
+    async def membership_revoked(self, event):
+        room = self.rooms.get(room_key(event.get('room_id', '')))
+        if room is not None:
+            await room.membership_revoked(event)
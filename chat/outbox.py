@@ -0,0 +1,257 @@
+# chat/outbox.py
+"""طابور إرسال محدود لكل اتصال WebSocket مع سياسة للقارئ البطيء
+
+معالجات أحداث المجموعة تضع الإطار في الطابور وتعود فوراً، ومهمة منفصلة ترسل
+الإطارات إلى الاتصال. عندما يتوقف العميل عن القراءة (شبكة جوال ضعيفة) ينتظر
+إرسال الاتصال (الخوادم مثل uvicorn و hypercorn تنتظر تفريغ المخزن)، فيكبر
+الطابور حتى MAX_DEPTH بدلاً من نمو الذاكرة بلا حد:
+
+1. الدمج: إطار له مفتاح (الكتابة، الانضمام والمغادرة، "قرأها N") يحل محل
+   الإطار السابق بنفس المفتاح الذي لم يُرسل بعد - اللقطة الأحدث تكفي
+2. عند الامتلاء تُحذف إطارات الكتابة والحضور أولاً ثم حالة القراءة
+3. إذا كان الطابور مليئاً برسائل فعلية تُطبق OVERFLOW:
+   'disconnect' يرسل تلميح استئناف (آخر مؤشر وصل للعميل) ويغلق الاتصال،
+   فيستكمل العميل من get_messages بعد إعادة الاتصال بدلاً من تأخير الغرفة كلها
+   'drop_oldest' يحذف أقدم رسالة (العميل يكتشف الفجوة من المؤشرات)
+
+تحت daphne لا ينتظر send شيئاً: الإطار يُكتب فوراً في مخزن Twisted للاتصال
+حيث لا يراه التطبيق، فالطابور وحده لا يمتلئ أبداً. لذلك الخادم في Procfile
+هو chat/server.py (daphne مع قياس المخزن): قبل كل إرسال يُقرأ حجم مخزن
+الكتابة من scope، وما دام أكبر من MAX_BUFFER تنتظر المهمة ولا ترسل، فتبقى
+الإطارات هنا حيث الحد والدمج وسياسة OVERFLOW. الذاكرة لكل عميل بطيء محدودة
+بـ MAX_BUFFER بايت في Twisted و MAX_DEPTH إطار في الطابور. مع daphne العادي
+(بدون القياس) لا حد للمخزن، ومع خوادم تنتظر الإرسال (uvicorn، hypercorn)
+يكفي انتظار send.
+
+إذا فشل send (الاتصال انقطع أثناء الكتابة) يتوقف الطابور ويُغلق الاتصال
+عبر on_error بدلاً من أن تتوقف المهمة بصمت وتتراكم الإطارات بعدها.
+
+الإعدادات (اختيارية) في settings.CHAT_SEND_QUEUE:
+    MAX_DEPTH: أقصى عدد إطارات تنتظر الإرسال لكل اتصال
+    OVERFLOW: 'disconnect' أو 'drop_oldest'
+    MAX_BUFFER: أقصى بايتات في مخزن كتابة الخادم قبل التوقف عن الإرسال
+"""
+import asyncio
+import threading
+import weakref
+from collections import Counter, deque
+
+from django.conf import settings
+
+DEFAULTS = {
+    'MAX_DEPTH': 256,
+    'OVERFLOW': 'disconnect',
+    'MAX_BUFFER': 256 * 1024,
+}
+
+# فترة إعادة قراءة مخزن الكتابة أثناء انتظار تفريغه
+BUFFER_POLL = 0.05
+
+# أنواع الإطارات بترتيب الحذف عند الامتلاء
+EPHEMERAL = 'ephemeral'   # الكتابة والحضور
+STATE = 'state'           # "قرأها N" - اللقطة التالية تصححها
+MESSAGE = 'message'       # الرسائل - لا تُحذف إلا حسب OVERFLOW
+
+DROP_ORDER = (EPHEMERAL, STATE)
+
+# رمز الإغلاق عند تجاوز الطابور (نطاق التطبيقات 4000-4999)
+OVERFLOW_CLOSE_CODE = 4008
+
+
+def outbox_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_SEND_QUEUE', {})}
+
+
+# المقاييس على مستوى العملية
+_counters = Counter()
+_counters_lock = threading.Lock()
+_outboxes = weakref.WeakSet()
+
+
+def _count(name, value=1):
+    with _counters_lock:
+        _counters[name] += value
+
+
+def metrics():
+    """عمق الطوابير الحالية والعدادات منذ بدء العملية"""
+    outboxes = [outbox for outbox in list(_outboxes) if not outbox.closed]
+    depths = [len(outbox) for outbox in outboxes]
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        'connections': len(depths),
+        'queued_frames': sum(depths),
+        'max_depth': max(depths, default=0),
+        # الاتصالات التي امتلأ نصف طابورها
+        'slow_connections': sum(1 for outbox in outboxes if len(outbox) * 2 >= outbox.max_depth),
+        # الاتصالات التي تنتظر تفريغ مخزن الخادم الآن
+        'blocked_connections': sum(1 for outbox in outboxes if outbox.blocked),
+        'sent': counters.get('sent', 0),
+        'coalesced': counters.get('coalesced', 0),
+        'dropped': {
+            kind: counters.get(f'dropped_{kind}', 0)
+            for kind in (EPHEMERAL, STATE, MESSAGE)
+        },
+        'overflow_disconnects': counters.get('overflow_disconnects', 0),
+        'send_errors': counters.get('send_errors', 0),
+    }
+
+
+def write_buffer_probe(scope):
+    """قياس مخزن الكتابة من الخادم (chat/server.py)، أو None إذا لم يوفره"""
+    return scope.get('extensions', {}).get('chat.write_buffer')
+
+
+class Frame:
+    __slots__ = ('text', 'kind', 'key', 'cursor', 'stream')
+
+    def __init__(self, text, kind, key, cursor, stream):
+        self.text = text
+        self.kind = kind
+        self.key = key
+        self.cursor = cursor
+        self.stream = stream
+
+
+class Outbox:
+    """طابور الإرسال لاتصال واحد
+
+    send: دالة async ترسل text_data إلى الاتصال
+    on_overflow: دالة async تُستدعى بمؤشرات الاستئناف {stream: cursor} عند سياسة disconnect
+    on_error: دالة async تغلق الاتصال إذا فشل send
+    write_buffer: دالة تُرجع البايتات المنتظرة في مخزن الخادم (write_buffer_probe)
+    """
+
+    def __init__(self, send, on_overflow, max_depth=None, overflow=None, on_error=None, write_buffer=None):
+        config = outbox_settings()
+        self.send = send
+        self.on_overflow = on_overflow
+        self.on_error = on_error
+        self.write_buffer = write_buffer
+        self.max_depth = max_depth or config['MAX_DEPTH']
+        self.overflow = overflow or config['OVERFLOW']
+        self.max_buffer = config['MAX_BUFFER']
+        self.frames = deque()
+        self.keys = {}
+        # آخر مؤشر رسالة أُرسل فعلاً لكل قناة
+        self.cursors = {}
+        self.closed = False
+        self.blocked = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        _outboxes.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, text, kind=MESSAGE, key=None, cursor=None, stream=None):
+        """إضافة إطار بدون انتظار - يطبق الدمج وسياسة الامتلاء"""
+        if self.closed:
+            return
+        if key is not None:
+            key = (stream, key)
+            frame = self.keys.get(key)
+            if frame is not None:
+                frame.text = text
+                _count('coalesced')
+                return
+
+        if len(self.frames) >= self.max_depth and not self._make_room(kind):
+            return
+
+        frame = Frame(text, kind, key, cursor, stream)
+        self.frames.append(frame)
+        if key is not None:
+            self.keys[key] = frame
+        self._wakeup.set()
+
+    def _make_room(self, kind):
+        """حذف إطار واحد حسب الأولوية - False إذا يجب إهمال الإطار الجديد"""
+        for drop_kind in DROP_ORDER:
+            for frame in self.frames:
+                if frame.kind == drop_kind:
+                    self._remove(frame)
+                    _count(f'dropped_{drop_kind}')
+                    return True
+            if kind == drop_kind:
+                # لا يوجد ما هو أقل أهمية من الإطار الجديد نفسه
+                _count(f'dropped_{kind}')
+                return False
+
+        if self.overflow == 'drop_oldest':
+            self._remove(self.frames[0])
+            _count(f'dropped_{MESSAGE}')
+            return True
+
+        self.closed = True
+        _count('overflow_disconnects')
+        asyncio.get_running_loop().create_task(self._disconnect())
+        return False
+
+    def _remove(self, frame):
+        self.frames.remove(frame)
+        if frame.key is not None:
+            self.keys.pop(frame.key, None)
+
+    async def _disconnect(self):
+        self._task.cancel()
+        self.frames.clear()
+        self.keys.clear()
+        try:
+            await self.on_overflow(dict(self.cursors))
+        except Exception as e:
+            print(f"Error closing slow connection: {e}")
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.frames:
+                await self._wait_for_buffer()
+                if not self.frames:
+                    break
+                frame = self.frames.popleft()
+                if frame.key is not None:
+                    self.keys.pop(frame.key, None)
+                try:
+                    await self.send(text_data=frame.text)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    await self._fail(e)
+                    return
+                _count('sent')
+                if frame.cursor:
+                    self.cursors[frame.stream] = frame.cursor
+
+    async def _wait_for_buffer(self):
+        """العميل لا يقرأ ومخزن الخادم ممتلئ - الإطارات الجديدة تنتظر هنا"""
+        if self.write_buffer is None:
+            return
+        while self.write_buffer() > self.max_buffer:
+            self.blocked = True
+            await asyncio.sleep(BUFFER_POLL)
+        self.blocked = False
+
+    async def _fail(self, error):
+        """فشل الإرسال - لا إطارات بعده، وإغلاق الاتصال"""
+        print(f"Error sending frame, closing connection: {error}")
+        _count('send_errors')
+        self.closed = True
+        self.frames.clear()
+        self.keys.clear()
+        _outboxes.discard(self)
+        if self.on_error is not None:
+            try:
+                await self.on_error()
+            except Exception as e:
+                print(f"Error closing connection after send failure: {e}")
+
+    def close(self):
+        """إيقاف مهمة الإرسال (عند قطع الاتصال)"""
+        self.closed = True
+        self._task.cancel()
+        self.frames.clear()
+        self.keys.clear()
+        _outboxes.discard(self)
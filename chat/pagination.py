@@ -0,0 +1,74 @@
+# chat/pagination.py
+import base64
+import uuid
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(message):
+    """مؤشر مبهم يمثل موقع الرسالة في الترتيب (timestamp, id)"""
+    raw = f"{message.timestamp.isoformat()}|{message.id.hex}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """فك المؤشر إلى (timestamp, id) - يرفع ValueError إذا كان غير صالح"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, message_id = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), uuid.UUID(hex=message_id)
+    except Exception:
+        raise ValueError('مؤشر غير صالح')
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE):
+    """قراءة حجم الصفحة مع حد أقصى"""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def messages_after(queryset, timestamp, message_id):
+    """الرسائل التي تأتي بعد الموقع (timestamp, id) - يشمل الرسائل بنفس الوقت"""
+    return queryset.filter(
+        Q(timestamp__gt=timestamp) |
+        Q(timestamp=timestamp, id__gt=message_id)
+    )
+
+
+def messages_before(queryset, timestamp, message_id):
+    """الرسائل التي تأتي قبل الموقع (timestamp, id)"""
+    return queryset.filter(
+        Q(timestamp__lt=timestamp) |
+        Q(timestamp=timestamp, id__lt=message_id)
+    )
+
+
+def paginate_messages(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """صفحة من الرسائل بالترتيب الزمني باستخدام keyset بدلاً من OFFSET
+
+    يُرجع (الرسائل، هل توجد رسائل أخرى في نفس الاتجاه). بدون مؤشر تُرجع
+    أحدث صفحة. كل صفحة تُقرأ من فهرس (room, timestamp) مباشرة لذلك التكلفة
+    واحدة مهما كان عمق التمرير.
+    """
+    if after:
+        timestamp, message_id = decode_cursor(after)
+        page = list(
+            messages_after(queryset, timestamp, message_id).order_by('timestamp', 'id')[:limit + 1]
+        )
+        return page[:limit], len(page) > limit
+
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        queryset = messages_before(queryset, timestamp, message_id)
+
+    page = list(queryset.order_by('-timestamp', '-id')[:limit + 1])
+    has_more = len(page) > limit
+    return list(reversed(page[:limit])), has_more
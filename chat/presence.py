@@ -0,0 +1,471 @@
+# chat/presence.py
+"""تتبع المتصلين في الذاكرة بدلاً من كتابة صفوف OnlineUser عند كل اتصال
+
+- عدّاد اتصالات لكل (مستخدم، غرفة) حتى تعمل عدة تبويبات بشكل صحيح
+- انتهاء صلاحية الإدخالات بعد TTL بدون نبضات (للعملاء الذين انقطعوا فجأة)
+- عدد المتصلين وقائمتهم من الذاكرة مباشرة
+- حفظ last_seen في OnlineUser بشكل دوري فقط
+
+الإعدادات (اختيارية) في settings.CHAT_PRESENCE:
+    BACKEND: 'chat.presence.LocalPresenceBackend' (داخل العملية) أو
+             'chat.presence.CachePresenceBackend' (مشترك عبر Django cache مثل Redis)
+    TTL: مدة الصلاحية بالثواني بدون نبضة
+    CHECKPOINT_INTERVAL: الفترة بين عمليات الحفظ في قاعدة البيانات
+"""
+import asyncio
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    'BACKEND': 'chat.presence.LocalPresenceBackend',
+    'TTL': 90,
+    'CHECKPOINT_INTERVAL': 30,
+    'CACHE_ALIAS': 'default',
+}
+
+
+def presence_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+def room_key(room_id):
+    """توحيد معرف الغرفة (UUID أو نص) إلى نص UUID قياسي"""
+    try:
+        return str(uuid.UUID(str(room_id)))
+    except ValueError:
+        return str(room_id)
+
+
+class BasePresenceBackend:
+    """الواجهة المشتركة لكل backends التتبع"""
+    # True إذا كانت العمليات في الذاكرة فقط (يمكن استدعاؤها مباشرة من async)
+    is_local = True
+
+    def __init__(self, ttl, **options):
+        self.ttl = ttl
+        self._dirty = {}
+        self._dirty_lock = threading.Lock()
+
+    def _mark_dirty(self, user_id, room, is_online):
+        with self._dirty_lock:
+            self._dirty[(user_id, room)] = (is_online, timezone.now())
+
+    def pop_dirty(self):
+        """التغييرات التي لم تُحفظ بعد في قاعدة البيانات"""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def connect(self, user_id, room_id, label=''):
+        """تسجيل اتصال - يُرجع True إذا كان أول اتصال للمستخدم في الغرفة"""
+        raise NotImplementedError
+
+    def disconnect(self, user_id, room_id):
+        """إلغاء اتصال - يُرجع True إذا كان آخر اتصال للمستخدم في الغرفة"""
+        raise NotImplementedError
+
+    def heartbeat(self, user_id, room_id):
+        raise NotImplementedError
+
+    def sweep(self):
+        """حذف الإدخالات المنتهية - يُرجع [(user_id, room, label)]"""
+        raise NotImplementedError
+
+    def online_user_ids(self, room_id):
+        raise NotImplementedError
+
+    def online_counts(self, room_ids):
+        """{room: عدد المتصلين} لعدة غرف دفعة واحدة"""
+        raise NotImplementedError
+
+    def forget_user(self, user_id):
+        """إزالة المستخدم من كل الغرف (عند تسجيل الخروج)"""
+        raise NotImplementedError
+
+    def online_count(self, room_id):
+        return self.online_counts([room_id]).get(room_key(room_id), 0)
+
+
+class LocalPresenceBackend(BasePresenceBackend):
+    """التتبع داخل العملية - مناسب لعامل daphne واحد"""
+
+    def __init__(self, ttl, **options):
+        super().__init__(ttl, **options)
+        self._lock = threading.Lock()
+        # room -> {user_id: [عدد الاتصالات, وقت الانتهاء, الاسم]}
+        self._rooms = {}
+
+    def connect(self, user_id, room_id, label=''):
+        room = room_key(room_id)
+        with self._lock:
+            users = self._rooms.setdefault(room, {})
+            entry = users.get(user_id)
+            first = entry is None
+            if first:
+                entry = users[user_id] = [0, 0, label]
+            entry[0] += 1
+            entry[1] = time.monotonic() + self.ttl
+        if first:
+            self._mark_dirty(user_id, room, True)
+        return first
+
+    def disconnect(self, user_id, room_id):
+        room = room_key(room_id)
+        with self._lock:
+            users = self._rooms.get(room, {})
+            entry = users.get(user_id)
+            if entry is None:
+                return False
+            entry[0] -= 1
+            last = entry[0] <= 0
+            if last:
+                del users[user_id]
+                if not users:
+                    self._rooms.pop(room, None)
+        if last:
+            self._mark_dirty(user_id, room, False)
+        return last
+
+    def heartbeat(self, user_id, room_id):
+        room = room_key(room_id)
+        with self._lock:
+            entry = self._rooms.get(room, {}).get(user_id)
+            if entry is None:
+                return False
+            entry[1] = time.monotonic() + self.ttl
+        self._mark_dirty(user_id, room, True)
+        return True
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for room, users in list(self._rooms.items()):
+                for user_id, entry in list(users.items()):
+                    if entry[1] < now:
+                        del users[user_id]
+                        expired.append((user_id, room, entry[2]))
+                if not users:
+                    del self._rooms[room]
+        for user_id, room, _ in expired:
+            self._mark_dirty(user_id, room, False)
+        return expired
+
+    def online_user_ids(self, room_id):
+        now = time.monotonic()
+        with self._lock:
+            users = self._rooms.get(room_key(room_id), {})
+            return {user_id for user_id, entry in users.items() if entry[1] >= now}
+
+    def online_counts(self, room_ids):
+        now = time.monotonic()
+        counts = {}
+        with self._lock:
+            for room_id in room_ids:
+                room = room_key(room_id)
+                users = self._rooms.get(room, {})
+                counts[room] = sum(1 for entry in users.values() if entry[1] >= now)
+        return counts
+
+    def forget_user(self, user_id):
+        with self._lock:
+            rooms = [room for room, users in self._rooms.items() if users.pop(user_id, None)]
+        for room in rooms:
+            self._mark_dirty(user_id, room, False)
+        return rooms
+
+
+class PresenceLockTimeout(Exception):
+    """لم يُحصل على قفل المفتاح خلال LOCK_WAIT - العملية لم تُنفذ"""
+
+
+class CachePresenceBackend(BasePresenceBackend):
+    """التتبع في مخزن مشترك (Django cache مثل Redis) لعدة عمال
+
+    كل غرفة مفتاح واحد يحوي {user_id: [عدد الاتصالات, وقت الانتهاء, الاسم]}،
+    ومجموعة الغرف مفتاح آخر. كل تعديل (قراءة ثم كتابة) يتم تحت قفل عبر cache.add
+    حتى لا تضيع تحديثات العمال المتزامنة. إذا لم يُحصل على القفل خلال LOCK_WAIT
+    تفشل العملية بـ PresenceLockTimeout بدلاً من التعديل بدون قفل.
+    """
+    is_local = False
+    # أقصى انتظار للقفل، وعمر القفل إذا توقفت العملية التي تحمله
+    LOCK_WAIT = 2
+    LOCK_TIMEOUT = 5
+
+    def __init__(self, ttl, cache_alias='default', **options):
+        super().__init__(ttl, **options)
+        self.cache = caches[cache_alias]
+        self.rooms_key = 'chat:presence:rooms'
+
+    def _key(self, room):
+        return f'chat:presence:{room}'
+
+    @contextmanager
+    def _locked(self, key):
+        lock_key = f'{key}:lock'
+        # رمز خاص بهذا القفل - لا يُحذف قفل أخذه عامل آخر بعد انتهاء عمر قفلنا
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.LOCK_WAIT
+        while not self.cache.add(lock_key, token, self.LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise PresenceLockTimeout(key)
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def _update(self, room, func):
+        """تعديل إدخالات الغرفة تحت قفل"""
+        key = self._key(room)
+        with self._locked(key):
+            users = self.cache.get(key) or {}
+            result = func(users)
+            if users:
+                self.cache.set(key, users, None)
+            else:
+                self.cache.delete(key)
+            return result
+
+    def _track_room(self, room):
+        if room in (self.cache.get(self.rooms_key) or ()):
+            return
+        with self._locked(self.rooms_key):
+            rooms = self.cache.get(self.rooms_key) or set()
+            if room not in rooms:
+                rooms.add(room)
+                self.cache.set(self.rooms_key, rooms, None)
+
+    def connect(self, user_id, room_id, label=''):
+        room = room_key(room_id)
+
+        def apply(users):
+            entry = users.get(user_id)
+            first = entry is None
+            if first:
+                entry = users[user_id] = [0, 0, label]
+            entry[0] += 1
+            entry[1] = time.time() + self.ttl
+            return first
+
+        # الغرفة في المجموعة قبل الإدخال حتى يصلها sweep دائماً
+        self._track_room(room)
+        first = self._update(room, apply)
+        if first:
+            self._mark_dirty(user_id, room, True)
+        return first
+
+    def disconnect(self, user_id, room_id):
+        room = room_key(room_id)
+
+        def apply(users):
+            entry = users.get(user_id)
+            if entry is None:
+                return False
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del users[user_id]
+                return True
+            return False
+
+        last = self._update(room, apply)
+        if last:
+            self._mark_dirty(user_id, room, False)
+        return last
+
+    def heartbeat(self, user_id, room_id):
+        room = room_key(room_id)
+
+        def apply(users):
+            entry = users.get(user_id)
+            if entry is None:
+                return False
+            entry[1] = time.time() + self.ttl
+            return True
+
+        alive = self._update(room, apply)
+        if alive:
+            self._mark_dirty(user_id, room, True)
+        return alive
+
+    def sweep(self):
+        now = time.time()
+        expired = []
+        for room in list(self.cache.get(self.rooms_key) or ()):
+            def apply(users, room=room):
+                for user_id, entry in list(users.items()):
+                    if entry[1] < now:
+                        del users[user_id]
+                        expired.append((user_id, room, entry[2]))
+            try:
+                self._update(room, apply)
+            except PresenceLockTimeout as e:
+                # الغرفة مشغولة - التنظيف التالي يكملها
+                print(f"Presence sweep skipped room {room}: {e}")
+        for user_id, room, _ in expired:
+            self._mark_dirty(user_id, room, False)
+        return expired
+
+    def online_user_ids(self, room_id):
+        now = time.time()
+        users = self.cache.get(self._key(room_key(room_id))) or {}
+        return {user_id for user_id, entry in users.items() if entry[1] >= now}
+
+    def online_counts(self, room_ids):
+        now = time.time()
+        rooms = [room_key(room_id) for room_id in room_ids]
+        stored = self.cache.get_many([self._key(room) for room in rooms])
+        return {
+            room: sum(1 for entry in stored.get(self._key(room), {}).values() if entry[1] >= now)
+            for room in rooms
+        }
+
+    def forget_user(self, user_id):
+        rooms = []
+        for room in list(self.cache.get(self.rooms_key) or ()):
+            def apply(users):
+                return users.pop(user_id, None) is not None
+            try:
+                if self._update(room, apply):
+                    rooms.append(room)
+            except PresenceLockTimeout as e:
+                # الإدخال ينتهي بعد TTL بدون نبضات
+                print(f"Error forgetting presence in room {room}: {e}")
+        for room in rooms:
+            self._mark_dirty(user_id, room, False)
+        return rooms
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_presence():
+    """الـ backend المحدد في الإعدادات (نسخة واحدة لكل عملية)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = presence_settings()
+                backend_class = import_string(config['BACKEND'])
+                _backend = backend_class(config['TTL'], cache_alias=config['CACHE_ALIAS'])
+    return _backend
+
+
+async def run(method, *args):
+    """استدعاء عملية تتبع من async - مباشرة للذاكرة المحلية، وعبر thread للمخزن المشترك"""
+    if get_presence().is_local:
+        return method(*args)
+    return await sync_to_async(method)(*args)
+
+
+# ---- الحفظ الدوري في قاعدة البيانات ----
+
+_last_checkpoint = time.monotonic()
+_local_connections = Counter()
+_maintenance_tasks = {}
+
+
+def checkpoint():
+    """حفظ last_seen و is_online للتغييرات المتراكمة في OnlineUser دفعة واحدة"""
+    global _last_checkpoint
+    from .models import ChatRoom, OnlineUser
+
+    _last_checkpoint = time.monotonic()
+    dirty = get_presence().pop_dirty()
+    if not dirty:
+        return 0
+
+    existing_rooms = {
+        str(pk) for pk in ChatRoom.objects.filter(
+            id__in={room for _, room in dirty}
+        ).values_list('id', flat=True)
+    }
+    rows = [
+        OnlineUser(user_id=user_id, room_id=room, is_online=is_online, last_seen=last_seen)
+        for (user_id, room), (is_online, last_seen) in dirty.items()
+        if room in existing_rooms
+    ]
+    try:
+        OnlineUser.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=['user', 'room'],
+            update_fields=['is_online', 'last_seen']
+        )
+    except Exception as e:
+        print(f"Error in presence checkpoint: {e}")
+    return len(rows)
+
+
+def maybe_checkpoint():
+    """الحفظ من مسارات HTTP فقط إذا مرت فترة الحفظ"""
+    if time.monotonic() - _last_checkpoint >= presence_settings()['CHECKPOINT_INTERVAL']:
+        checkpoint()
+
+
+def register_connection(user_id, room_id):
+    """اتصال WebSocket حي في هذه العملية - يحصل على نبضات تلقائية"""
+    _local_connections[(user_id, room_key(room_id))] += 1
+
+
+def unregister_connection(user_id, room_id):
+    key = (user_id, room_key(room_id))
+    _local_connections[key] -= 1
+    if _local_connections[key] <= 0:
+        del _local_connections[key]
+
+
+def run_maintenance():
+    """نبضات للاتصالات الحية، حذف المنتهية، ثم الحفظ - يُرجع الإدخالات المنتهية"""
+    presence = get_presence()
+    for user_id, room in list(_local_connections):
+        try:
+            presence.heartbeat(user_id, room)
+        except PresenceLockTimeout as e:
+            # ما زال أمام الإدخال TTL كامل - النبضة التالية تجدده
+            print(f"Presence heartbeat skipped: {e}")
+    expired = presence.sweep()
+    checkpoint()
+    return expired
+
+
+async def _maintenance_loop():
+    from channels.layers import get_channel_layer
+    from .broadcast import group_event, room_group_name
+
+    interval = presence_settings()['CHECKPOINT_INTERVAL']
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            expired = await sync_to_async(run_maintenance)()
+            channel_layer = get_channel_layer()
+            for user_id, room, label in expired:
+                await channel_layer.group_send(
+                    room_group_name(room),
+                    group_event('user_left', {
+                        'type': 'user_left',
+                        'user': label,
+                        'online_count': await run(get_presence().online_count, room)
+                    }, room=room)
+                )
+        except Exception as e:
+            print(f"Error in presence maintenance: {e}")
+
+
+def ensure_maintenance():
+    """تشغيل مهمة الصيانة الدورية مرة واحدة لكل event loop"""
+    loop = asyncio.get_running_loop()
+    task = _maintenance_tasks.get(loop)
+    if task is None or task.done():
+        _maintenance_tasks[loop] = loop.create_task(_maintenance_loop())
@@ -0,0 +1,167 @@
+# chat/queries.py
+from django.db.models import Exists, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import ChatRoom, HiddenMessages, Message, ReadReceipt
+from .presence import get_presence, room_key
+
+
+def annotate_room_summary(queryset, user):
+    """إضافة الإحصائيات وصلاحية الدخول إلى استعلام الغرف دفعة واحدة"""
+    return queryset.select_related('created_by', 'activity').annotate(
+        # العدد من ملخص النشاط بدلاً من COUNT على جدول الرسائل
+        message_count=Coalesce(F('activity__message_count'), Value(0)),
+        is_participant=Exists(
+            ChatRoom.participants.through.objects.filter(
+                chatroom_id=OuterRef('pk'),
+                customuser_id=user.id
+            )
+        ),
+    )
+
+
+# أقصى عدد رسائل غير مقروءة يُحسب لكل غرفة - ما بعده يُعرض "99+"
+UNREAD_CAP = 99
+
+
+class CappedCount(Subquery):
+    """COUNT لاستعلام فرعي محدود بـ LIMIT - المسح يتوقف عند الحد بدلاً من عد كل الصفوف"""
+    template = '(SELECT COUNT(*) FROM (%(subquery)s) AS capped_count)'
+    output_field = IntegerField()
+
+
+def unread_messages(user, room_ref):
+    """رسائل الغرفة بعد مؤشر القراءة للمستخدم (بدون رسائله وما قبل مسح المحادثة عنده)
+
+    الغرفة التي لم يفتحها المستخدم بعد ليس لها مؤشر، ولا تُعتبر فيها رسائل غير مقروءة.
+    """
+    receipt = ReadReceipt.objects.filter(user_id=user.id, room_id=OuterRef('room_id'))
+    last_read_at = Subquery(receipt.values('last_read_at')[:1])
+    last_read_id = Subquery(receipt.values('last_read_message_id')[:1])
+    # "مسح المحادثة" - الإخفاء الفردي لا يُحسب هنا (الرسائل المخفية عادة مقروءة)
+    cleared_seq = HiddenMessages.objects.filter(
+        user_id=user.id,
+        room_id=OuterRef('room_id')
+    ).values('cleared_seq')[:1]
+    # نفس ترتيب (timestamp, id) في pagination.messages_after - الرسائل بنفس
+    # وقت آخر رسالة مقروءة وبعدها في الترتيب غير مقروءة
+    return Message.objects.filter(
+        Q(timestamp__gt=last_read_at) | Q(timestamp=last_read_at, id__gt=last_read_id),
+        room_id=room_ref,
+        seq__gt=Coalesce(Subquery(cleared_seq), Value(0))
+    ).exclude(
+        sender_id=user.id
+    )
+
+
+def annotate_unread_counts(queryset, user):
+    """عدد الرسائل غير المقروءة لكل غرفة في نفس استعلام الغرف
+
+    كل عد فرعي يستخدم فهرس (room, timestamp) ويتوقف بعد UNREAD_CAP + 1 صف.
+    """
+    return queryset.annotate(
+        unread_count=Coalesce(
+            CappedCount(unread_messages(user, OuterRef('pk')).order_by().values('id')[:UNREAD_CAP + 1]),
+            Value(0)
+        )
+    )
+
+
+def format_unread(count):
+    """النص المعروض في الشارة"""
+    if not count:
+        return ''
+    return f'{UNREAD_CAP}+' if count > UNREAD_CAP else str(count)
+
+
+def available_rooms_queryset(user):
+    """الغرف التي يستطيع المستخدم رؤيتها"""
+    return ChatRoom.objects.filter(
+        Q(room_type='public') |
+        Q(participants=user) |
+        Q(created_by=user)
+    ).distinct().filter(is_active=True)
+
+
+def member_rooms_queryset(user):
+    """غرف المستخدم: التي يشارك فيها أو أنشأها أو فتحها من الغرف العامة
+
+    بدلاً من كل الغرف العامة - الغرف العامة الأخرى تُعرض من دليل الغرف
+    (chat/directory.py) صفحة بصفحة.
+    """
+    return ChatRoom.objects.filter(
+        Q(Exists(ChatRoom.participants.through.objects.filter(
+            chatroom_id=OuterRef('pk'),
+            customuser_id=user.id
+        ))) |
+        Q(created_by=user) |
+        Q(Exists(ReadReceipt.objects.filter(room_id=OuterRef('pk'), user_id=user.id)), room_type='public'),
+        is_active=True
+    )
+
+
+def joinable_rooms_queryset(user):
+    """الغرف التي يسمح ChatRoom.can_join بدخولها"""
+    return ChatRoom.objects.filter(
+        Q(room_type='public') |
+        Q(room_type='private', participants=user),
+        is_active=True
+    )
+
+
+def get_unread_counts(user, room_ids=None):
+    """{room_id: unread_count} لكل غرف المستخدم في استعلام واحد"""
+    rooms = member_rooms_queryset(user)
+    if room_ids is not None:
+        rooms = rooms.filter(id__in=room_ids)
+    return {
+        str(room_id): count
+        for room_id, count in annotate_unread_counts(rooms, user).values_list('id', 'unread_count')
+    }
+
+
+def attach_online_counts(rooms):
+    """إضافة عدد المتصلين لكل غرفة من التتبع في الذاكرة دفعة واحدة"""
+    rooms = list(rooms)
+    counts = get_presence().online_counts([room.id for room in rooms])
+    for room in rooms:
+        room.online_count = counts.get(room_key(room.id), 0)
+    return rooms
+
+
+def room_can_join(room):
+    """نفس منطق ChatRoom.can_join لكن من القيم المحسوبة مسبقاً"""
+    if room.room_type == 'public':
+        return True
+    elif room.room_type == 'private':
+        return room.is_participant
+    return False
+
+
+def serialize_room_summary(room, user, is_owner=None, can_join=None):
+    """تحويل غرفة محسوبة الإحصائيات إلى القاموس المستخدم في الواجهة"""
+    return {
+        'id': str(room.id),
+        'name': room.name,
+        'description': room.description or 'لا يوجد وصف',
+        'type': room.room_type,
+        'created_by': room.created_by.email,
+        'is_owner': room.created_by_id == user.id if is_owner is None else is_owner,
+        'online_count': room.online_count,
+        'message_count': room.message_count,
+        'can_join': room_can_join(room) if can_join is None else can_join,
+        'unread_count': getattr(room, 'unread_count', 0),
+        'unread_display': format_unread(getattr(room, 'unread_count', 0)),
+    }
+
+
+def get_available_rooms(user):
+    """غرف المستخدم مع الإحصائيات وعدد غير المقروء في استعلام واحد"""
+    rooms = annotate_room_summary(member_rooms_queryset(user), user)
+    return attach_online_counts(annotate_unread_counts(rooms, user))
+
+
+def get_user_rooms(user):
+    """الغرف التي أنشأها المستخدم مع الإحصائيات في استعلام واحد"""
+    rooms = annotate_room_summary(user.created_rooms.all(), user)
+    return attach_online_counts(annotate_unread_counts(rooms, user))
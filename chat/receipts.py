@@ -0,0 +1,226 @@
+# chat/receipts.py
+"""مؤشرات القراءة: موقع آخر رسالة مقروءة لكل (مستخدم، غرفة)
+
+- إطارات read_receipt تُجمع في الذاكرة ويبقى لكل (مستخدم، غرفة) أعلى موقع فقط
+- الحفظ على دفعات كل FLUSH_INTERVAL ثانية، والتحديث مشروط حتى لا يرجع
+  المؤشر إلى الخلف إذا وصلت الإطارات بترتيب مختلف أو من أكثر من عملية
+- بعد كل دفعة يُبث لكل غرفة تغيرت حدث واحد "قرأها N" بدلاً من حدث لكل قارئ
+
+الإعدادات (اختيارية) في settings.CHAT_READ_RECEIPTS:
+    FLUSH_INTERVAL: الفترة بين عمليات الحفظ بالثواني
+    BROADCAST_LIMIT: أقصى عدد مواقع مختلفة في حدث "قرأها N"
+"""
+import asyncio
+import atexit
+import threading
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .broadcast import group_event, room_group_name, unread_group_name
+from .presence import room_key
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 1.0,
+    'BROADCAST_LIMIT': 50,
+}
+
+
+def receipt_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_READ_RECEIPTS', {})}
+
+
+class ReceiptBuffer:
+    """أعلى موقع قراءة لم يُحفظ بعد لكل (مستخدم، غرفة)"""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def mark(self, user_id, room_id, timestamp, message_id):
+        """يُرجع True إذا تقدم المؤشر عن آخر موقع في الذاكرة"""
+        key = (user_id, room_key(room_id))
+        position = (timestamp, str(message_id))
+        with self._lock:
+            current = self._pending.get(key)
+            if current is not None and current >= position:
+                return False
+            self._pending[key] = position
+        return True
+
+    def pop(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def __len__(self):
+        return len(self._pending)
+
+
+_buffer = ReceiptBuffer()
+
+
+def save_pointers(pointers):
+    """حفظ دفعة مؤشرات - يُرجع الغرف التي تقدم فيها مؤشر واحد على الأقل"""
+    from .models import ReadReceipt
+
+    changed_rooms = set()
+    missing = []
+    with transaction.atomic():
+        for (user_id, room), (timestamp, message_id) in pointers.items():
+            updated = ReadReceipt.objects.filter(user_id=user_id, room_id=room).filter(
+                Q(last_read_at__lt=timestamp) |
+                Q(last_read_at=timestamp, last_read_message_id__lt=message_id)
+            ).update(
+                last_read_at=timestamp,
+                last_read_message_id=message_id,
+                updated_at=timezone.now()
+            )
+            if updated:
+                changed_rooms.add(room)
+            else:
+                missing.append(ReadReceipt(
+                    user_id=user_id,
+                    room_id=room,
+                    last_read_at=timestamp,
+                    last_read_message_id=message_id
+                ))
+        if missing:
+            # الصفوف الموجودة بموقع أحدث تبقى كما هي - الإضافة للجديدة فقط
+            existing = set(
+                (user_id, str(room))
+                for user_id, room in ReadReceipt.objects.filter(
+                    user_id__in={receipt.user_id for receipt in missing},
+                    room_id__in={receipt.room_id for receipt in missing}
+                ).values_list('user_id', 'room_id')
+            )
+            missing = [
+                receipt for receipt in missing
+                if (receipt.user_id, receipt.room_id) not in existing
+            ]
+            ReadReceipt.objects.bulk_create(missing, ignore_conflicts=True)
+            changed_rooms.update(receipt.room_id for receipt in missing)
+    return changed_rooms
+
+
+def read_by(room_id, limit=None):
+    """عدد القراء لكل موقع، من الأحدث للأقدم
+
+    القيمة count لكل موقع هي عدد المستخدمين الذين وصل مؤشرهم إليه أو بعده،
+    أي أن كل رسالة حتى هذا الموقع (وبعد الموقع التالي) قرأها count مستخدم.
+    مؤشر كاتب رسالة الموقع لا يُحسب - الكاتب ليس من قرائها.
+    """
+    from .models import Message, ReadReceipt
+
+    if limit is None:
+        limit = receipt_settings()['BROADCAST_LIMIT']
+    positions = list(
+        ReadReceipt.objects.filter(room_id=room_id)
+        .values('last_read_at', 'last_read_message_id')
+        .annotate(readers=Count('id'))
+        .order_by('-last_read_at', '-last_read_message_id')[:limit]
+    )
+    if not positions:
+        return []
+
+    # كاتب كل رسالة موقع ومؤشره (استعلامان للصفحة كلها)
+    senders = dict(
+        Message.objects.filter(
+            id__in=[position['last_read_message_id'] for position in positions]
+        ).values_list('id', 'sender_id')
+    )
+    sender_positions = {
+        user_id: (last_read_at, str(message_id))
+        for user_id, last_read_at, message_id in ReadReceipt.objects.filter(
+            room_id=room_id, user_id__in=set(senders.values())
+        ).values_list('user_id', 'last_read_at', 'last_read_message_id')
+    }
+
+    result = []
+    total = 0
+    for position in positions:
+        total += position['readers']
+        message_id = position['last_read_message_id']
+        sender_position = sender_positions.get(senders.get(message_id))
+        own = sender_position is not None and sender_position >= (position['last_read_at'], str(message_id))
+        result.append({
+            'message_id': str(message_id),
+            'count': total - 1 if own else total
+        })
+    return result
+
+
+def flush():
+    """حفظ المؤشرات المعلقة
+
+    يُرجع أحداث "قرأها N" لكل غرفة تغيرت، و(مستخدم، غرفة) لكل مؤشر حُفظ
+    لتحديث عدد غير المقروء عند المستخدم.
+    """
+    pointers = _buffer.pop()
+    if not pointers:
+        return {}, []
+    try:
+        changed_rooms = save_pointers(pointers)
+    except Exception as e:
+        print(f"Error saving read receipts: {e}")
+        return {}, []
+    events = {
+        room: group_event('read_receipts', {
+            'type': 'read_receipts',
+            'read_by': read_by(room)
+        }, room=room)
+        for room in changed_rooms
+    }
+    return events, list(pointers)
+
+
+async def _flush_loop():
+    interval = receipt_settings()['FLUSH_INTERVAL']
+    channel_layer = get_channel_layer()
+    # تتوقف المهمة عندما لا يبقى شيء للحفظ وتبدأ من جديد مع أول إطار
+    while len(_buffer):
+        await asyncio.sleep(interval)
+        events, readers = await database_sync_to_async(flush)()
+        try:
+            for room, event in events.items():
+                await channel_layer.group_send(room_group_name(room), event)
+            for user_id, room in readers:
+                await channel_layer.group_send(
+                    unread_group_name(user_id),
+                    {'type': 'room_read', 'room_id': room}
+                )
+        except Exception as e:
+            print(f"Error broadcasting read receipts: {e}")
+
+
+_flush_tasks = {}
+
+
+def ensure_flusher():
+    loop = asyncio.get_running_loop()
+    task = _flush_tasks.get(loop)
+    if task is None or task.done():
+        _flush_tasks[loop] = loop.create_task(_flush_loop())
+
+
+def mark_read(user_id, room_id, timestamp, message_id):
+    """تسجيل موقع قراءة من داخل event loop - الحفظ والبث يتمان لاحقاً على دفعات"""
+    # مؤشر بوقت في المستقبل كان سيجعل الرسائل القادمة مقروءة مسبقاً
+    timestamp = min(timestamp, timezone.now())
+    if _buffer.mark(user_id, room_id, timestamp, message_id):
+        ensure_flusher()
+
+
+@atexit.register
+def flush_pending_receipts():
+    """حفظ ما تبقى عند إيقاف العملية (بدون بث)"""
+    pointers = _buffer.pop()
+    if pointers:
+        try:
+            save_pointers(pointers)
+        except Exception as e:
+            print(f"Error in final read receipt flush: {e}")
@@ -0,0 +1,154 @@
+# chat/replay.py
+"""ذاكرة إعادة التشغيل: آخر N حدث بُث في كل غرفة داخل هذه العملية
+
+عند انقطاع الاتصال يعيد العميل الاتصال بمؤشر آخر رسالة وصلته
+(ws/chat/room/<id>/?cursor=...)، فيُرسل له ما فاته من الذاكرة مباشرة بدلاً
+من استعلام get_messages من كل العملاء في نفس اللحظة.
+
+الذاكرة تُملأ مرة واحدة لكل حدث في موقع البث (broadcast_message،
+broadcast_message_change، وحفظ الرسالة في المستهلك) وليس عند كل مستقبل،
+وتوجد فقط طالما بقي مشترك واحد على الأقل في الغرفة داخل العملية. عند خروج
+آخر مشترك تُحذف، وأي مؤشر غير موجود فيها (أقدم من الذاكرة، أو عملية جديدة
+بعد النشر) يُستكمل من قاعدة البيانات.
+
+لأن التسجيل عند المرسل، الحلقة كاملة فقط مع InMemoryChannelLayer (كل البث
+من نفس العملية). مع طبقة مشتركة بين عمليات (Redis) الأحداث المرسلة من عملية
+أخرى لا تصل إليها، لذلك الاستئناف يُقرأ من قاعدة البيانات دائماً.
+
+الإعدادات (اختيارية) في settings.CHAT_REPLAY:
+    SIZE: عدد الأحداث المحفوظة لكل غرفة
+    DB_LIMIT: أقصى عدد رسائل تُقرأ من قاعدة البيانات عند الفجوة الكبيرة
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from .pagination import decode_cursor, paginate_messages
+from .presence import room_key
+
+DEFAULTS = {
+    'SIZE': 200,
+    'DB_LIMIT': 200,
+}
+
+
+def replay_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_REPLAY', {})}
+
+
+class RoomBuffer:
+    """حلقة بآخر SIZE حدث لغرفة واحدة بترتيب الوصول"""
+
+    def __init__(self, size):
+        # (key, message_id, event)
+        self.events = deque(maxlen=size)
+        self.keys = set()
+        self.subscribers = 0
+
+    def add(self, key, message_id, event):
+        if key in self.keys:
+            # نفس الحدث وصل لاتصال آخر في العملية
+            return
+        if len(self.events) == self.events.maxlen:
+            self.keys.discard(self.events[0][0])
+        self.events.append((key, message_id, event))
+        self.keys.add(key)
+
+    def after(self, message_id):
+        """الأحداث بعد الرسالة message_id، أو None إذا لم تعد في الحلقة"""
+        events = list(self.events)
+        for index, (_, event_message_id, event) in enumerate(events):
+            if event_message_id == message_id and event['type'] == 'chat_message':
+                return [event for _, _, event in events[index + 1:]]
+        return None
+
+
+_rooms = {}
+_lock = threading.Lock()
+
+
+def subscribe(room_id):
+    """تسجيل مشترك في الغرفة - الحلقة تبدأ التسجيل من هذه اللحظة"""
+    key = room_key(room_id)
+    with _lock:
+        buffer = _rooms.get(key)
+        if buffer is None:
+            buffer = _rooms[key] = RoomBuffer(replay_settings()['SIZE'])
+        buffer.subscribers += 1
+
+
+def unsubscribe(room_id):
+    key = room_key(room_id)
+    with _lock:
+        buffer = _rooms.get(key)
+        if buffer is None:
+            return
+        buffer.subscribers -= 1
+        if buffer.subscribers <= 0:
+            # بدون مشتركين لا تصل الأحداث لهذه العملية - الحلقة لم تعد متصلة
+            del _rooms[key]
+
+
+def record(room_id, event):
+    """حفظ حدث chat_message أو message_changed وصل لمجموعة الغرفة"""
+    message_id = event.get('message_id')
+    if message_id is None:
+        return
+    if event['type'] == 'chat_message':
+        key = message_id
+    else:
+        key = (event['type'], message_id, event.get('seq'), event['text'])
+    with _lock:
+        buffer = _rooms.get(room_key(room_id))
+        if buffer is not None:
+            buffer.add(key, message_id, event)
+
+
+def is_complete():
+    """هل كل أحداث الغرف تُبث من هذه العملية (طبقة القنوات داخل العملية)"""
+    layers = getattr(settings, 'CHANNEL_LAYERS', {})
+    return layers.get('default', {}).get('BACKEND') == 'channels.layers.InMemoryChannelLayer'
+
+
+def missed_events(room_id, cursor):
+    """الأحداث بعد المؤشر من الذاكرة، أو None إذا كانت الفجوة أكبر من الحلقة"""
+    if not is_complete():
+        return None
+    try:
+        _, message_id = decode_cursor(cursor)
+    except ValueError:
+        return None
+    with _lock:
+        buffer = _rooms.get(room_key(room_id))
+        if buffer is None:
+            return None
+        return buffer.after(str(message_id))
+
+
+def messages_after_cursor(user, room, cursor, limit=None):
+    """أحداث chat_message للرسائل بعد المؤشر من قاعدة البيانات
+
+    يُرجع (events, has_more) - قائمة فارغة إذا كان المؤشر غير صالح.
+    """
+    from .broadcast import message_event
+    from .hiding import visible_messages
+    from .models import Message
+    from .serializers import with_message_relations
+
+    if limit is None:
+        limit = replay_settings()['DB_LIMIT']
+    query = with_message_relations(visible_messages(Message.objects.filter(room=room), user, room.id))
+    try:
+        messages_list, has_more = paginate_messages(query, after=cursor, limit=limit)
+    except ValueError:
+        return [], False
+    return [message_event(message) for message in messages_list], has_more
+
+
+def stats():
+    with _lock:
+        return {
+            'rooms': len(_rooms),
+            'events': sum(len(buffer.events) for buffer in _rooms.values()),
+        }
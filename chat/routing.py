@@ -1,6 +1,9 @@
 from django.urls import re_path
-from . import consumers
+from . import consumers, multiplex
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/room/(?P<room_id>[0-9a-f-]+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/unread/$', consumers.UnreadConsumer.as_asgi()),
+    # اتصال واحد لكل المستخدم: غرف متعددة وإشارات المكالمات
+    re_path(r'ws/chat/mux/$', multiplex.MultiplexConsumer.as_asgi()),
 ]
\ No newline at end of file
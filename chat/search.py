@@ -0,0 +1,228 @@
+# chat/search.py
+"""البحث في نص الرسائل بفهرس نصي مقلوب مع تطبيع للعربية
+
+كل رسالة نصية لها صف MessageSearchDocument بالنص بعد التطبيع، والفهرس
+المقلوب مبني عليه حسب قاعدة البيانات:
+
+- SQLite: جدول FTS5 بمحتوى خارجي (chat_message_fts) تحدثه triggers على
+  جدول المستندات، والبحث بالبادئة "كلمة"* من فهارس prefix
+- PostgreSQL (عند DATABASE_URL): فهرس GIN على to_tsvector('simple', body)
+  والبحث بـ to_tsquery('كلمة:*')
+
+التطبيع نفسه يُطبق على النص وعلى كلمات البحث: حذف التشكيل والتطويل، توحيد
+أشكال الألف (أ إ آ ٱ)، الياء (ى ئ)، التاء المربوطة (ة) والهمزة على الواو،
+والأرقام العربية.
+
+الغرف (الاسم والوصف) لها نفس البنية في RoomSearchDocument لبحث دليل الغرف
+(chat/directory.py).
+
+الفهرس يُحدث تدريجياً من الإشارات (إنشاء رسالة، دفعة الحفظ المؤجل، تعديل
+النص)، والحذف يصل للفهرس عبر CASCADE على المستند، لذلك تكلفة البحث لا
+تعتمد على حجم جدول الرسائل بل على عدد النتائج المطابقة.
+"""
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .hiding import exclude_hidden, get_state
+from .models import Message, MessageSearchDocument, RoomSearchDocument
+from .pagination import DEFAULT_PAGE_SIZE, paginate_messages
+from .queries import joinable_rooms_queryset
+from .serializers import with_message_relations
+
+# أقصى عدد كلمات تُستخدم من نص البحث
+MAX_TERMS = 8
+
+# التشكيل وعلامات القرآن والتطويل
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06dc\u06df-\u06e8\u06ea-\u06ed\u0640]')
+_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي',
+    'ؤ': 'و',
+    'ة': 'ه',
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    **{chr(0x06f0 + digit): str(digit) for digit in range(10)},
+})
+# حروف وأرقام فقط - نفس تقسيم unicode61 و parser البسيط في PostgreSQL
+_TOKEN = re.compile(r'[^\W_]+')
+
+
+def normalize(text):
+    """النص بعد التطبيع: كلمات مفصولة بمسافة واحدة"""
+    text = unicodedata.normalize('NFKC', text or '')
+    text = _DIACRITICS.sub('', text).translate(_LETTERS).casefold()
+    return ' '.join(_TOKEN.findall(text))
+
+
+def query_terms(query):
+    return normalize(query).split()[:MAX_TERMS]
+
+
+def document_text(message):
+    """النص المفهرس للرسالة - فارغ لرسائل النظام والصور بدون نص"""
+    if message.message_type == 'system':
+        return ''
+    return normalize(' '.join(filter(None, [message.content, message.file_name])))
+
+
+class SQLiteBackend:
+    """FTS5 بمحتوى خارجي - الفهرس لا يكرر النص المحفوظ في جدول المستندات"""
+
+    def __init__(self, model, fts_table):
+        self.documents = model._meta.db_table
+        self.fts_table = fts_table
+
+    def install(self, schema_editor):
+        documents, fts = self.documents, self.fts_table
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"body, content='{documents}', content_rowid='id', "
+            f"prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {documents} BEGIN "
+            f"INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {documents} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, body) VALUES ('delete', old.id, old.body); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF body ON {documents} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, body) VALUES ('delete', old.id, old.body); "
+            f"INSERT INTO {fts}(rowid, body) VALUES (new.id, new.body); END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    def uninstall(self, schema_editor):
+        for trigger in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {self.fts_table}_{trigger}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {self.fts_table}")
+
+    def matching_ids(self, terms):
+        """معرفات المستندات التي تحتوي كل الكلمات (كبادئة) - للاستخدام مع __in"""
+        expression = ' '.join(f'"{term}"*' for term in terms)
+        return RawSQL(f"SELECT rowid FROM {self.fts_table} WHERE {self.fts_table} MATCH %s", [expression])
+
+
+class PostgresBackend:
+    """فهرس GIN على tsvector محسوب من body (بدون عمود إضافي)"""
+
+    def __init__(self, model, fts_table):
+        self.documents = model._meta.db_table
+        self.fts_table = fts_table
+
+    def install(self, schema_editor):
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.fts_table}_gin ON {self.documents} "
+            f"USING gin (to_tsvector('simple', body))"
+        )
+
+    def uninstall(self, schema_editor):
+        schema_editor.execute(f"DROP INDEX IF EXISTS {self.fts_table}_gin")
+
+    def matching_ids(self, terms):
+        expression = ' & '.join(f'{term}:*' for term in terms)
+        return RawSQL(
+            f"SELECT id FROM {self.documents} WHERE to_tsvector('simple', body) @@ to_tsquery('simple', %s)",
+            [expression]
+        )
+
+
+class ContainsBackend:
+    """قواعد بيانات أخرى - بحث بدون فهرس على النص المطبّع"""
+
+    def __init__(self, model, fts_table):
+        self.model = model
+
+    def install(self, schema_editor):
+        pass
+
+    def uninstall(self, schema_editor):
+        pass
+
+    def matching_ids(self, terms):
+        documents = self.model.objects.all()
+        for term in terms:
+            documents = documents.filter(body__contains=term)
+        return documents.values('id')
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'postgresql': PostgresBackend,
+}
+
+# جدول الفهرس (أو اسم فهرس GIN) لكل نموذج مستندات
+FTS_TABLES = {
+    MessageSearchDocument: 'chat_message_fts',
+    RoomSearchDocument: 'chat_room_fts',
+}
+
+
+def get_backend(vendor=None, model=MessageSearchDocument):
+    backend = BACKENDS.get(vendor or connection.vendor, ContainsBackend)
+    return backend(model, FTS_TABLES[model])
+
+
+def index_messages(messages):
+    """فهرسة رسائل جديدة أو معدلة - إدراج واحد (upsert) للدفعة"""
+    documents = []
+    for message in messages:
+        body = document_text(message)
+        if body:
+            documents.append(MessageSearchDocument(message_id=message.id, body=body))
+    if documents:
+        MessageSearchDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=['message'],
+            update_fields=['body']
+        )
+
+
+def reindex_message(message):
+    """بعد تعديل النص"""
+    if document_text(message):
+        index_messages([message])
+    else:
+        MessageSearchDocument.objects.filter(message_id=message.id).delete()
+
+
+def index_room(room):
+    """فهرسة اسم الغرفة ووصفها بعد الإنشاء أو التعديل"""
+    RoomSearchDocument.objects.update_or_create(
+        room_id=room.pk,
+        defaults={'body': normalize(f"{room.name} {room.description or ''}")}
+    )
+
+
+def matching_rooms(terms):
+    """استعلام معرفات الغرف التي تطابق الكلمات"""
+    return RoomSearchDocument.objects.filter(
+        id__in=get_backend(model=RoomSearchDocument).matching_ids(terms)
+    ).values('room_id')
+
+
+def search_messages(user, query, room=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """نتائج البحث الأحدث أولاً: (الرسائل، هل توجد نتائج أقدم)
+
+    room=None للبحث في كل الغرف التي يستطيع المستخدم دخولها. الرسائل التي
+    أخفاها المستخدم لا تظهر. before مؤشر آخر نتيجة في الصفحة السابقة.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], False
+
+    messages = Message.objects.filter(search_document__id__in=get_backend().matching_ids(terms))
+    if room is not None:
+        messages = get_state(user, room.id).filter(messages.filter(room=room))
+    else:
+        messages = exclude_hidden(
+            messages.filter(room_id__in=joinable_rooms_queryset(user).values('id')),
+            user
+        )
+    page, has_more = paginate_messages(
+        with_message_relations(messages).select_related('room'),
+        before=before,
+        limit=limit
+    )
+    return list(reversed(page)), has_more
@@ -0,0 +1,129 @@
+# chat/sequence.py
+"""تسلسل الغرفة والمزامنة بعد seq
+
+كل تغيير في الغرفة (رسالة جديدة، تعديل، حذف) يأخذ الرقم التالي من
+RoomActivity.last_seq. الزيادة بـ UPDATE ... SET last_seq = last_seq + n داخل
+نفس معاملة الإدراج، لذلك تنتظر الكتابات المتزامنة بعضها على صف الغرفة
+(بدلاً من الاعتماد على timestamp) ولا تبقى فجوة إذا تراجعت المعاملة.
+
+العميل يحفظ آخر seq وصله ويطلب sync_events(after=N) بعد إعادة الاتصال:
+الرسائل الجديدة والمعدلة تُقرأ من فهرس (room, changed_seq) والحذف من
+MessageTombstone، بدون إعادة جلب صفحات كاملة.
+"""
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .hiding import visible_messages
+from .models import Message, MessageTombstone, RoomActivity
+from .serializers import serialize_messages, with_message_relations
+
+SYNC_PAGE_SIZE = 100
+
+
+def allocate_seq(room_id, count=1):
+    """حجز count رقم متتالي للغرفة - يُرجع أول رقم
+
+    يجب استدعاؤها داخل نفس المعاملة التي تحفظ التغيير. حيث تدعم قاعدة
+    البيانات RETURNING الحجز جملة UPDATE واحدة بدون قراءة منفصلة.
+    """
+    with transaction.atomic():
+        last = _increment_returning(room_id, count)
+        if last is not None:
+            return last - count + 1
+        updated = RoomActivity.objects.filter(room_id=room_id).update(last_seq=F('last_seq') + count)
+        if not updated:
+            # غرفة بدون سجل نشاط (أُنشئت قبل وجود الجدول)
+            RoomActivity.objects.get_or_create(room_id=room_id)
+            RoomActivity.objects.filter(room_id=room_id).update(last_seq=F('last_seq') + count)
+        last = RoomActivity.objects.filter(room_id=room_id).values_list('last_seq', flat=True).get()
+    return last - count + 1
+
+
+def _increment_returning(room_id, count):
+    """UPDATE ... RETURNING last_seq - None إذا لم تدعمه القاعدة أو لا يوجد سجل للغرفة"""
+    if not connection.features.can_return_columns_from_insert:
+        return None
+    meta = RoomActivity._meta
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {table} SET {seq} = {seq} + %s WHERE {room} = %s RETURNING {seq}'.format(
+                table=quote(meta.db_table),
+                seq=quote(meta.get_field('last_seq').column),
+                room=quote(meta.pk.column),
+            ),
+            [count, meta.pk.get_db_prep_value(room_id, connection)]
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def assign_seqs(messages):
+    """تخصيص الأرقام لدفعة رسائل غير محفوظة (قبل bulk_create في نفس المعاملة)"""
+    by_room = {}
+    for message in messages:
+        if message.seq is None:
+            by_room.setdefault(message.room_id, []).append(message)
+    for room_id, room_messages in by_room.items():
+        room_messages.sort(key=lambda m: (m.timestamp, str(m.id)))
+        first = allocate_seq(room_id, len(room_messages))
+        for offset, message in enumerate(room_messages):
+            message.seq = message.changed_seq = first + offset
+
+
+def edit_message(message, content):
+    """تعديل نص الرسالة برقم تسلسل جديد حتى تصل للمزامنة"""
+    with transaction.atomic():
+        message.content = content
+        message.is_edited = True
+        message.edited_at = timezone.now()
+        message.changed_seq = allocate_seq(message.room_id)
+        message.save(update_fields=['content', 'is_edited', 'edited_at', 'changed_seq'])
+    return message
+
+
+def record_delete(message):
+    """أثر للرسالة المحذوفة برقم تسلسل جديد (من إشارة post_delete)"""
+    if not RoomActivity.objects.filter(room_id=message.room_id).exists():
+        # الغرفة نفسها تُحذف - لا أحد سيزامنها
+        return None
+    with transaction.atomic():
+        return MessageTombstone.objects.create(
+            room_id=message.room_id,
+            seq=allocate_seq(message.room_id),
+            message_id=message.id
+        )
+
+
+def sync_events(room, user, after, limit=SYNC_PAGE_SIZE):
+    """كل التغييرات في الغرفة بعد seq = after بترتيب التسلسل
+
+    يُرجع (events, last_seq, has_more):
+        {'type': 'message', ...}  رسالة جديدة (seq > after)
+        {'type': 'edit', ...}     رسالة قديمة تغير نصها
+        {'type': 'delete', 'id', 'seq'}
+    """
+    changed = list(
+        with_message_relations(
+            visible_messages(Message.objects.filter(room=room, changed_seq__gt=after), user, room.id)
+        ).order_by('changed_seq')[:limit + 1]
+    )
+    tombstones = list(
+        MessageTombstone.objects.filter(room_id=room.id, seq__gt=after)
+        .order_by('seq')
+        .values('message_id', 'seq')[:limit + 1]
+    )
+
+    events = []
+    for message, data in zip(changed, serialize_messages(changed)):
+        kind = 'message' if message.seq > after else 'edit'
+        events.append({**data, 'type': kind, 'seq': message.changed_seq})
+    for tombstone in tombstones:
+        events.append({'type': 'delete', 'id': str(tombstone['message_id']), 'seq': tombstone['seq']})
+
+    events.sort(key=lambda event: event['seq'])
+    has_more = len(events) > limit
+    events = events[:limit]
+    last_seq = events[-1]['seq'] if events else after
+    return events, last_seq, has_more
@@ -0,0 +1,65 @@
+# chat/serializers.py
+from .pagination import encode_cursor
+
+# العلاقات التي يحتاجها تحويل الرسالة - تُجلب بنفس الاستعلام بدلاً من استعلام لكل رسالة
+MESSAGE_RELATED_FIELDS = ('sender__chat_profile', 'reply_to__sender')
+
+REPLY_PREVIEW_LENGTH = 50
+
+
+def with_message_relations(queryset):
+    """إضافة select_related للمرسل وملفه الشخصي والرسالة المردود عليها"""
+    return queryset.select_related(*MESSAGE_RELATED_FIELDS)
+
+
+def get_display_name(user):
+    """الاسم المعروض للمستخدم أو البريد إذا لم يكن محدداً"""
+    try:
+        profile = getattr(user, 'chat_profile', None)
+    except Exception:
+        profile = None
+    return profile.display_name if profile and profile.display_name else user.email
+
+
+def reply_preview(message):
+    """معاينة الرسالة المردود عليها"""
+    if not message:
+        return None
+    return {
+        'id': str(message.id),
+        'sender': message.sender.email,
+        'message': message.content[:REPLY_PREVIEW_LENGTH]
+    }
+
+
+def serialize_message(msg, display_name=None):
+    """تحويل الرسالة إلى القاموس المستخدم في get_messages و send_message"""
+    message_data = {
+        'id': str(msg.id),
+        'sender': msg.sender.email,
+        'sender_display': display_name or get_display_name(msg.sender),
+        'message': msg.content,
+        'message_type': msg.message_type,
+        'timestamp': msg.timestamp.strftime("%H:%M"),
+        'is_edited': msg.is_edited,
+        'cursor': encode_cursor(msg),
+        'seq': msg.seq,
+    }
+
+    if msg.image:
+        message_data['image_url'] = msg.image.url
+        image = msg.image_data()
+        if image:
+            message_data['image'] = image
+    if msg.file:
+        message_data['file_url'] = msg.file.url
+        message_data['file_name'] = msg.file_name
+    if msg.reply_to_id:
+        message_data['reply_to'] = reply_preview(msg.reply_to)
+
+    return message_data
+
+
+def serialize_messages(messages):
+    """تحويل قائمة رسائل - يجب أن تكون مجلوبة عبر with_message_relations"""
+    return [serialize_message(msg) for msg in messages]
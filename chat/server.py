@@ -0,0 +1,48 @@
+# chat/server.py
+"""تشغيل daphne مع قياس مخزن الكتابة لكل اتصال WebSocket
+
+send في daphne يعود فوراً: الإطار يُكتب في مخزن Twisted للاتصال وينتظر هناك
+حتى يقرأه العميل، وطبقة ASGI لا ترى حجم هذا المخزن. هذا الخادم يضيف إلى
+scope الاتصال دالة تُرجع عدد البايتات التي لم تُرسل بعد:
+
+    scope['extensions']['chat.write_buffer']() -> int
+
+وطابور الإرسال (chat/outbox.py) يتوقف عن الإرسال ما دام المخزن أكبر من
+MAX_BUFFER، فتبقى الإطارات في الطابور المحدود حيث يطبق الدمج وسياسة الامتلاء.
+
+التشغيل بنفس خيارات daphne:
+    python -m chat.server -b 0.0.0.0 -p 8000 whatsapp_clone.asgi:application
+"""
+from daphne.cli import CommandLineInterface as DaphneCommandLineInterface
+from daphne.server import Server
+
+WRITE_BUFFER_EXTENSION = 'chat.write_buffer'
+
+
+def buffered_bytes(transport):
+    """البايتات المنتظرة في مخزن transport من Twisted (ومن تحته إذا كان TLS)"""
+    total = 0
+    while transport is not None:
+        data = getattr(transport, 'dataBuffer', None)
+        if data is not None:
+            total += len(data) - getattr(transport, 'offset', 0) + getattr(transport, '_tempDataLen', 0)
+        transport = getattr(transport, 'transport', None)
+    return total
+
+
+class WriteBufferServer(Server):
+    """Server من daphne يضيف قياس مخزن الكتابة لاتصالات WebSocket"""
+
+    def create_application(self, protocol, scope):
+        if scope.get('type') == 'websocket':
+            extensions = scope.setdefault('extensions', {})
+            extensions[WRITE_BUFFER_EXTENSION] = lambda: buffered_bytes(protocol.transport)
+        return super().create_application(protocol, scope)
+
+
+class CommandLineInterface(DaphneCommandLineInterface):
+    server_class = WriteBufferServer
+
+
+if __name__ == '__main__':
+    CommandLineInterface.entrypoint()
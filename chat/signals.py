@@ -1,8 +1,21 @@
 # في chat/signals.py - إنشاء ملف جديد
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
 from django.contrib.auth import user_logged_in, user_logged_out
-from .models import OnlineUser, ChatRoom
+from .models import OnlineUser, ChatRoom, Message, MessageTombstone, UserProfile
+from django.db import transaction
+from . import activity, directory, images, message_cache, search, sequence
+from .presence import get_presence
+from .broadcast import send_to_user
+
+# يُرسل بعد حفظ دفعة رسائل بـ bulk_create (لا يُرسل post_save في هذه الحالة)
+# وبعد دفعة من رسائل المستهلك المحفوظة منفردة (writebehind.record_saved)
+messages_bulk_created = Signal()
+
+
+def recorded_later(instance):
+    """رسالة المستهلك - عداداتها وفهرستها ونافذتها تأتي لاحقاً من messages_bulk_created"""
+    return getattr(instance, 'record_later', False)
 
 @receiver(user_logged_in)
 def user_logged_in_handler(sender, request, user, **kwargs):
@@ -17,10 +30,162 @@ def user_logged_in_handler(sender, request, user, **kwargs):
 def user_logged_out_handler(sender, request, user, **kwargs):
     """عند تسجيل خروج المستخدم"""
     try:
-        # تحديث جميع سجلات OnlineUser لهذا المستخدم
+        # إزالة المستخدم من التتبع في الذاكرة وتحديث جميع سجلات OnlineUser لهذا المستخدم
+        get_presence().forget_user(user.id)
         OnlineUser.objects.filter(user=user).update(is_online=False)
         print(f"User {user.email} logged out - marked as offline in all rooms")
     except Exception as e:
         print(f"Error in user_logged_out_handler: {e}")
 
-# تأكد من تسجيل الإشارات في apps.py
\ No newline at end of file
+# تأكد من تسجيل الإشارات في apps.py
+
+@receiver(post_save, sender=ChatRoom)
+def create_room_activity(sender, instance, created, **kwargs):
+    """إنشاء ملخص النشاط عند إنشاء غرفة جديدة"""
+    if created:
+        activity.ensure_room_activity(instance.pk)
+
+@receiver(post_save, sender=ChatRoom)
+def update_room_search_index(sender, instance, update_fields=None, **kwargs):
+    """فهرسة اسم الغرفة ووصفها وإبطال نتائج البحث المحفوظة"""
+    if update_fields is not None and not {'name', 'description', 'is_active'} & set(update_fields):
+        return
+    search.index_room(instance)
+    directory.invalidate()
+
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room_search(sender, instance, **kwargs):
+    directory.invalidate()
+
+@receiver(post_save, sender=Message)
+def update_room_activity_on_message(sender, instance, created, **kwargs):
+    """تحديث عدادات الغرفة عند إنشاء رسالة (الإرسال عبر HTTP، رسائل النظام)"""
+    if created and not recorded_later(instance):
+        activity.record_message(instance)
+
+@receiver(messages_bulk_created)
+def update_room_activity_on_bulk(sender, messages, **kwargs):
+    """تحديث عدادات الغرف بعد حفظ دفعة من الطابور المؤجل"""
+    activity.record_messages(messages)
+
+@receiver(post_save, sender=Message)
+def update_message_cache(sender, instance, created, **kwargs):
+    """إضافة الرسالة الجديدة لنافذة الغرفة في الذاكرة بعد نجاح المعاملة، أو إبطالها عند التعديل"""
+    if created:
+        if not recorded_later(instance):
+            transaction.on_commit(lambda: message_cache.record_messages([instance]))
+    else:
+        transaction.on_commit(lambda: message_cache.invalidate_room(instance.room_id))
+
+@receiver(messages_bulk_created)
+def update_message_cache_on_bulk(sender, messages, **kwargs):
+    message_cache.record_messages(messages)
+
+@receiver(post_save, sender=Message)
+def update_search_index(sender, instance, created, update_fields=None, **kwargs):
+    """فهرسة الرسالة الجديدة في نفس المعاملة، وإعادة فهرستها عند تعديل النص فقط"""
+    if created:
+        if not recorded_later(instance):
+            search.index_messages([instance])
+    elif update_fields is None or 'content' in update_fields:
+        search.reindex_message(instance)
+
+@receiver(post_save, sender=Message)
+def process_message_image(sender, instance, created, **kwargs):
+    """إنشاء أحجام الصورة في مجموعة العمليات بعد نجاح المعاملة"""
+    if created and instance.image:
+        images.schedule(instance)
+
+@receiver(messages_bulk_created)
+def update_search_index_on_bulk(sender, messages, **kwargs):
+    search.index_messages(messages)
+
+@receiver(post_delete, sender=Message)
+def invalidate_message_cache_on_delete(sender, instance, **kwargs):
+    message_cache.invalidate_room(instance.room_id)
+
+@receiver(post_delete, sender=Message)
+def update_room_activity_on_delete(sender, instance, **kwargs):
+    """تحديث عدادات الغرفة عند حذف رسالة"""
+    activity.forget_message(instance)
+
+@receiver(post_delete, sender=Message)
+def record_message_tombstone(sender, instance, **kwargs):
+    """أثر الحذف برقم تسلسل جديد حتى يصل للمزامنة"""
+    try:
+        sequence.record_delete(instance)
+    except Exception as e:
+        print(f"Error recording tombstone for message {instance.id}: {e}")
+
+@receiver(post_delete, sender=ChatRoom)
+def delete_room_tombstones(sender, instance, **kwargs):
+    """آثار الحذف بدون مفتاح أجنبي - تُحذف مع الغرفة"""
+    MessageTombstone.objects.filter(room_id=instance.pk).delete()
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def remember_cleared(sender, instance, action, reverse, **kwargs):
+    """الطرف الآخر قبل clear - post_clear يصل بدون pk_set
+
+    room.participants.clear(): معرفات المستخدمين، user.chat_rooms.clear(): معرفات الغرف.
+    """
+    if action == 'pre_clear':
+        related = instance.chat_rooms if reverse else instance.participants
+        instance._cleared_pks = set(related.values_list('id', flat=True))
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def update_participant_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """تحديث عدد المشاركين عند الإضافة أو الإزالة"""
+    if action in ('post_add', 'post_remove') and pk_set:
+        delta = len(pk_set) if action == 'post_add' else -len(pk_set)
+        if reverse:
+            # user.chat_rooms.add(...) - كل غرفة تتغير بمقدار واحد
+            activity.adjust_participant_count(pk_set, 1 if delta > 0 else -1)
+        else:
+            activity.adjust_participant_count([instance.pk], delta)
+    elif action == 'post_clear':
+        if not reverse:
+            activity.refresh_participant_count(instance)
+        elif getattr(instance, '_cleared_pks', None):
+            # user.chat_rooms.clear() - كل غرفة نقصت مشاركاً واحداً
+            activity.adjust_participant_count(instance._cleared_pks, -1)
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def revoke_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """إبلاغ اتصالات المستخدم المفتوحة لإعادة التحقق من الصلاحية بعد الإزالة"""
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_pks', set())
+    elif action != 'post_remove':
+        return
+    if not pk_set:
+        return
+    if reverse:
+        pairs = [(instance.pk, room_id) for room_id in pk_set]
+    else:
+        pairs = [(user_id, instance.pk) for user_id in pk_set]
+    for user_id, room_id in pairs:
+        send_to_user(user_id, {'type': 'membership_revoked', 'room_id': str(room_id)})
+
+# قيمة غير معروفة (الحقل مؤجل عند القراءة) - تُعامل كتغيير
+_UNKNOWN = object()
+
+@receiver(post_init, sender=UserProfile)
+def remember_display_name(sender, instance, **kwargs):
+    """الاسم المعروض كما قُرئ - save_user_profile يحفظ الملف مع كل حفظ للمستخدم (last_login مثلاً)"""
+    instance._saved_display_name = instance.__dict__.get('display_name', _UNKNOWN)
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_display_name(sender, instance, update_fields=None, **kwargs):
+    """تحديث الاسم المعروض المخزن في اتصالات WebSocket المفتوحة للمستخدم عند تغيره فقط
+
+    الصورة الشخصية غير مخزنة في الاتصالات أو نوافذ الرسائل، فتغييرها لا يحتاج بثاً.
+    """
+    if update_fields is not None and 'display_name' not in update_fields:
+        return
+    if instance.display_name == getattr(instance, '_saved_display_name', _UNKNOWN):
+        return
+    instance._saved_display_name = instance.display_name
+    message_cache.invalidate_sender(instance.user_id, instance.display_name or instance.user.email)
+    send_to_user(instance.user_id, {
+        'type': 'profile_changed',
+        'display_name': instance.display_name or instance.user.email
+    })
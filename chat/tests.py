@@ -1,3 +1,1328 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from .models import ChatRoom, FileUpload, Message, ReadReceipt, RoomActivity
+from .routing import websocket_urlpatterns
+from .queries import UNREAD_CAP, format_unread, get_unread_counts
+from . import directory, drain, hiding, images, message_cache, multiplex, presence, receipts, replay, search, sequence, server, typing_indicator, uploads, writebehind
+from .broadcast import broadcast_message, group_event, message_event, room_group_name
+from .consumers import ChatConsumer
+from .outbox import EPHEMERAL, MESSAGE, Outbox, metrics as outbox_metrics, write_buffer_probe
+from .sequence import assign_seqs
+from .signals import messages_bulk_created
+from .presence import get_presence
+
+
+@override_settings(CHAT_MESSAGE_CACHE={'ENABLED': False})
+class GetMessagesQueryBudgetTests(TestCase):
+    """get_messages يجب أن يكلف عدداً ثابتاً من الاستعلامات مهما كان عدد الرسائل"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='reader@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='budget', room_type='public', created_by=self.user)
+        self.client.force_login(self.user)
+
+    def create_messages(self, start, count):
+        for i in range(start, start + count):
+            sender = CustomUser.objects.create_user(email=f'sender{i}@example.com', password='pass12345')
+            sender.chat_profile.display_name = f'مرسل {i}'
+            sender.chat_profile.save()
+            original = Message.objects.create(room=self.room, sender=sender, content=f'أصل {i}')
+            Message.objects.create(room=self.room, sender=sender, content=f'رد {i}', reply_to=original)
+
+    def test_query_count_does_not_grow_with_messages(self):
+        self.create_messages(0, 2)
+        # الجلسة + المستخدم + الغرفة + المخفي + الرسائل مع المرسلين والملفات والردود
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/chat/messages/{self.room.id}/?limit=100')
+        self.assertEqual(len(response.json()['messages']), 4)
+
+        self.create_messages(2, 20)
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/chat/messages/{self.room.id}/?limit=100')
+
+        data = response.json()['messages']
+        self.assertEqual(len(data), 44)
+        reply = data[-1]
+        self.assertEqual(reply['sender_display'], 'مرسل 21')
+        self.assertEqual(reply['reply_to']['message'], 'أصل 21')
+        self.assertEqual(reply['reply_to']['sender'], 'sender21@example.com')
+
+    def test_legacy_last_id(self):
+        self.create_messages(0, 2)
+        url = f'/chat/messages/{self.room.id}/'
+        all_ids = [m['id'] for m in self.client.get(url).json()]
+        self.assertEqual(len(all_ids), 4)
+
+        after = self.client.get(url, {'last_id': all_ids[1]}).json()
+        self.assertEqual([m['id'] for m in after], all_ids[2:])
+        # معرف صحيح الصيغة لكن غير موجود - نفس الصفحة بدون last_id
+        unknown = self.client.get(url, {'last_id': str(uuid.uuid4())}).json()
+        self.assertEqual([m['id'] for m in unknown], all_ids)
+
+
+class UnreadCountsTests(TestCase):
+    """عدد غير المقروء لكل الغرف باستعلام واحد ومحدود بـ UNREAD_CAP"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='reader@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='writer@example.com', password='pass12345')
+
+    def create_room(self, name, unread):
+        room = ChatRoom.objects.create(name=name, room_type='public', created_by=self.other)
+        read = Message.objects.create(room=room, sender=self.other, content='مقروءة')
+        ReadReceipt.objects.create(
+            user=self.user, room=room, last_read_at=read.timestamp, last_read_message_id=read.id
+        )
+        for i in range(unread):
+            Message.objects.create(room=room, sender=self.other, content=f'جديدة {i}')
+        # رسائل المستخدم نفسه لا تُحسب
+        Message.objects.create(room=room, sender=self.user, content='رسالتي')
+        return room
+
+    def test_counts_in_one_query_with_cap(self):
+        small = self.create_room('small', 3)
+        large = self.create_room('large', UNREAD_CAP + 5)
+        unopened = ChatRoom.objects.create(name='unopened', room_type='public', created_by=self.other)
+        Message.objects.create(room=unopened, sender=self.other, content='لم تُفتح')
+
+        with self.assertNumQueries(1):
+            counts = get_unread_counts(self.user)
+
+        self.assertEqual(counts[str(small.id)], 3)
+        self.assertEqual(counts[str(large.id)], UNREAD_CAP + 1)
+        # غرفة عامة لم يفتحها المستخدم ليست من غرفه - تظهر في دليل الغرف فقط
+        self.assertNotIn(str(unopened.id), counts)
+        self.assertEqual(format_unread(counts[str(large.id)]), '99+')
+        self.assertEqual(format_unread(counts[str(small.id)]), '3')
+
+    def test_messages_with_same_timestamp_as_cursor(self):
+        room = ChatRoom.objects.create(name='same-time', room_type='public', created_by=self.other)
+        first = Message.objects.create(room=room, sender=self.other, content='أولى')
+        second = Message.objects.create(room=room, sender=self.other, content='ثانية', timestamp=first.timestamp)
+        read, unread = sorted([first, second], key=lambda m: m.id)
+        ReadReceipt.objects.create(
+            user=self.user, room=room, last_read_at=read.timestamp, last_read_message_id=read.id
+        )
+
+        self.assertEqual(get_unread_counts(self.user)[str(room.id)], 1)
+        ReadReceipt.objects.filter(user=self.user, room=room).update(last_read_message_id=unread.id)
+        self.assertEqual(get_unread_counts(self.user)[str(room.id)], 0)
+
+
+class ReadReceiptTests(TestCase):
+    """"قرأها N" لكل موقع بدون مؤشر كاتب الرسالة، والمؤشر لا يرجع للخلف"""
+
+    def setUp(self):
+        self.author = CustomUser.objects.create_user(email='author@example.com', password='pass12345')
+        self.reader = CustomUser.objects.create_user(email='reader@example.com', password='pass12345')
+        self.late = CustomUser.objects.create_user(email='late@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='receipts', room_type='public', created_by=self.author)
+        base = timezone.now() - timedelta(minutes=5)
+        self.first = Message.objects.create(room=self.room, sender=self.author, content='1', timestamp=base)
+        self.second = Message.objects.create(
+            room=self.room, sender=self.reader, content='2', timestamp=base + timedelta(seconds=1)
+        )
+
+    def point(self, user, message):
+        return {(user.id, str(self.room.id)): (message.timestamp, str(message.id))}
+
+    def test_author_pointer_not_counted(self):
+        receipts.save_pointers({
+            **self.point(self.author, self.second),
+            **self.point(self.reader, self.second),
+            **self.point(self.late, self.first),
+        })
+        self.assertEqual(receipts.read_by(self.room.id), [
+            # الثانية قرأها الكاتب الأول فقط، والأولى قرأها القارئان
+            {'message_id': str(self.second.id), 'count': 1},
+            {'message_id': str(self.first.id), 'count': 2},
+        ])
+
+    def test_pointer_does_not_move_back(self):
+        receipts.save_pointers(self.point(self.reader, self.second))
+        self.assertEqual(receipts.save_pointers(self.point(self.reader, self.first)), set())
+        self.assertEqual(
+            ReadReceipt.objects.get(user=self.reader, room=self.room).last_read_message_id,
+            self.second.id
+        )
+
+
+class SyncAfterSeqTests(TestCase):
+    """المزامنة بعد seq تُرجع الرسائل الجديدة والتعديلات والحذف بدون فجوات"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='sync@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='sync', room_type='public', created_by=self.user)
+        self.client.force_login(self.user)
+
+    def sync(self, after):
+        return self.client.get(f'/chat/sync/{self.room.id}/?after_seq={after}').json()
+
+    def test_seq_is_gap_free_across_single_and_bulk_inserts(self):
+        first = Message.objects.create(room=self.room, sender=self.user, content='1')
+        batch = [Message(room=self.room, sender=self.user, content=str(i)) for i in (2, 3)]
+        assign_seqs(batch)
+        Message.objects.bulk_create(batch)
+        last = Message.objects.create(room=self.room, sender=self.user, content='4')
+
+        seqs = list(Message.objects.filter(room=self.room).order_by('seq').values_list('seq', flat=True))
+        self.assertEqual(seqs, [1, 2, 3, 4])
+        self.assertEqual((first.seq, last.seq), (1, 4))
+
+    def test_sync_returns_edits_and_deletes_after_seq(self):
+        kept = Message.objects.create(room=self.room, sender=self.user, content='قديمة')
+        gone = Message.objects.create(room=self.room, sender=self.user, content='ستحذف')
+        data = self.sync(0)
+        self.assertEqual([e['type'] for e in data['events']], ['message', 'message'])
+        cursor = data['last_seq']
+        self.assertEqual(cursor, 2)
+
+        self.client.post(f'/chat/message/{kept.id}/edit/', '{"message": "معدلة"}', content_type='application/json')
+        self.client.post(f'/chat/message/{gone.id}/delete/')
+        new = Message.objects.create(room=self.room, sender=self.user, content='جديدة')
+
+        data = self.sync(cursor)
+        self.assertEqual(
+            [(e['type'], e['seq']) for e in data['events']],
+            [('edit', 3), ('delete', 4), ('message', 5)]
+        )
+        self.assertEqual(data['events'][0]['message'], 'معدلة')
+        self.assertEqual(data['events'][1]['id'], str(gone.id))
+        self.assertEqual(data['events'][2]['id'], str(new.id))
+        self.assertEqual(data['last_seq'], 5)
+        self.assertFalse(data['has_more'])
+        self.assertEqual(self.sync(5)['events'], [])
+
+    def test_invalid_after_seq(self):
+        response = self.client.get(f'/chat/sync/{self.room.id}/?after_seq=abc')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHAT_REPLAY={'SIZE': 3})
+class ReplayBufferTests(TestCase):
+    """الاستئناف من الذاكرة ما دام المؤشر في الحلقة، وإلا من قاعدة البيانات"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='replay@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='replay', room_type='public', created_by=self.user)
+        replay.subscribe(self.room.id)
+        self.addCleanup(replay.unsubscribe, self.room.id)
+
+    def send(self, content):
+        # الحدث يُحفظ في الحلقة عند البث وليس عند كل مستقبل
+        message = Message.objects.create(room=self.room, sender=self.user, content=content)
+        broadcast_message(message)
+        return message_event(message)
+
+    def test_missed_events_from_memory(self):
+        first = self.send('1')
+        self.send('2')
+        self.send('3')
+        events = replay.missed_events(self.room.id, first['cursor'])
+        self.assertEqual([e['message_id'] for e in events], [str(m.id) for m in Message.objects.all()[1:]])
+
+    def test_gap_larger_than_buffer_falls_back_to_db(self):
+        first = self.send('1')
+        for i in range(2, 6):
+            self.send(str(i))
+        self.assertIsNone(replay.missed_events(self.room.id, first['cursor']))
+
+        events, has_more = replay.messages_after_cursor(self.user, self.room, first['cursor'], limit=3)
+        self.assertEqual(len(events), 3)
+        self.assertTrue(has_more)
+
+    def test_consumer_delivery_does_not_record(self):
+        first = self.send('1')
+        delivered = []
+        consumer = ChatConsumer()
+        consumer.room_id = str(self.room.id)
+        consumer.replayed = set()
+        consumer.recent_messages = {}
+
+        async def deliver(event, kind, key=None):
+            delivered.append(event)
+        consumer.deliver = deliver
+        stray = message_event(Message.objects.create(room=self.room, sender=self.user, content='2'))
+        async_to_sync(consumer.chat_message)(stray)
+        # حدث بدون message_id (مثل أدوات القياس) لا يكسر التسليم
+        async_to_sync(consumer.chat_message)(group_event('chat_message', {'type': 'message'}))
+        self.assertEqual(len(delivered), 2)
+        self.assertEqual(replay.missed_events(self.room.id, first['cursor']), [])
+
+    def test_shared_channel_layer_reads_from_db(self):
+        first = self.send('1')
+        self.send('2')
+        with self.settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}}):
+            self.assertIsNone(replay.missed_events(self.room.id, first['cursor']))
+
+    def test_buffer_dropped_without_subscribers(self):
+        first = self.send('1')
+        self.send('2')
+        replay.unsubscribe(self.room.id)
+        self.assertIsNone(replay.missed_events(self.room.id, first['cursor']))
+        replay.subscribe(self.room.id)
+
+
+class ParticipantSignalsTests(TestCase):
+    """clear() من الطرفين يحدّث عدد المشاركين ويبلغ اتصالات المستخدمين المزالين"""
+
+    def setUp(self):
+        self.owner = CustomUser.objects.create_user(email='owner@example.com', password='pass12345')
+        self.user = CustomUser.objects.create_user(email='member@example.com', password='pass12345')
+        self.rooms = [
+            ChatRoom.objects.create(name=f'group {i}', room_type='private', created_by=self.owner)
+            for i in range(2)
+        ]
+        for room in self.rooms:
+            room.participants.add(self.user, self.owner)
+
+    def participant_counts(self):
+        return [
+            RoomActivity.objects.get(room=room).participant_count for room in self.rooms
+        ]
+
+    def revoked(self, send):
+        return sorted(
+            (call.args[0], call.args[1]['room_id']) for call in send.call_args_list
+            if call.args[1]['type'] == 'membership_revoked'
+        )
+
+    def test_reverse_clear(self):
+        self.assertEqual(self.participant_counts(), [2, 2])
+        with mock.patch('chat.signals.send_to_user') as send:
+            self.user.chat_rooms.clear()
+
+        self.assertEqual(self.participant_counts(), [1, 1])
+        self.assertEqual(self.revoked(send), sorted((self.user.id, str(room.id)) for room in self.rooms))
+
+    def test_forward_clear(self):
+        with mock.patch('chat.signals.send_to_user') as send:
+            self.rooms[0].participants.clear()
+
+        self.assertEqual(self.participant_counts(), [0, 2])
+        self.assertEqual(
+            self.revoked(send),
+            sorted((user.id, str(self.rooms[0].id)) for user in (self.owner, self.user))
+        )
+
+
+class ProfileChangedTests(TestCase):
+    """profile_changed يُبث عند تغير الاسم المعروض فقط، لا مع كل حفظ للمستخدم"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='profile@example.com', password='pass12345')
+        self.user = CustomUser.objects.get(id=self.user.id)
+
+    def test_user_save_without_name_change_does_not_broadcast(self):
+        with mock.patch('chat.signals.send_to_user') as send:
+            self.user.last_login = self.user.date_joined
+            self.user.save()
+        send.assert_not_called()
+
+    def test_name_change_broadcasts_once(self):
+        profile = self.user.chat_profile
+        with mock.patch('chat.signals.send_to_user') as send:
+            profile.display_name = 'اسم جديد'
+            profile.save()
+            profile.save()
+            self.user.save()
+        send.assert_called_once_with(self.user.id, {'type': 'profile_changed', 'display_name': 'اسم جديد'})
+
+
+class CachePresenceBackendTests(TestCase):
+    """التتبع المشترك: التعديلات المتزامنة لا تضيع، والقفل المشغول يُفشل العملية"""
+
+    def setUp(self):
+        self.backend = presence.CachePresenceBackend(90)
+        self.backend.cache.clear()
+        self.addCleanup(self.backend.cache.clear)
+
+    def test_concurrent_connects_track_every_room(self):
+        rooms = [str(uuid.uuid4()) for _ in range(20)]
+        threads = [
+            threading.Thread(target=self.backend.connect, args=(i, room, f'user{i}'))
+            for i, room in enumerate(rooms)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.backend.cache.get(self.backend.rooms_key), set(rooms))
+        counts = self.backend.online_counts(rooms)
+        self.assertTrue(all(count == 1 for count in counts.values()))
+
+    def test_lock_timeout_fails_instead_of_writing(self):
+        room = str(uuid.uuid4())
+        self.backend.connect(1, room)
+        self.backend.LOCK_WAIT = 0.05
+        self.backend.cache.add(f'{self.backend._key(room)}:lock', 'other', 10)
+
+        with self.assertRaises(presence.PresenceLockTimeout):
+            self.backend.connect(2, room)
+        self.assertEqual(self.backend.online_user_ids(room), {1})
+        # قفل عامل آخر لا يُحذف
+        self.assertEqual(self.backend.cache.get(f'{self.backend._key(room)}:lock'), 'other')
+
+
+class TypingIndicatorTests(TestCase):
+    """الكتابة مرتبطة بالاتصال: إغلاق تبويب آخر لا يلغيها"""
+
+    async def test_clear_only_when_last_typing_connection_stops(self):
+        typing_indicator.set_typing('room-1', 7, 'tab-a', 'a@example.com', 'أ', True)
+        typing_indicator.set_typing('room-1', 7, 'tab-b', 'a@example.com', 'أ', True)
+        room = typing_indicator.get_room_typing('room-1')
+
+        # إغلاق تبويب لا يكتب
+        typing_indicator.clear_typing('room-1', 7, 'tab-c')
+        typing_indicator.clear_typing('room-1', 7, 'tab-a')
+        self.assertEqual(room.snapshot()['users'], [{'user': 'a@example.com', 'display_name': 'أ'}])
+
+        typing_indicator.clear_typing('room-1', 7, 'tab-b')
+        self.assertEqual(room.snapshot()['users'], [])
+        await room.task
+
+    def record(self, room_id):
+        room = typing_indicator.get_room_typing(room_id)
+        sent = []
+
+        async def broadcast(payload):
+            sent.append(sorted(user['user'] for user in payload['users']))
+
+        room.broadcast = broadcast
+        return room, sent
+
+    @override_settings(CHAT_TYPING={'TIMEOUT': 5, 'INTERVAL': 0.05})
+    async def test_new_typer_wakes_sleeping_loop(self):
+        room, sent = self.record('room-2')
+        typing_indicator.set_typing('room-2', 1, 'tab-a', 'a@x', 'a', True)
+        # المهمة بثت ثم نامت حتى انتهاء صلاحية a بعد 5 ثوانٍ
+        await asyncio.sleep(0.2)
+        typing_indicator.set_typing('room-2', 2, 'tab-b', 'b@x', 'b', True)
+        await asyncio.sleep(0.2)
+        self.assertEqual(sent, [['a@x'], ['a@x', 'b@x']])
+
+        typing_indicator.clear_typing('room-2', 1, 'tab-a')
+        typing_indicator.clear_typing('room-2', 2, 'tab-b')
+        await asyncio.wait_for(room.task, 1)
+
+    @override_settings(CHAT_TYPING={'TIMEOUT': 5, 'INTERVAL': 0.05})
+    async def test_stop_wakes_sleeping_loop(self):
+        room, sent = self.record('room-3')
+        typing_indicator.set_typing('room-3', 1, 'tab-a', 'a@x', 'a', True)
+        typing_indicator.set_typing('room-3', 2, 'tab-b', 'b@x', 'b', True)
+        await asyncio.sleep(0.2)
+        typing_indicator.clear_typing('room-3', 1, 'tab-a')
+        await asyncio.sleep(0.2)
+        self.assertEqual(sent, [['a@x', 'b@x'], ['b@x']])
+
+        typing_indicator.clear_typing('room-3', 2, 'tab-b')
+        await asyncio.wait_for(room.task, 1)
+        self.assertEqual(sent[-1], [])
+
+
+class OutboxTests(TestCase):
+    """طابور الإرسال: الدمج، وإغلاق الاتصال إذا فشل الإرسال"""
+
+    async def test_coalesced_frames_send_latest(self):
+        sent = []
+
+        async def send(text_data=None):
+            sent.append(text_data)
+
+        outbox = Outbox(send, None)
+        outbox.put('typing 1', EPHEMERAL, key='typing')
+        outbox.put('typing 2', EPHEMERAL, key='typing')
+        outbox.put('message', MESSAGE, cursor='c1')
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, ['typing 2', 'message'])
+        self.assertEqual(outbox.cursors, {None: 'c1'})
+        outbox.close()
+
+    async def test_send_failure_closes_connection(self):
+        closed = []
+
+        async def send(text_data=None):
+            raise ConnectionError('broken pipe')
+
+        async def on_error():
+            closed.append(True)
+
+        outbox = Outbox(send, None, on_error=on_error)
+        outbox.put('first')
+        await asyncio.sleep(0.01)
+        self.assertEqual(closed, [True])
+        self.assertTrue(outbox.closed)
+        # لا تتراكم إطارات بعد الفشل
+        outbox.put('second')
+        self.assertEqual(len(outbox), 0)
+
+    @override_settings(CHAT_SEND_QUEUE={'MAX_DEPTH': 3, 'MAX_BUFFER': 100})
+    async def test_full_server_buffer_keeps_frames_in_bounded_queue(self):
+        sent, overflow = [], []
+        buffered = [0]
+
+        async def send(text_data=None):
+            sent.append(text_data)
+            # daphne لا ينتظر - الإطار يبقى في مخزن Twisted
+            buffered[0] += 60
+
+        async def on_overflow(cursors):
+            overflow.append(cursors)
+
+        outbox = Outbox(send, on_overflow, write_buffer=lambda: buffered[0])
+        for i in range(2):
+            outbox.put(f'message {i}', MESSAGE, cursor=f'c{i}')
+        await asyncio.sleep(0.01)
+        # المخزن تجاوز MAX_BUFFER بعد الإطار الثاني
+        self.assertEqual(sent, ['message 0', 'message 1'])
+        for i in range(2, 5):
+            outbox.put(f'message {i}', MESSAGE, cursor=f'c{i}')
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(len(outbox), 3)
+        self.assertEqual(outbox_metrics()['blocked_connections'], 1)
+
+        # الطابور ممتلئ برسائل - سياسة disconnect مع آخر مؤشر وصل للعميل
+        outbox.put('message 5', MESSAGE, cursor='c5')
+        await asyncio.sleep(0.01)
+        self.assertEqual(overflow, [{None: 'c1'}])
+
+    @override_settings(CHAT_SEND_QUEUE={'MAX_BUFFER': 100})
+    async def test_sending_resumes_when_buffer_drains(self):
+        sent = []
+        buffered = [500]
+
+        async def send(text_data=None):
+            sent.append(text_data)
+
+        outbox = Outbox(send, None, write_buffer=lambda: buffered[0])
+        outbox.put('message')
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, [])
+        buffered[0] = 0
+        await asyncio.sleep(0.1)
+        self.assertEqual(sent, ['message'])
+        outbox.close()
+
+
+class WriteBufferServerTests(TestCase):
+    """daphne مع قياس مخزن الكتابة في scope اتصالات WebSocket"""
+
+    def test_buffered_bytes_through_tls_wrapper(self):
+        tcp = mock.Mock(spec=['dataBuffer', 'offset', '_tempDataLen'])
+        tcp.dataBuffer, tcp.offset, tcp._tempDataLen = b'x' * 100, 40, 25
+        tls = mock.Mock(spec=['transport'])
+        tls.transport = tcp
+        self.assertEqual(server.buffered_bytes(tls), 85)
+        self.assertEqual(server.buffered_bytes(None), 0)
+
+    def test_websocket_scope_gets_probe(self):
+        protocol = mock.Mock()
+        protocol.transport.dataBuffer, protocol.transport.offset, protocol.transport._tempDataLen = b'abc', 0, 0
+        protocol.transport.transport = None
+        instance = server.WriteBufferServer.__new__(server.WriteBufferServer)
+        scopes = []
+        with mock.patch.object(server.Server, 'create_application', lambda self, p, scope: scopes.append(scope)):
+            instance.create_application(protocol, {'type': 'websocket'})
+            instance.create_application(protocol, {'type': 'http'})
+
+        self.assertEqual(write_buffer_probe(scopes[0])(), 3)
+        self.assertIsNone(write_buffer_probe(scopes[1]))
+
+
+class BenchFanoutTests(TestCase):
+    """أداة قياس البث تعمل مع معالج chat_message الحالي"""
+
+    def test_bench_fanout_runs(self):
+        output = io.StringIO()
+        call_command('bench_fanout', connections=[10], repeat=1, stdout=output)
+        self.assertIn('10', output.getvalue().splitlines()[-1])
+
+
+class ResumeTokenTests(TestCase):
+    """رمز الاستئناف عند إيقاف العملية صالح فقط لنفس المستخدم وبدون تعديل"""
+
+    def test_round_trip(self):
+        token = drain.make_resume_token(7, {'room:abc': 'cursor'})
+        self.assertEqual(drain.read_resume_token(token, 7), {'room:abc': 'cursor'})
+
+    def test_rejects_other_user_and_tampering(self):
+        token = drain.make_resume_token(7, {'room:abc': 'cursor'})
+        self.assertIsNone(drain.read_resume_token(token, 8))
+        self.assertIsNone(drain.read_resume_token(token[:-2] + 'xx', 7))
+
+    @override_settings(CHAT_DRAIN={'RETRY_AFTER_MIN': 2, 'RETRY_AFTER_MAX': 4})
+    def test_retry_after_is_spread(self):
+        values = {drain.retry_after() for _ in range(50)}
+        self.assertTrue(all(2 <= value <= 4 for value in values))
+        self.assertGreater(len(values), 1)
+
+
+@override_settings(CHAT_WRITE_BEHIND={'ENABLED': True, 'BATCH_SIZE': 2, 'FLUSH_INTERVAL': 10})
+class WriteBehindDrainTests(TransactionTestCase):
+    """الإيقاف بين الإضافة للطابور والحفظ لا يفقد رسائل ولا يحفظها مرتين"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='writer@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='write-behind', room_type='public', created_by=self.user)
+        self.addCleanup(setattr, drain, '_draining', False)
+        self.addCleanup(writebehind._writers.clear)
+
+    def build(self, count):
+        return [
+            Message(id=uuid.uuid4(), room_id=self.room.id, sender=self.user, content=f'مؤجلة {i}')
+            for i in range(count)
+        ]
+
+    @database_sync_to_async
+    def saved_seqs(self):
+        return list(Message.objects.filter(room=self.room).values_list('seq', flat=True))
+
+    async def test_drain_saves_pending_and_queued_messages(self):
+        writer = writebehind.get_writer()
+        for message in self.build(3):
+            await writer.enqueue(message)
+        # المهمة تجمع دفعة وتنتظر المهلة الطويلة
+        await asyncio.sleep(0.05)
+        self.assertTrue(writer._pending)
+
+        await drain.drain()
+        self.assertEqual(sorted(await self.saved_seqs()), [1, 2, 3])
+
+    async def test_drain_during_save_does_not_save_twice(self):
+        real_save = writebehind.save_batch
+        saved = []
+
+        def slow_save(batch):
+            time.sleep(0.2)
+            saved.extend(message.id for message in batch)
+            return real_save(batch)
+
+        writer = writebehind.get_writer()
+        writer.flush_interval = 0.01
+        messages = self.build(3)
+        with mock.patch.object(writebehind, 'save_batch', slow_save):
+            for message in messages:
+                await writer.enqueue(message)
+            while writer._saving is None:
+                await asyncio.sleep(0.01)
+            await drain.drain()
+
+        self.assertEqual(sorted(saved), sorted(message.id for message in messages))
+        self.assertEqual(sorted(await self.saved_seqs()), [1, 2, 3])
+        # بعد الإيقاف: حفظ مباشر بدون طابور
+        await writer.enqueue(self.build(1)[0])
+        self.assertEqual(len(await self.saved_seqs()), 4)
+
+
+@override_settings(CHAT_WRITE_BEHIND={'FLUSH_INTERVAL': 10})
+class ConsumerSaveTests(TransactionTestCase):
+    """حفظ رسالة المستهلك: حجز seq والإدراج فقط، والباقي على دفعات بعد البث"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='saver@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='save path', room_type='public', created_by=self.user)
+        self.addCleanup(setattr, drain, '_draining', False)
+        self.addCleanup(writebehind._writers.clear)
+
+    def consumer(self):
+        consumer = ChatConsumer()
+        consumer.room = self.room
+        consumer.user = self.user
+        return consumer
+
+    def test_save_is_seq_update_and_insert(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            message = async_to_sync(self.consumer().save_message)('مرحبا بالجميع')
+        statements = [
+            query['sql'] for query in queries.captured_queries
+            if not query['sql'].startswith(('BEGIN', 'COMMIT', 'SAVEPOINT', 'RELEASE SAVEPOINT'))
+        ]
+        self.assertEqual(len(statements), 2, statements)
+        self.assertTrue(statements[0].startswith('UPDATE') and 'RETURNING' in statements[0])
+        self.assertTrue(statements[1].startswith('INSERT'))
+        self.assertEqual(message.seq, 1)
+
+        # العدادات والفهرس تنتظر الدفعة
+        self.assertEqual(RoomActivity.objects.get(room=self.room).message_count, 0)
+        self.assertEqual(search.search_messages(self.user, 'مرحبا')[0], [])
+        writebehind.record_saved([message])
+        activity = RoomActivity.objects.get(room=self.room)
+        self.assertEqual((activity.message_count, activity.last_message_id), (1, message.id))
+        self.assertEqual([m.id for m in search.search_messages(self.user, 'مرحبا')[0]], [message.id])
+
+    async def test_sent_message_recorded_on_drain(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/room/{self.room.id}/'
+        )
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'type': 'message', 'message': 'رسالة فورية'})
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get('type') == 'message':
+                break
+        count = await database_sync_to_async(
+            lambda: RoomActivity.objects.get(room=self.room).message_count
+        )()
+        self.assertEqual(count, 0)
+
+        # المهلة طويلة - الدفعة تُطبق في مسار التفريغ
+        await drain.drain()
+        count = await database_sync_to_async(
+            lambda: RoomActivity.objects.get(room=self.room).message_count
+        )()
+        self.assertEqual(count, 1)
+        results, _ = await database_sync_to_async(search.search_messages)(self.user, 'فورية')
+        self.assertEqual([m.content for m in results], ['رسالة فورية'])
+        await communicator.disconnect()
+
+
+class MessageCacheTests(TestCase):
+    """نافذة الرسائل في الذاكرة: بدون استعلام رسائل عند الإصابة، ومع فلترة الرسائل المخفية"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='cache@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='other@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='cache', room_type='public', created_by=self.user)
+        self.client.force_login(self.user)
+
+    def send(self, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(room=self.room, sender=self.other, content=content)
+
+    def test_hit_skips_message_queries_and_sees_new_writes(self):
+        self.send('1')
+        url = f'/chat/messages/{self.room.id}/?limit=50'
+        self.client.get(url)
+
+        # الجلسة + المستخدم + الغرفة مع last_seq + الرسائل المخفية للمستخدم
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['1'])
+        cursor = response.json()['next_cursor']
+
+        self.send('2')
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/chat/messages/{self.room.id}/?after={cursor}')
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['2'])
+
+    def test_hidden_messages_filtered_per_user(self):
+        hidden = self.send('مخفية')
+        self.send('ظاهرة')
+        hiding.hide_messages(self.user, self.room.id, [hidden.id])
+
+        response = self.client.get(f'/chat/messages/{self.room.id}/?limit=50')
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['ظاهرة'])
+        self.client.force_login(self.other)
+        response = self.client.get(f'/chat/messages/{self.room.id}/?limit=50')
+        self.assertEqual(len(response.json()['messages']), 2)
+
+    def test_size_based_eviction(self):
+        cache = message_cache.MessageCache(window=10, max_bytes=3 * message_cache.ENTRY_OVERHEAD)
+        messages = [self.send(str(i)) for i in range(2)]
+        entries = message_cache.build_entries(messages)
+        cache.put('a', message_cache.RoomWindow(entries, 2, True))
+        cache.put('b', message_cache.RoomWindow(entries, 2, True))
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+
+
+
+class HiddenMessagesTests(TestCase):
+    """حذف لدي ومسح المحادثة: صف واحد لكل (مستخدم، غرفة)"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='hide@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='hide2@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='hide', room_type='public', created_by=self.user)
+        self.room.participants.add(self.user, self.other)
+        self.client.force_login(self.user)
+
+    def send(self, content):
+        return Message.objects.create(room=self.room, sender=self.other, content=content)
+
+    def contents(self, user):
+        self.client.force_login(user)
+        response = self.client.get(f'/chat/messages/{self.room.id}/?limit=50')
+        return [m['message'] for m in response.json()['messages']]
+
+    def test_clear_history_is_one_write_and_keeps_new_messages(self):
+        read = self.send('مقروءة')
+        ReadReceipt.objects.create(
+            user=self.user, room=self.room, last_read_at=read.timestamp, last_read_message_id=read.id
+        )
+        for i in range(20):
+            self.send(str(i))
+        hiding.hide_messages(self.user, self.room.id, [self.send('20').id])
+
+        # قراءة صف النشاط داخل UPDATE واحد مهما كان عدد الرسائل
+        with self.assertNumQueries(1):
+            hiding.clear_history(self.user, self.room.id)
+        self.assertEqual(hiding.get_state(self.user, self.room.id).seqs, frozenset())
+
+        self.send('بعد المسح')
+        self.assertEqual(self.contents(self.user), ['بعد المسح'])
+        self.assertEqual(len(self.contents(self.other)), 23)
+        # الرسائل الممسوحة لا تُحسب غير مقروءة
+        self.assertEqual(get_unread_counts(self.user)[str(self.room.id)], 1)
+
+    def test_hide_message_endpoint_and_sync(self):
+        first = self.send('أولى')
+        self.send('ثانية')
+        response = self.client.post(f'/chat/message/{first.id}/hide/')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.contents(self.user), ['ثانية'])
+        self.client.force_login(self.user)
+        events = self.client.get(f'/chat/sync/{self.room.id}/?after_seq=0').json()['events']
+        self.assertEqual([event['message'] for event in events], ['ثانية'])
+
+    def test_clear_endpoint_rejects_outsiders(self):
+        private = ChatRoom.objects.create(name='p', room_type='private', created_by=self.other)
+        response = self.client.post(f'/chat/clear/{private.id}/')
+        self.assertEqual(response.status_code, 403)
+
+
+class MessageSearchTests(TestCase):
+    """البحث في الرسائل من الفهرس النصي مع تطبيع العربية والصلاحيات"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='search@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='search2@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='بحث', room_type='public', created_by=self.other)
+        self.client.force_login(self.user)
+
+    def send(self, content, room=None):
+        return Message.objects.create(room=room or self.room, sender=self.other, content=content)
+
+    def search(self, q, **params):
+        response = self.client.get('/chat/search/', {'q': q, **params})
+        return [m['message'] for m in response.json()['messages']]
+
+    def test_normalize_arabic_variants(self):
+        self.assertEqual(search.normalize('إِنَّ المَدرسةَ الكُبرى'), 'ان المدرسه الكبري')
+        self.assertEqual(search.normalize('أحـــمد ٣٤'), 'احمد 34')
+
+    def test_search_matches_normalized_prefixes_newest_first(self):
+        self.send('ذهبتُ إلى المدرسة')
+        self.send('مدرسة جديدة في الحي')
+        self.send('لا علاقة')
+
+        self.assertEqual(self.search('مدرسه'), ['مدرسة جديدة في الحي'])
+        self.assertEqual(self.search('المدرس'), ['ذهبتُ إلى المدرسة'])
+        self.assertEqual(self.search('الى'), ['ذهبتُ إلى المدرسة'])
+        self.assertEqual(self.search('مدرسة جديدة'), ['مدرسة جديدة في الحي'])
+
+    def test_respects_can_join_and_hidden_messages(self):
+        private = ChatRoom.objects.create(name='سري', room_type='private', created_by=self.other)
+        self.send('تقرير سري', room=private)
+        hidden = self.send('تقرير مخفي')
+        self.send('تقرير عام')
+        hiding.hide_messages(self.user, self.room.id, [hidden.id])
+
+        self.assertEqual(self.search('تقرير'), ['تقرير عام'])
+        self.assertEqual(self.search('تقرير', room=str(self.room.id)), ['تقرير عام'])
+        response = self.client.get('/chat/search/', {'q': 'تقرير', 'room': str(private.id)})
+        self.assertEqual(response.status_code, 403)
+
+        private.participants.add(self.user)
+        self.assertEqual(self.search('تقرير'), ['تقرير عام', 'تقرير سري'])
+
+    def test_index_follows_edits_deletes_and_bulk_inserts(self):
+        message = self.send('نص قديم')
+        sequence.edit_message(message, 'نص جديد')
+        self.assertEqual(self.search('قديم'), [])
+        self.assertEqual(self.search('جديد'), ['نص جديد'])
+
+        message.delete()
+        self.assertEqual(self.search('جديد'), [])
+
+        batch = [Message(room=self.room, sender=self.other, content=f'دفعة {i}') for i in range(3)]
+        assign_seqs(batch)
+        Message.objects.bulk_create(batch)
+        messages_bulk_created.send(sender=Message, messages=batch)
+        self.assertEqual(len(self.search('دفعه')), 3)
+
+    def test_paginates_with_before_cursor(self):
+        for i in range(5):
+            self.send(f'صفحة {i}')
+        first = self.client.get('/chat/search/', {'q': 'صفحة', 'limit': 3}).json()
+        self.assertTrue(first['has_more'])
+        second = self.client.get('/chat/search/', {'q': 'صفحة', 'before': first['next_cursor']}).json()
+        self.assertEqual(
+            [m['message'] for m in first['messages'] + second['messages']],
+            [f'صفحة {i}' for i in reversed(range(5))]
+        )
+
+
+class RoomSearchTests(TestCase):
+    """بحث دليل الغرف من الفهرس مع نتائج محفوظة لكل نص مطبّع"""
+
+    def setUp(self):
+        directory.invalidate()
+        self.user = CustomUser.objects.create_user(email='rooms@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='rooms2@example.com', password='pass12345')
+        self.client.force_login(self.user)
+
+    def create_room(self, name, room_type='public', messages=0):
+        room = ChatRoom.objects.create(name=name, room_type=room_type, created_by=self.other)
+        for i in range(messages):
+            Message.objects.create(room=room, sender=self.other, content=str(i))
+        return room
+
+    def search(self, q):
+        return [room['name'] for room in self.client.get('/chat/search-rooms/', {'q': q}).json()]
+
+    def test_prefix_match_ranked_by_activity(self):
+        self.create_room('مكتبة المدينة', messages=1)
+        self.create_room('المكتبة الكبرى', messages=3)
+        self.create_room('رياضة')
+        self.assertEqual(self.search('مكتبه'), ['مكتبة المدينة'])
+        self.assertEqual(self.search('المكت'), ['المكتبة الكبرى'])
+        self.assertEqual(self.search('ال'), ['المكتبة الكبرى', 'مكتبة المدينة'])
+
+    def test_cached_per_normalized_query_and_filtered_per_user(self):
+        self.create_room('أخبار')
+        private = self.create_room('أخبار خاصة', room_type='private')
+        self.assertEqual(self.search('اخبار'), ['أخبار'])
+
+        # نفس النص بعد التطبيع من الذاكرة: الجلسة + المستخدم + غرف المستخدم المطابقة
+        private.participants.add(self.user)
+        with self.assertNumQueries(3):
+            names = self.search('إِخبار')
+        self.assertEqual(sorted(names), ['أخبار', 'أخبار خاصة'])
+
+    @override_settings(CHAT_ROOM_DIRECTORY={'CANDIDATES': 2, 'RESULTS': 3})
+    def test_member_rooms_beyond_candidates_are_merged(self):
+        for i in range(3):
+            self.create_room(f'أخبار عامة {i}', messages=i + 1)
+        mine = self.create_room('أخبار الفريق', room_type='private')
+        mine.participants.add(self.user)
+        self.create_room('أخبار سرية', room_type='private')
+        directory.invalidate()
+
+        # أفضل غرفتين عامتين فقط في القائمة المشتركة، وغرفة المستخدم الخاصة بعدها
+        self.assertEqual(self.search('اخبار'), ['أخبار عامة 2', 'أخبار عامة 1', 'أخبار الفريق'])
+
+    def test_rename_invalidates_results(self):
+        room = self.create_room('قديم')
+        self.assertEqual(self.search('قديم'), ['قديم'])
+        room.name = 'جديد'
+        room.save()
+        self.assertEqual(self.search('قديم'), [])
+        self.assertEqual(self.search('جديد'), ['جديد'])
+
+
+@override_settings(CHAT_ROOM_DIRECTORY={'REFRESH': 3600})
+class RoomDirectoryTests(TestCase):
+    """دليل الغرف العامة: ترتيبات من لقطة محسوبة مسبقاً ومؤشرات ثابتة"""
+
+    def setUp(self):
+        directory.invalidate()
+        self.user = CustomUser.objects.create_user(email='dir@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='dir2@example.com', password='pass12345')
+        self.client.force_login(self.user)
+        self.rooms = [
+            ChatRoom.objects.create(name=f'عامة {i}', room_type='public', created_by=self.other)
+            for i in range(5)
+        ]
+        ChatRoom.objects.create(name='خاصة', room_type='private', created_by=self.other)
+
+    def page(self, **params):
+        return self.client.get('/chat/directory/', params).json()
+
+    def names(self, sort):
+        names, cursor = [], None
+        while True:
+            data = self.page(sort=sort, limit=2, **({'cursor': cursor} if cursor else {}))
+            names += [room['name'] for room in data['rooms']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return names
+
+    def test_newest_pages_cover_public_rooms_once(self):
+        self.assertEqual(self.names('newest'), [f'عامة {i}' for i in reversed(range(5))])
+
+    def test_active_ranks_by_recent_messages(self):
+        self.page(sort='active')
+        for _ in range(3):
+            Message.objects.create(room=self.rooms[1], sender=self.other, content='.')
+        Message.objects.create(room=self.rooms[3], sender=self.other, content='.')
+        directory.invalidate()
+        self.assertEqual(self.names('active')[:2], ['عامة 1', 'عامة 3'])
+
+    def test_online_ranking_and_cursor_survives_refresh(self):
+        self.rooms[2].add_online_user(self.user)
+        self.rooms[2].add_online_user(self.other)
+        self.rooms[4].add_online_user(self.other)
+        directory.invalidate()
+        first = self.page(sort='online', limit=2)
+        self.assertEqual([room['name'] for room in first['rooms']], ['عامة 2', 'عامة 4'])
+        self.assertEqual(first['rooms'][0]['online_count'], 2)
+
+        # لقطة جديدة بغرفة إضافية - الصفحة التالية تكمل بعد آخر غرفة عُرضت
+        ChatRoom.objects.create(name='جديدة', room_type='public', created_by=self.other)
+        second = self.page(sort='online', limit=10, cursor=first['next_cursor'])
+        names = [room['name'] for room in second['rooms']]
+        self.assertNotIn('عامة 2', names)
+        self.assertEqual(len(names), 4)
+
+    def test_invalid_cursor_and_sort(self):
+        cursor = self.page(sort='newest', limit=2)['next_cursor']
+        self.assertEqual(self.client.get('/chat/directory/', {'sort': 'active', 'cursor': cursor}).status_code, 400)
+        self.assertEqual(self.client.get('/chat/directory/', {'sort': 'x'}).status_code, 400)
+
+    def test_cursor_with_wrong_key_length(self):
+        self.page(sort='online', limit=2)
+        for sort, key in [('online', [0, 'x']), ('active', [0, 0, 0, 'x']), ('newest', ['x'])]:
+            cursor = directory.encode_directory_cursor(sort, key)
+            response = self.client.get('/chat/directory/', {'sort': sort, 'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+    def test_home_page_does_not_embed_public_rooms(self):
+        response = self.client.get('/chat/')
+        self.assertNotContains(response, 'عامة 3')
+
+    def test_general_room_looked_up_once(self):
+        self.client.get('/chat/')
+        self.assertEqual(ChatRoom.objects.filter(name=directory.GENERAL_ROOM_NAME).count(), 1)
+        with mock.patch.object(ChatRoom.objects, 'get_or_create', wraps=ChatRoom.objects.get_or_create) as lookup:
+            self.client.get('/chat/')
+        lookup.assert_not_called()
+
+        # حذف الغرفة يبطل النسخة المحفوظة
+        ChatRoom.objects.filter(name=directory.GENERAL_ROOM_NAME).get().delete()
+        self.client.get('/chat/')
+        self.assertEqual(ChatRoom.objects.filter(name=directory.GENERAL_ROOM_NAME).count(), 1)
+
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CHAT_IMAGES={'WORKERS': 0})
+class ImagePipelineTests(TestCase):
+    """أحجام الصورة تُنشأ بعد الحفظ وتُرجع في get_messages"""
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='img@example.com', password='pass12345')
+        self.client.force_login(self.user)
+        self.room = ChatRoom.objects.create(name='صور', room_type='public', created_by=self.user)
+
+    def upload(self, size, mode='RGB', image_format='PNG'):
+        buffer = io.BytesIO()
+        Image.new(mode, size, 'red').save(buffer, image_format)
+        upload = SimpleUploadedFile(f'photo.{image_format.lower()}', buffer.getvalue())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/chat/send-image/{self.room.id}/', {'image': upload})
+        self.assertEqual(response.json()['status'], 'success')
+        return Message.objects.get(id=response.json()['message_id'])
+
+    def test_variants_written_without_upscaling(self):
+        message = self.upload((1000, 500))
+        meta = message.image_meta
+        self.assertEqual((meta['width'], meta['height']), (1000, 500))
+        self.assertTrue(meta['placeholder'].startswith('data:image/jpeg;base64,'))
+        self.assertEqual(
+            {name: (entry['width'], entry['height']) for name, entry in meta['variants'].items()},
+            {'small': (320, 160), 'medium': (800, 400), 'large': (1000, 500)}
+        )
+        for entry in meta['variants'].values():
+            for extension in ('webp', 'jpeg'):
+                self.assertTrue(os.path.exists(os.path.join(MEDIA_ROOT, entry[extension])))
+
+    def test_small_image_and_transparency(self):
+        message = self.upload((200, 100), mode='RGBA')
+        self.assertEqual(list(message.image_meta['variants']), ['small'])
+        self.assertEqual(message.image_data()['src'], message.image_data()['variants']['small']['jpeg'])
+
+    def test_get_messages_returns_srcset_and_bumps_seq(self):
+        message = self.upload((1000, 500))
+        self.assertGreater(message.changed_seq, message.seq)
+        data = self.client.get(f'/chat/messages/{self.room.id}/', {'limit': 50}).json()['messages'][-1]
+        self.assertEqual(data['image']['width'], 1000)
+        self.assertIn('320w', data['image']['srcset']['webp'])
+        self.assertTrue(data['image']['src'].endswith('/medium.jpeg'))
+        self.assertIn('image_url', data)
+
+        events, _, _ = sequence.sync_events(self.room, self.user, message.seq)
+        self.assertEqual([(event['type'], event['seq']) for event in events], [('edit', message.changed_seq)])
+        self.assertEqual(events[0]['image']['height'], 500)
+
+    def test_corrupt_image_keeps_original(self):
+        upload = SimpleUploadedFile('broken.png', b'not an image')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/chat/send-image/{self.room.id}/', {'image': upload})
+        message = Message.objects.get(id=response.json()['message_id'])
+        self.assertIsNone(message.image_meta)
+        self.assertIsNone(message.image_data())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CHAT_IMAGES={'WORKERS': 1})
+class ImagePoolTests(TransactionTestCase):
+    """نتيجة مجموعة العمليات تُحفظ وتُبث عبر event loop الخادم وليس thread المجموعة"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='pool@example.com', password='pass12345')
+        self.room = ChatRoom.objects.create(name='pool', room_type='public', created_by=self.user)
+        self.addCleanup(self.shutdown_pool)
+
+    def shutdown_pool(self):
+        if images._executor is not None:
+            images._executor.shutdown()
+            images._executor = None
+
+    def create_image_message(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 200), 'blue').save(buffer, 'PNG')
+        return Message.objects.create(
+            room=self.room,
+            sender=self.user,
+            message_type='image',
+            image=SimpleUploadedFile('pool.png', buffer.getvalue())
+        )
+
+    async def test_result_is_broadcast_on_server_loop(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(room_group_name(self.room.id), channel)
+
+        # نفس مسار العرض المتزامن: on_commit داخل thread من sync_to_async
+        message = await database_sync_to_async(self.create_image_message)()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        event = await asyncio.wait_for(layer.receive(channel), 10)
+        while event['type'] != 'message_changed':
+            event = await asyncio.wait_for(layer.receive(channel), 10)
+
+        self.assertEqual(event['message_id'], str(message.id))
+        # الـ loop أُوقظ مباشرة وليس بعد انتهاء مهلة انتظار
+        self.assertLess(loop.time() - started, 5)
+        saved = await database_sync_to_async(Message.objects.get)(id=message.id)
+        self.assertEqual(saved.image_meta['width'], 400)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CHAT_UPLOADS={'CHUNK_SIZE': 4, 'MAX_CHUNK': 8, 'MAX_SIZE': 64})
+class ChunkedUploadTests(TestCase):
+    """رفع على أجزاء: الاستئناف من الموقع المحفوظ ورسالة واحدة عند الإنهاء"""
+
+    CONTENT = b'0123456789abcdef'
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='upload@example.com', password='pass12345')
+        self.client.force_login(self.user)
+        self.room = ChatRoom.objects.create(name='ملفات', room_type='public', created_by=self.user)
+        response = self.client.post(
+            f'/chat/upload/start/{self.room.id}/',
+            {'file_name': '../تقرير نهائي.pdf', 'size': len(self.CONTENT)},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.upload_id = response.json()['upload_id']
+        self.url = f'/chat/upload/{self.upload_id}/'
+
+    def put(self, offset, data):
+        return self.client.put(f'{self.url}?offset={offset}', data, content_type='application/octet-stream')
+
+    def complete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'{self.url}complete/')
+
+    def test_resume_retry_and_complete(self):
+        self.assertEqual(self.put(0, self.CONTENT[:8]).json()['offset'], 8)
+        # جزء بعد فجوة - الخادم يُرجع الموقع الصحيح
+        response = self.put(12, self.CONTENT[12:])
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 8))
+        # إعادة آخر جزء بعد فقد الرد
+        self.assertEqual(self.put(4, self.CONTENT[4:8]).json()['offset'], 8)
+        self.assertEqual(self.client.get(self.url).json()['offset'], 8)
+        self.assertEqual(self.put(8, self.CONTENT[8:]).json()['offset'], 16)
+
+        response = self.complete()
+        self.assertEqual(response.status_code, 201)
+        message = Message.objects.get(id=response.json()['message_id'])
+        self.assertEqual((message.message_type, message.file_name), ('file', 'تقرير_نهائي.pdf'))
+        with message.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.CONTENT)
+        self.assertFalse(os.path.exists(uploads.part_path(FileUpload.objects.get(id=self.upload_id))))
+
+        # إعادة الإنهاء لا تنشئ رسالة ثانية
+        again = self.complete()
+        self.assertEqual((again.status_code, again.json()['message_id']), (200, str(message.id)))
+        self.assertEqual(Message.objects.filter(room=self.room, message_type='file').count(), 1)
+        self.assertEqual(self.put(0, b'x').status_code, 400)
+
+    def test_incomplete_and_limits(self):
+        self.put(0, self.CONTENT[:4])
+        response = self.complete()
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 4))
+        self.assertEqual(self.put(4, self.CONTENT[4:13]).status_code, 400)
+        self.assertFalse(Message.objects.filter(room=self.room).exists())
+
+        too_big = self.client.post(
+            f'/chat/upload/start/{self.room.id}/',
+            {'file_name': 'big.mp4', 'size': 65},
+            content_type='application/json'
+        )
+        self.assertEqual(too_big.status_code, 400)
+
+    def test_overlapping_writes_keep_disk_and_row_in_sync(self):
+        # طلبان قرآ الرفع قبل أن يكتب أي منهما
+        first = FileUpload.objects.get(id=self.upload_id)
+        second = FileUpload.objects.get(id=self.upload_id)
+        uploads.write_chunk(first, 0, io.BytesIO(self.CONTENT[:8]), 8)
+        # إعادة الجزء الأول بعد فقد الرد - الموقع يُقرأ من جديد تحت القفل
+        self.assertEqual(uploads.write_chunk(second, 0, io.BytesIO(self.CONTENT[:4]), 4), 4)
+        upload = FileUpload.objects.get(id=self.upload_id)
+        self.assertEqual(upload.received, 4)
+        self.assertEqual(os.path.getsize(uploads.part_path(upload)), 4)
+
+        with self.assertRaises(uploads.OffsetConflict) as conflict:
+            uploads.write_chunk(first, 8, io.BytesIO(self.CONTENT[8:]), 8)
+        self.assertEqual(conflict.exception.offset, 4)
+
+    def test_failed_complete_keeps_upload_resumable(self):
+        self.put(0, self.CONTENT[:8])
+        self.put(8, self.CONTENT[8:])
+        files_dir = os.path.join(MEDIA_ROOT, 'chat_files')
+        os.makedirs(files_dir, exist_ok=True)
+        before = set(os.listdir(files_dir))
+        with mock.patch.object(Message.objects, 'create', side_effect=RuntimeError('db down')):
+            self.assertEqual(self.complete().status_code, 500)
+        upload = FileUpload.objects.get(id=self.upload_id)
+        self.assertEqual(os.path.getsize(uploads.part_path(upload)), len(self.CONTENT))
+        self.assertEqual(set(os.listdir(files_dir)), before)
+
+        response = self.complete()
+        self.assertEqual(response.status_code, 201)
+        with Message.objects.get(id=response.json()['message_id']).file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.CONTENT)
+
+    def test_other_user_cannot_write(self):
+        other = CustomUser.objects.create_user(email='upload2@example.com', password='pass12345')
+        self.client.force_login(other)
+        self.assertEqual(self.put(0, self.CONTENT[:4]).status_code, 404)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_expire_removes_stale_uploads(self):
+        upload = FileUpload.objects.get(id=self.upload_id)
+        FileUpload.objects.filter(id=upload.id).update(updated_at=upload.updated_at - timedelta(days=2))
+        self.assertEqual(uploads.expire_uploads(), 1)
+        self.assertFalse(os.path.exists(uploads.part_path(upload)))
+
+
+class MultiplexConsumerTests(TransactionTestCase):
+    """اتصال ws/chat/mux/ واحد لعدة غرف: اشتراك، إطارات لكل قناة، إلغاء، إغلاق"""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email='mux@example.com', password='pass12345')
+        self.other = CustomUser.objects.create_user(email='mux2@example.com', password='pass12345')
+        self.first = ChatRoom.objects.create(name='mux 1', room_type='public', created_by=self.other)
+        self.second = ChatRoom.objects.create(name='mux 2', room_type='public', created_by=self.other)
+        self.private = ChatRoom.objects.create(name='mux خاصة', room_type='private', created_by=self.other)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(multiplex.MultiplexConsumer.as_asgi(), '/ws/chat/mux/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def next_frame(self, communicator, stream, kind):
+        """أول إطار من القناة بهذا النوع (تُتجاوز إطارات أخرى مثل user_joined)"""
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            if frame.get('stream') == stream and frame['payload']['type'] == kind:
+                return frame['payload']
+
+    async def subscribe(self, communicator, room):
+        stream = f'room:{room.id}'
+        await communicator.send_json_to({'action': 'subscribe', 'stream': stream})
+        await self.next_frame(communicator, stream, 'subscribed')
+        return stream
+
+    async def publish(self, room, content):
+        message = await database_sync_to_async(Message.objects.create)(room=room, sender=self.other, content=content)
+        await get_channel_layer().group_send(room_group_name(room.id), message_event(message, 'other'))
+        return message
+
+    async def test_frames_routed_per_room(self):
+        communicator = await self.connect()
+        first = await self.subscribe(communicator, self.first)
+        second = await self.subscribe(communicator, self.second)
+
+        sent = await self.publish(self.second, 'في الثانية')
+        payload = await self.next_frame(communicator, second, 'message')
+        self.assertEqual(payload['message_id'], str(sent.id))
+
+        # رسالة من العميل على قناة الغرفة الأولى تُحفظ وتعود على نفس القناة فقط
+        await communicator.send_json_to({'stream': first, 'payload': {'type': 'message', 'message': 'مرحبا'}})
+        payload = await self.next_frame(communicator, first, 'message')
+        self.assertEqual(payload['message'], 'مرحبا')
+        self.assertTrue(await database_sync_to_async(
+            Message.objects.filter(room=self.first, content='مرحبا', sender=self.user).exists
+        )())
+        await communicator.disconnect()
+
+    async def test_unsubscribe_stops_frames(self):
+        communicator = await self.connect()
+        first = await self.subscribe(communicator, self.first)
+        second = await self.subscribe(communicator, self.second)
+        await communicator.send_json_to({'action': 'unsubscribe', 'stream': first})
+        await self.next_frame(communicator, first, 'unsubscribed')
+
+        await self.publish(self.first, 'بعد الإلغاء')
+        marker = await self.publish(self.second, 'علامة')
+        while True:
+            frame = await communicator.receive_json_from(timeout=2)
+            self.assertNotEqual(frame.get('stream'), first)
+            if frame['payload'].get('message_id') == str(marker.id):
+                break
+        await communicator.disconnect()
+
+    async def test_forbidden_room_and_close(self):
+        communicator = await self.connect()
+        stream = f'room:{self.private.id}'
+        await communicator.send_json_to({'action': 'subscribe', 'stream': stream})
+        payload = await self.next_frame(communicator, stream, 'error')
+        self.assertIn('message', payload)
+
+        await self.subscribe(communicator, self.first)
+        self.assertEqual(get_presence().online_count(self.first.id), 1)
+        await communicator.disconnect()
+        # الإغلاق يزيل المستخدم من كل قنوات الغرف
+        self.assertEqual(get_presence().online_count(self.first.id), 0)
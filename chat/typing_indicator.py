@@ -0,0 +1,161 @@
+# chat/typing_indicator.py
+"""تجميع مؤشرات الكتابة لكل غرفة بدلاً من بث حدث عند كل إطار typing
+
+- حالة الكتابة لكل مستخدم تُحفظ في الذاكرة وتنتهي تلقائياً بعد TIMEOUT
+  إذا لم يرسل العميل is_typing=False (انقطاع، إغلاق التبويب)
+- الحالة مرتبطة بالاتصال الذي أرسلها: المستخدم يبقى كاتباً ما دام أحد
+  اتصالاته يكتب، فإغلاق تبويب آخر أو الإرسال منه لا يلغي الكتابة في هذا
+- الإطارات المتكررة من نفس المستخدم لا تغير الحالة ولا تُبث
+- لقطة "من يكتب الآن" تُبث مرة واحدة على الأكثر كل INTERVAL لكل غرفة،
+  فتكلفة مؤشر الكتابة محدودة لكل غرفة مهما كان عدد الكاتبين
+
+كل عملية تبث لقطة الكاتبين المتصلين بها مع معرف العملية (source)،
+والعميل يدمج اللقطات إذا كان هناك أكثر من عملية.
+
+الإعدادات (اختيارية) في settings.CHAT_TYPING:
+    TIMEOUT: ثواني بقاء حالة الكتابة بدون إطار جديد
+    INTERVAL: أقل فترة بين لقطتين للغرفة نفسها
+"""
+import asyncio
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .broadcast import group_event, room_group_name
+from .presence import room_key
+
+DEFAULTS = {
+    'TIMEOUT': 6,
+    'INTERVAL': 0.3,
+}
+
+# معرف هذه العملية في اللقطات
+SOURCE = uuid.uuid4().hex[:12]
+
+
+def typing_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_TYPING', {})}
+
+
+class RoomTyping:
+    """الكاتبون في غرفة واحدة ومهمة البث المجمّع"""
+
+    def __init__(self, key, timeout, interval):
+        self.key = key
+        self.room = key[1]
+        self.timeout = timeout
+        self.interval = interval
+        # user_id -> [email, display_name, expires, {الاتصالات التي تكتب}]
+        self.typers = {}
+        self.dirty = False
+        self.last_sent = 0.0
+        self.task = None
+        # يوقظ المهمة النائمة حتى أقرب انتهاء صلاحية عند تغير الحالة
+        self.wake = asyncio.Event()
+
+    def update(self, user_id, connection, email, display_name, is_typing):
+        """تحديث حالة اتصال المستخدم - البث يتم لاحقاً فقط إذا تغيرت الحالة"""
+        now = time.monotonic()
+        entry = self.typers.get(user_id)
+        if is_typing:
+            if entry is None or entry[1] != display_name:
+                self.dirty = True
+            connections = entry[3] if entry is not None else set()
+            connections.add(connection)
+            self.typers[user_id] = [email, display_name, now + self.timeout, connections]
+        elif entry is not None:
+            entry[3].discard(connection)
+            if not entry[3]:
+                # آخر اتصال يكتب للمستخدم
+                del self.typers[user_id]
+                self.dirty = True
+
+        if self.dirty:
+            self.wake.set()
+        if self.dirty or self.typers:
+            self.start()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def expire(self, now):
+        expired = [user_id for user_id, entry in self.typers.items() if entry[2] <= now]
+        for user_id in expired:
+            del self.typers[user_id]
+        if expired:
+            self.dirty = True
+
+    def snapshot(self):
+        return {
+            'type': 'user_typing',
+            'source': SOURCE,
+            'users': [
+                {'user': email, 'display_name': display_name}
+                for email, display_name, _, _ in self.typers.values()
+            ]
+        }
+
+    async def _run(self):
+        """تعمل فقط ما دام هناك كاتبون أو تغيير لم يُبث"""
+        while self.typers or self.dirty:
+            self.wake.clear()
+            now = time.monotonic()
+            self.expire(now)
+            if self.dirty:
+                wait = self.last_sent + self.interval - now
+                if wait <= 0:
+                    self.dirty = False
+                    self.last_sent = now
+                    await self.broadcast(self.snapshot())
+                    continue
+            else:
+                # لا تغيير - الاستيقاظ عند أقرب انتهاء صلاحية فقط
+                wait = min(entry[2] for entry in self.typers.values()) - now
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(wait, 0))
+            except asyncio.TimeoutError:
+                pass
+
+        # الغرفة خاملة - لا حاجة للاحتفاظ بها
+        if _rooms.get(self.key) is self:
+            del _rooms[self.key]
+
+    async def broadcast(self, payload):
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            await channel_layer.group_send(
+                room_group_name(self.room),
+                group_event('user_typing', payload, room=self.room, source=SOURCE)
+            )
+        except Exception as e:
+            print(f"Error broadcasting typing state for room {self.room}: {e}")
+
+
+_rooms = {}
+
+
+def get_room_typing(room_id):
+    """مجمّع الكتابة للغرفة داخل الـ event loop الحالي"""
+    key = (asyncio.get_running_loop(), room_key(room_id))
+    room = _rooms.get(key)
+    if room is None:
+        config = typing_settings()
+        room = _rooms[key] = RoomTyping(key, config['TIMEOUT'], config['INTERVAL'])
+    return room
+
+
+def set_typing(room_id, user_id, connection, email, display_name, is_typing):
+    get_room_typing(room_id).update(user_id, connection, email, display_name, is_typing)
+
+
+def clear_typing(room_id, user_id, connection):
+    """إلغاء حالة الكتابة لهذا الاتصال (عند إرسال رسالة أو قطع الاتصال)"""
+    key = (asyncio.get_running_loop(), room_key(room_id))
+    room = _rooms.get(key)
+    if room is not None and user_id in room.typers:
+        room.update(user_id, connection, None, None, False)
@@ -0,0 +1,252 @@
+# chat/uploads.py
+"""رفع الملفات الكبيرة على أجزاء مع الاستئناف بعد انقطاع الاتصال
+
+بدلاً من request.FILES (الملف كاملاً في طلب واحد، وأي انقطاع يعني إعادة
+الرفع من البداية):
+
+1. start: إنشاء FileUpload بالاسم والحجم - يُرجع upload_id
+2. جزء بعد جزء: PUT بجسم الطلب الخام و ?offset=N - يُكتب مباشرة في ملف
+   مؤقت على القرص على دفعات (COPY_BUFFER) بدون تحميل الجزء أو الملف في الذاكرة
+3. بعد انقطاع: GET يُرجع offset (البايتات المحفوظة) والعميل يكمل منه.
+   إعادة إرسال جزء سابق (offset أقل من المحفوظ) مسموحة وتستبدل ما بعده.
+   الكتابة والإنهاء لنفس الرفع تأخذ قفلاً حصرياً (flock) على الملف المؤقت
+   وتقرأ الموقع المحفوظ بعده، فالطلبات المتداخلة تُنفذ بالتتابع
+4. complete: نقل الملف إلى chat_files/ (rename على نفس القرص) وإنشاء رسالة
+   الملف في معاملة واحدة، ثم البث بعد نجاحها. إعادة الطلب تُرجع نفس الرسالة
+
+الرفع غير المكتمل يُحذف مع ملفه بعد EXPIRE ثانية بدون نشاط.
+
+الإعدادات (اختيارية) في settings.CHAT_UPLOADS:
+    CHUNK_SIZE: حجم الجزء المقترح للعميل
+    MAX_CHUNK: أقصى حجم لجزء واحد
+    MAX_SIZE: أقصى حجم للملف
+    DIR: مجلد الملفات المؤقتة (افتراضياً MEDIA_ROOT/.uploads)
+    EXPIRE: عمر الرفع غير المكتمل بالثواني
+"""
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .broadcast import broadcast_message
+from .models import FileUpload, Message
+
+DEFAULTS = {
+    'CHUNK_SIZE': 4 * 1024 * 1024,
+    'MAX_CHUNK': 16 * 1024 * 1024,
+    'MAX_SIZE': 2 * 1024 * 1024 * 1024,
+    'DIR': None,
+    'EXPIRE': 24 * 3600,
+}
+
+# حجم القراءة من جسم الطلب والكتابة إلى القرص
+COPY_BUFFER = 64 * 1024
+
+# أقل فترة بين عمليتي حذف للرفع المنتهي
+EXPIRE_INTERVAL = 600
+
+
+def upload_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_UPLOADS', {})}
+
+
+class OffsetConflict(Exception):
+    """offset الجزء بعد آخر بايت محفوظ - العميل يكمل من offset الصحيح"""
+
+    def __init__(self, offset):
+        super().__init__(f'الموقع المتوقع {offset}')
+        self.offset = offset
+
+
+class PartFile(File):
+    """FileSystemStorage ينقل الملف (rename) بدلاً من نسخه إذا وُجد temporary_file_path"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def part_path(upload):
+    directory = upload_settings()['DIR'] or os.path.join(settings.MEDIA_ROOT, '.uploads')
+    return os.path.join(directory, f'{upload.id.hex}.part')
+
+
+def start_upload(user, room, file_name, size):
+    """إنشاء رفع جديد وملفه المؤقت الفارغ - يرفع ValueError للاسم أو الحجم غير الصالح"""
+    maybe_expire()
+    try:
+        file_name = get_valid_filename(os.path.basename(str(file_name or '')))[:255]
+    except Exception:
+        file_name = ''
+    if not file_name:
+        raise ValueError('اسم الملف غير صالح')
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise ValueError('حجم الملف غير صالح')
+    if size > upload_settings()['MAX_SIZE']:
+        raise ValueError('حجم الملف أكبر من المسموح')
+
+    upload = FileUpload.objects.create(room=room, user=user, file_name=file_name, size=size)
+    path = part_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+@contextmanager
+def locked_part(upload, mode):
+    """الملف المؤقت مع قفل حصري (flock)
+
+    الكتابة والإنهاء لنفس الرفع من طلبات أو عمليات مختلفة تنتظر بعضها، لذلك
+    الموقع المحفوظ يُقرأ من جديد بعد أخذ القفل ويطابق الملف على القرص دائماً.
+    """
+    with open(part_path(upload), mode) as part:
+        fcntl.flock(part, fcntl.LOCK_EX)
+        try:
+            yield part
+        finally:
+            fcntl.flock(part, fcntl.LOCK_UN)
+
+
+def write_chunk(upload, offset, stream, length=None):
+    """كتابة جزء من stream عند offset - يُرجع عدد البايتات المحفوظة بعده
+
+    length من Content-Length إذا كان معروفاً. انقطاع الطلب في منتصف الجزء
+    يحفظ ما وصل منه فقط، والعميل يكمل من الموقع المُرجع.
+    """
+    if upload.message_id:
+        raise ValueError('اكتمل رفع الملف')
+    if offset < 0 or offset > upload.size:
+        raise ValueError('موقع غير صالح')
+    limit = min(upload_settings()['MAX_CHUNK'], upload.size - offset)
+    if length is not None and length > limit:
+        raise ValueError('الجزء أكبر من المسموح')
+
+    remaining = limit if length is None else length
+    try:
+        with locked_part(upload, 'r+b') as part:
+            return _write_locked(upload, part, offset, stream, remaining)
+    except FileNotFoundError:
+        # نُقل الملف عند الإنهاء
+        raise ValueError('اكتمل رفع الملف')
+
+
+def _write_locked(upload, part, offset, stream, remaining):
+    current = FileUpload.objects.filter(id=upload.id).values('received', 'message_id').get()
+    if current['message_id']:
+        raise ValueError('اكتمل رفع الملف')
+    upload.received = current['received']
+    if offset > upload.received:
+        raise OffsetConflict(upload.received)
+
+    written = 0
+    part.seek(offset)
+    while remaining:
+        data = stream.read(min(COPY_BUFFER, remaining))
+        if not data:
+            break
+        part.write(data)
+        written += len(data)
+        remaining -= len(data)
+    # إعادة جزء سابق تُلغي ما بعده - الموقع التالي هو نهاية هذا الجزء
+    part.truncate()
+    part.flush()
+
+    upload.received = offset + written
+    FileUpload.objects.filter(id=upload.id).update(received=upload.received, updated_at=timezone.now())
+    return upload.received
+
+
+def complete_upload(upload):
+    """نقل الملف وإنشاء رسالته في معاملة واحدة - يُرجع (الرسالة، هل أُنشئت الآن)"""
+    try:
+        with locked_part(upload, 'rb') as part:
+            # القفل يبقى حتى نجاح المعاملة - الكتابة بعده ترى message_id
+            return _complete_locked(upload, part)
+    except FileNotFoundError:
+        # اكتمل في طلب سابق - نفس الرسالة
+        upload = FileUpload.objects.select_related('message').get(id=upload.id)
+        if upload.message_id:
+            return upload.message, False
+        raise
+
+
+def _complete_locked(upload, part):
+    path = part_path(upload)
+    stored = None
+    try:
+        with transaction.atomic():
+            upload = FileUpload.objects.select_for_update().select_related('room').get(id=upload.id)
+            if upload.message_id:
+                return upload.message, False
+            if upload.received != upload.size:
+                raise OffsetConflict(upload.received)
+
+            stored = default_storage.save(f'chat_files/{upload.file_name}', PartFile(part))
+            message = Message.objects.create(
+                room=upload.room,
+                sender=upload.user,
+                content='📎 ملف مرفق',
+                file=stored,
+                file_name=upload.file_name,
+                message_type='file'
+            )
+            upload.message = message
+            upload.save(update_fields=['message', 'updated_at'])
+            # تخزين بدون temporary_file_path نسخ الملف بدلاً من نقله
+            transaction.on_commit(lambda: _discard_part(path))
+            transaction.on_commit(lambda: broadcast_message(message))
+    except Exception:
+        if stored is not None:
+            _restore_part(stored, path)
+        raise
+    return message, True
+
+
+def _restore_part(stored, path):
+    """فشل الإنشاء بعد نقل الملف - إعادته حتى ينجح طلب الإنهاء التالي"""
+    try:
+        if not os.path.exists(path):
+            file_move_safe(default_storage.path(stored), path)
+        else:
+            default_storage.delete(stored)
+    except Exception as e:
+        print(f"Error restoring upload file {path}: {e}")
+
+
+def _discard_part(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+_last_expire = 0.0
+
+
+def expire_uploads():
+    """حذف الرفع المتوقف منذ EXPIRE ثانية مع ملفاته - يُرجع عدد المحذوف"""
+    global _last_expire
+    _last_expire = time.monotonic()
+    cutoff = timezone.now() - timedelta(seconds=upload_settings()['EXPIRE'])
+    stale = FileUpload.objects.filter(updated_at__lt=cutoff)
+    for upload in stale.filter(message__isnull=True).only('id'):
+        try:
+            os.remove(part_path(upload))
+        except FileNotFoundError:
+            pass
+    deleted, _ = stale.delete()
+    return deleted
+
+
+def maybe_expire():
+    """الحذف من مسار start_upload فقط إذا مرت الفترة"""
+    if time.monotonic() - _last_expire >= EXPIRE_INTERVAL:
+        expire_uploads()
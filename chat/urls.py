@@ -9,9 +9,22 @@ urlpatterns = [
     path('create-room/', views.create_room, name='create_room'),
     path('manage-room/<str:room_id>/', views.manage_room, name='manage_room'),
     path('messages/<str:room_id>/', views.get_messages, name='get_messages'),
+    path('stream/<str:room_id>/', views.stream_messages, name='stream_messages'),
+    path('sync/<str:room_id>/', views.sync_messages, name='sync_messages'),
+    path('message/<str:message_id>/edit/', views.edit_message, name='edit_message'),
+    path('message/<str:message_id>/delete/', views.delete_message, name='delete_message'),
+    path('message/<str:message_id>/hide/', views.hide_message, name='hide_message'),
+    path('clear/<str:room_id>/', views.clear_history, name='clear_history'),
     path('send/<str:room_id>/', views.send_message, name='send_message'),
     path('send-image/<str:room_id>/', views.send_image, name='send_image'),
+    path('upload/start/<str:room_id>/', views.start_upload, name='start_upload'),
+    path('upload/<str:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('upload/<str:upload_id>/complete/', views.complete_upload, name='complete_upload'),
     path('search-rooms/', views.search_rooms, name='search_rooms'),
+    path('search/', views.search_messages, name='search_messages'),
+    path('directory/', views.room_directory, name='room_directory'),
+    path('unread-counts/', views.unread_counts, name='unread_counts'),
+    path('metrics/', views.realtime_metrics, name='realtime_metrics'),
     path('profile/', views.user_profile, name='user_profile'),
     path('create-test-rooms/', views.create_test_rooms, name='create_test_rooms'),  # إضافة هذا
     path('old/', views.chat_home, name='room_old'),
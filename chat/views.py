@@ -1,19 +1,42 @@
 # chat/views.py
+import asyncio
+import time
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
-from django.db.models import Q, Count
+from django.db.models import Q, Count, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.contrib import messages
+from django.core.exceptions import ValidationError
 import json
-from .models import ChatRoom, Message, UserProfile, RoomInvitation, OnlineUser
+from datetime import datetime, timezone as dt_timezone
+from .models import ChatRoom, FileUpload, Message, MessageTombstone, UserProfile, RoomInvitation
+from .broadcast import broadcast_message, broadcast_message_change, room_group_name
+from .pagination import encode_cursor, messages_after, paginate_messages, parse_limit
+from .serializers import get_display_name, serialize_message, serialize_messages, with_message_relations
+from .presence import get_presence, maybe_checkpoint
+from .receipts import read_by
+from . import sequence
+from . import directory, hiding, message_cache, outbox, replay, search, uploads
+from .queries import (
+    format_unread, get_available_rooms,
+    get_unread_counts, get_user_rooms, serialize_room_summary, UNREAD_CAP
+)
 from accounts.models import CustomUser
 import uuid
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 
+# إعدادات البث عبر Server-Sent Events
+SSE_HEARTBEAT_INTERVAL = 15  # ثانية
+SSE_MAX_DURATION = 300  # إغلاق الاتصال دورياً ليعيد المتصفح الاتصال
+SSE_RETRY_MS = 3000
+
 @login_required
 def chat_home(request):
     """الصفحة الرئيسية للدردشة مع قائمة الغرف"""
@@ -26,43 +49,30 @@ def chat_home(request):
             expires_at__gt=timezone.now()
         ).count()
         
-        # إنشاء غرفة عامة افتراضية إذا لم تكن موجودة
-        general_room, created = ChatRoom.objects.get_or_create(
-            name='عام',
-            room_type='public',
-            defaults={
-                'created_by': request.user, 
-                'description': 'الغرفة العامة للدردشة'
-            }
-        )
-        
-        
-        # جلب الغرف المتاحة للمستخدم
-        available_rooms = ChatRoom.objects.filter(
-            Q(room_type='public') | 
-            Q(participants=request.user) |
-            Q(created_by=request.user)
-        ).distinct().filter(is_active=True)
+        # غرف المستخدم مع الإحصائيات (عدد ثابت من الاستعلامات) - الغرف العامة
+        # الأخرى تُحمّل من دليل الغرف صفحة بصفحة عند فتح تبويب "العامة"
+        available_rooms = list(get_available_rooms(request.user))
         
         # غرف المستخدم الخاصة (التي أنشأها)
-        user_rooms = request.user.created_rooms.all()
+        user_rooms = list(get_user_rooms(request.user))
+        
+        # الغرفة العامة الافتراضية موجودة غالباً ضمن الغرف المتاحة - وإلا من الذاكرة
+        # (تُنشأ مرة واحدة فقط إذا لم تكن موجودة)
+        general_room = next(
+            (room for room in available_rooms
+             if room.name == directory.GENERAL_ROOM_NAME and room.room_type == 'public'),
+            None
+        )
+        if general_room is None:
+            general_room, created = directory.get_general_room(request.user)
+            if created:
+                available_rooms = list(get_available_rooms(request.user))
         
         # تحضير بيانات الغرف مع الإحصائيات - بشكل آمن
         rooms_data = []
         for room in available_rooms:
             try:
-                room_data = {
-                    'id': str(room.id),
-                    'name': room.name,
-                    'description': room.description or 'لا يوجد وصف',
-                    'type': room.room_type,
-                    'created_by': room.created_by.email,
-                    'is_owner': room.created_by == request.user,
-                    'online_count': room.get_online_count(),
-                    'message_count': room.message_set.count(),
-                    'can_join': room.can_join(request.user)
-                }
-                rooms_data.append(room_data)
+                rooms_data.append(serialize_room_summary(room, request.user))
             except Exception as e:
                 print(f"Error processing room {room.id}: {e}")
                 # استمرار مع الغرف الأخرى حتى في حالة الخطأ
@@ -71,32 +81,21 @@ def chat_home(request):
         user_rooms_data = []
         for room in user_rooms:
             try:
-                room_data = {
-                    'id': str(room.id),
-                    'name': room.name,
-                    'description': room.description or 'لا يوجد وصف',
-                    'type': room.room_type,
-                    'created_by': room.created_by.email,
-                    'is_owner': True,
-                    'online_count': room.get_online_count(),
-                    'message_count': room.message_set.count(),
-                    'can_join': True
-                }
-                user_rooms_data.append(room_data)
+                user_rooms_data.append(
+                    serialize_room_summary(room, request.user, is_owner=True, can_join=True)
+                )
             except Exception as e:
                 print(f"Error processing user room {room.id}: {e}")
         
-        # الغرف العامة فقط
-        public_rooms_data = [room for room in rooms_data if room['type'] == 'public']
-        
         context = {
             'available_rooms': available_rooms,
             'user_rooms': user_rooms,
             'rooms_data_json': json.dumps(rooms_data, ensure_ascii=False),
             'user_rooms_data_json': json.dumps(user_rooms_data, ensure_ascii=False),
-            'public_rooms_data_json': json.dumps(public_rooms_data, ensure_ascii=False),
             'current_room': general_room,
             'unread_invitations_count': unread_invitations_count,  # إضافة هذا
+            # عدد الرسائل غير المقروءة لكل غرفة (محسوب ضمن استعلام الغرف)
+            'unread_counts': {room['id']: room['unread_count'] for room in rooms_data},
         }
         return render(request, 'chat/home.html', context)
         
@@ -106,7 +105,6 @@ def chat_home(request):
         return render(request, 'chat/home.html', {
             'rooms_data_json': '[]',
             'user_rooms_data_json': '[]',
-            'public_rooms_data_json': '[]',
             'available_rooms': [],
             'user_rooms': [],
             'unread_invitations_count': 0
@@ -118,39 +116,50 @@ def room_detail(request, room_id):
     """تفاصيل غرفة دردشة محددة"""
     try:
         # محاولة تحويل room_id إلى UUID أولاً
+        # activity مع الغرفة: last_seq يحدد صلاحية نافذة الرسائل في الذاكرة
+        rooms = ChatRoom.objects.select_related('activity')
         try:
             room_uuid = uuid.UUID(room_id)
-            room = get_object_or_404(ChatRoom, id=room_uuid)
+            room = get_object_or_404(rooms, id=room_uuid)
         except ValueError:
-            room = get_object_or_404(ChatRoom, name=room_id)
+            room = get_object_or_404(rooms, name=room_id)
         
         # التحقق من صلاحية الدخول
         if not room.can_join(request.user):
             messages.error(request, 'ليس لديك صلاحية للدخول إلى هذه الغرفة')
             return redirect('chat:home')
         
-        # إضافة المستخدم إلى قائمة المتصلين
-        room.add_online_user(request.user)
-        
-        # جلب آخر 100 رسالة
-        messages_list = Message.objects.filter(
-            room=room
-        ).exclude(
-            deleted_for=request.user
-        ).select_related('sender', 'reply_to').order_by('-timestamp')[:100]
+        # جلب آخر 100 رسالة - من الذاكرة للغرف النشطة
+        hidden = hiding.get_state(request.user, room.id)
+        cached = message_cache.latest_page(room, hidden, 100)
+        if cached is not None:
+            entries, has_older = cached
+            messages_list = [entry.message for entry in entries]
+        else:
+            messages_list, has_older = paginate_messages(
+                hidden.filter(
+                    Message.objects.filter(room=room)
+                ).select_related('sender', 'reply_to'),
+                limit=100
+            )
         
-        # معلومات المستخدمين المتصلين
-        online_users = room.online_users.filter(
-            onlineuser__is_online=True
-        ).distinct()
+        # معلومات المستخدمين المتصلين (الصفحة تسجل الانضمام بنفسها عند التحميل)
+        online_user_ids = room.get_online_user_ids()
+        online_users = CustomUser.objects.filter(id__in=online_user_ids)
         
         # عدد المتصلين الحقيقي
-        online_count = room.get_online_count()
+        online_count = len(online_user_ids)
         
         context = {
             'room': room,
             'room_id': str(room.id),
-            'messages': reversed(messages_list),
+            'messages': messages_list,
+            # مؤشرات للتمرير للخلف ولجلب الرسائل الجديدة
+            'oldest_cursor': encode_cursor(messages_list[0]) if messages_list else '',
+            'latest_cursor': encode_cursor(messages_list[-1]) if messages_list else '',
+            'has_older': has_older,
+            # "قرأها N" الحالية لرسائلي (التحديثات تصل عبر WebSocket)
+            'read_by': read_by(room.id),
             'online_users': online_users,
             'online_count': online_count,  # إضافة هذا
             'is_room_admin': room.admins.filter(id=request.user.id).exists() or room.created_by == request.user,
@@ -177,11 +186,10 @@ def update_online_status(request, room_id):
             elif action == 'leave':
                 room.remove_online_user(request.user)
             elif action == 'ping':
-                # تحديث last_seen فقط
-                OnlineUser.objects.filter(
-                    user=request.user,
-                    room=room
-                ).update(last_seen=timezone.now())
+                # نبضة في الذاكرة - last_seen يُحفظ دورياً
+                get_presence().heartbeat(request.user.id, room.id)
+            
+            maybe_checkpoint()
             
             return JsonResponse({
                 'status': 'success',
@@ -253,12 +261,13 @@ def manage_room(request, room_id):
                 messages.success(request, f'تم إضافة {email} إلى الغرفة')
                 
                 # إنشاء رسالة نظام
-                Message.objects.create(
+                system_message = Message.objects.create(
                     room=room,
                     sender=request.user,
                     content=f'انضم {user.email} إلى الغرفة',
                     message_type='system'
                 )
+                broadcast_message(system_message)
                 
             except CustomUser.DoesNotExist:
                 messages.error(request, 'المستخدم غير موجود')
@@ -279,75 +288,91 @@ def manage_room(request, room_id):
         'participants': participants
     })
 
+# أقدم من أي رسالة - بديل توقيت last_id غير الموجود
+EARLIEST = datetime.min.replace(tzinfo=dt_timezone.utc)
+
 @login_required
 def get_messages(request, room_id):
     """جلب الرسائل الجديدة - متوافق مع UUID والأسماء"""
     try:
         # محاولة البحث بـ UUID أولاً
+        rooms = ChatRoom.objects.select_related('activity')
         try:
             room_uuid = uuid.UUID(room_id)
-            room = get_object_or_404(ChatRoom, id=room_uuid)
+            room = get_object_or_404(rooms, id=room_uuid)
         except ValueError:
             # إذا لم يكن UUID، البحث بالاسم
-            room = get_object_or_404(ChatRoom, name=room_id)
+            room = get_object_or_404(rooms, name=room_id)
         
         if not room.can_join(request.user):
             return JsonResponse([], safe=False)
         
-        last_id = request.GET.get('last_id')
+        hidden = hiding.get_state(request.user, room.id)
+        query = with_message_relations(hidden.filter(Message.objects.filter(room=room)))
         
-        query = Message.objects.filter(room=room).exclude(deleted_for=request.user)
+        before = request.GET.get('before')
+        after = request.GET.get('after')
+        cursor_mode = before or after or 'limit' in request.GET
+        # الاستعلام الدوري وأحدث صفحة من نافذة الذاكرة، والصفحات الأقدم من قاعدة البيانات
+        cached = None
         
-        if last_id:
-            try:
-                # محاولة استخدام last_id كـ UUID
-                last_uuid = uuid.UUID(last_id)
-                last_message = Message.objects.get(id=last_uuid)
-                query = query.filter(timestamp__gt=last_message.timestamp)
-            except (ValueError, Message.DoesNotExist):
-                # إذا فشل، استخدام last_id كـ ID رقمي (للتتوافق)
+        if cursor_mode:
+            limit = parse_limit(request.GET.get('limit'))
+            if after and not before:
+                cached = message_cache.page_after(room, hidden, after, limit)
+            elif not before:
+                cached = message_cache.latest_page(room, hidden, limit)
+            
+            if cached is None:
+                # ترقيم بالمؤشر على (timestamp, id)
                 try:
-                    last_id_int = int(last_id)
-                    last_message = Message.objects.get(id=last_id_int)
-                    query = query.filter(timestamp__gt=last_message.timestamp)
-                except (ValueError, Message.DoesNotExist):
+                    messages_list, has_more = paginate_messages(
+                        query,
+                        before=before,
+                        after=after,
+                        limit=limit
+                    )
+                except ValueError as e:
+                    return JsonResponse({'error': str(e)}, status=400)
+            else:
+                entries, has_more = cached
+        else:
+            # الطريقة القديمة (last_id) - التوقيت يُقرأ باستعلام فرعي بدلاً من استعلام منفصل
+            last_id = request.GET.get('last_id')
+            last_uuid = None
+            if last_id:
+                try:
+                    last_uuid = uuid.UUID(last_id)
+                except ValueError:
                     pass
-        
-        messages_list = query.order_by('timestamp')[:50]
-        
-        messages_data = []
-        for msg in messages_list:
-            # الحصول على الاسم المعروض بشكل آمن
-            sender_display = msg.sender.email  # القيمة الافتراضية
-            try:
-                if hasattr(msg.sender, 'chat_profile') and msg.sender.chat_profile.display_name:
-                    sender_display = msg.sender.chat_profile.display_name
-            except Exception:
-                pass  # استخدام القيمة الافتراضية في حالة الخطأ
-            
-            message_data = {
-                'id': str(msg.id),
-                'sender': msg.sender.email,
-                'sender_display': sender_display,
-                'message': msg.content,
-                'message_type': msg.message_type,
-                'timestamp': msg.timestamp.strftime("%H:%M"),
-                'is_edited': msg.is_edited,
-            }
             
-            if msg.image:
-                message_data['image_url'] = msg.image.url
-            if msg.file:
-                message_data['file_url'] = msg.file.url
-                message_data['file_name'] = msg.file_name
-            if msg.reply_to:
-                message_data['reply_to'] = {
-                    'id': str(msg.reply_to.id),
-                    'sender': msg.reply_to.sender.email,
-                    'message': msg.reply_to.content[:50]
-                }
+            if last_uuid:
+                entries = message_cache.page_after_id(room, hidden, last_uuid, 50)
+                if entries is not None:
+                    cached = (entries, False)
+                # معرف غير موجود (رسالة محذوفة مثلاً): نفس الصفحة بدون last_id
+                # كما في السابق، بدلاً من مقارنة بـ NULL تُرجع قائمة فارغة
+                last_timestamp = Coalesce(
+                    Subquery(Message.objects.filter(id=last_uuid).values('timestamp')[:1]),
+                    Value(EARLIEST)
+                )
+                query = messages_after(query, last_timestamp, last_uuid)
             
-            messages_data.append(message_data)
+            if cached is None:
+                messages_list = query.order_by('timestamp', 'id')[:50]
+        
+        if cached is not None:
+            messages_data = [entry.data for entry in entries]
+        else:
+            messages_data = serialize_messages(messages_list)
+        
+        if cursor_mode:
+            return JsonResponse({
+                'messages': messages_data,
+                'has_more': has_more,
+                'next_cursor': messages_data[-1]['cursor'] if messages_data else after,
+                'prev_cursor': messages_data[0]['cursor'] if messages_data else before,
+            })
         
         return JsonResponse(messages_data, safe=False)
         
@@ -355,6 +380,81 @@ def get_messages(request, room_id):
         print(f"Error in get_messages: {e}")
         return JsonResponse({'error': str(e)}, status=500)
 
+def _get_streamable_room(user, room_id):
+    """الغرفة إذا كان المستخدم يستطيع متابعتها، وإلا None"""
+    try:
+        room = ChatRoom.objects.get(id=uuid.UUID(room_id))
+    except (ValueError, ChatRoom.DoesNotExist):
+        room = ChatRoom.objects.filter(name=room_id).first()
+    if room is None or not room.can_join(user):
+        return None
+    return room
+
+def _get_messages_after(user, room, cursor, limit=50):
+    """الرسائل الفائتة بعد مؤشر Last-Event-ID (فقط عند إعادة الاتصال)"""
+    events, _ = replay.messages_after_cursor(user, room, cursor, limit)
+    return events
+
+def _sse_frame(event):
+    """تحويل حدث chat_message إلى إطار text/event-stream (النص مرمّز مسبقاً)"""
+    return f"id: {event.get('cursor', '')}\nevent: message\ndata: {event['text']}\n\n"
+
+def _sse_change_frame(event):
+    """إطار تعديل أو حذف - بدون id حتى لا يتغير مؤشر Last-Event-ID"""
+    return f"event: message_changed\ndata: {event['text']}\n\n"
+
+@login_required
+async def stream_messages(request, room_id):
+    """بث الرسائل الجديدة عبر Server-Sent Events بدلاً من الاستعلام كل ثانيتين
+
+    الطلب يبقى مفتوحاً ويشترك في نفس مجموعة chat_<room_id> التي يستخدمها
+    ChatConsumer، لذلك الغرفة الخاملة لا تكلف أي استعلام على قاعدة البيانات.
+    """
+    user = await request.auser()
+    room = await sync_to_async(_get_streamable_room)(user, room_id)
+    if room is None:
+        return JsonResponse({'error': 'غير مصرح بالدخول'}, status=403)
+    
+    last_event_id = request.headers.get('Last-Event-ID')
+    
+    async def event_stream():
+        channel_layer = get_channel_layer()
+        channel_name = await channel_layer.new_channel()
+        group_name = room_group_name(room.id)
+        await channel_layer.group_add(group_name, channel_name)
+        
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            
+            # عند إعادة الاتصال: إرسال ما فات فقط
+            if last_event_id:
+                for event in await sync_to_async(_get_messages_after)(user, room, last_event_id):
+                    yield _sse_frame(event)
+            
+            deadline = time.monotonic() + SSE_MAX_DURATION
+            while time.monotonic() < deadline:
+                try:
+                    event = await asyncio.wait_for(
+                        channel_layer.receive(channel_name),
+                        timeout=SSE_HEARTBEAT_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    # نبضة للحفاظ على الاتصال عبر البروكسي
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                if event.get('type') == 'chat_message':
+                    yield _sse_frame(event)
+                elif event.get('type') == 'message_changed':
+                    yield _sse_change_frame(event)
+        finally:
+            await channel_layer.group_discard(group_name, channel_name)
+    
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @csrf_exempt
 @login_required
 def send_message(request, room_id):
@@ -380,8 +480,8 @@ def send_message(request, room_id):
                 reply_to = None
                 if reply_to_id:
                     try:
-                        reply_to = Message.objects.get(id=reply_to_id, room=room)
-                    except Message.DoesNotExist:
+                        reply_to = Message.objects.select_related('sender').get(id=reply_to_id, room=room)
+                    except (Message.DoesNotExist, ValueError, ValidationError):
                         pass
                 
                 message = Message.objects.create(
@@ -390,26 +490,18 @@ def send_message(request, room_id):
                     content=message_content,
                     reply_to=reply_to
                 )
+                sender_display = get_display_name(request.user)
+                broadcast_message(message, sender_display)
                 
-                # الحصول على الاسم المعروض بشكل آمن
-                sender_display = request.user.email  # القيمة الافتراضية
-                try:
-                    if hasattr(request.user, 'chat_profile') and request.user.chat_profile.display_name:
-                        sender_display = request.user.chat_profile.display_name
-                except Exception:
-                    pass  # استخدام القيمة الافتراضية في حالة الخطأ
-                
+                message_data = serialize_message(message, sender_display)
                 return JsonResponse({
                     'status': 'success', 
-                    'message_id': str(message.id),
-                    'sender': request.user.email,
-                    'sender_display': sender_display,
-                    'timestamp': message.timestamp.strftime("%H:%M"),
-                    'reply_to': {
-                        'id': str(reply_to.id),
-                        'sender': reply_to.sender.email,
-                        'message': reply_to.content[:50]
-                    } if reply_to else None
+                    'message_id': message_data['id'],
+                    'sender': message_data['sender'],
+                    'sender_display': message_data['sender_display'],
+                    'timestamp': message_data['timestamp'],
+                    'cursor': message_data['cursor'],
+                    'reply_to': message_data.get('reply_to')
                 })
             else:
                 return JsonResponse({'status': 'error', 'error': 'الرسالة فارغة'})
@@ -444,6 +536,7 @@ def send_image(request, room_id):
                 image=image_file,
                 message_type='image'
             )
+            broadcast_message(message)
             
             return JsonResponse({
                 'status': 'success', 
@@ -459,36 +552,271 @@ def send_image(request, room_id):
     
     return JsonResponse({'status': 'error', 'error': 'لم يتم اختيار صورة'})
 
+def _upload_state(upload):
+    return {
+        'upload_id': str(upload.id),
+        'file_name': upload.file_name,
+        'size': upload.size,
+        'offset': upload.received,
+        'chunk_size': uploads.upload_settings()['CHUNK_SIZE'],
+    }
+
+def _get_own_upload(request, upload_id):
+    """رفع المستخدم الحالي في غرفة يستطيع دخولها، وإلا None"""
+    try:
+        upload = FileUpload.objects.select_related('room').get(id=uuid.UUID(upload_id), user=request.user)
+    except (ValueError, FileUpload.DoesNotExist):
+        return None
+    if not upload.room.can_join(request.user):
+        return None
+    return upload
+
+@login_required
+def start_upload(request, room_id):
+    """بدء رفع ملف على أجزاء: {"file_name", "size"} - يُرجع upload_id و offset"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    room = _get_streamable_room(request.user, room_id)
+    if room is None:
+        return JsonResponse({'status': 'error', 'error': 'الغرفة غير موجودة'}, status=404)
+    try:
+        data = json.loads(request.body)
+        upload = uploads.start_upload(request.user, room, data.get('file_name'), data.get('size'))
+    except (ValueError, AttributeError) as e:
+        return JsonResponse({'status': 'error', 'error': str(e)}, status=400)
+    return JsonResponse({'status': 'success', **_upload_state(upload)}, status=201)
+
+@login_required
+def upload_chunk(request, upload_id):
+    """GET: الموقع الحالي للاستئناف. PUT ?offset=N: جزء من الملف في جسم الطلب الخام
+
+    الجسم يُقرأ من request مباشرة (وليس request.body) حتى يُكتب على دفعات.
+    """
+    upload = _get_own_upload(request, upload_id)
+    if upload is None:
+        return JsonResponse({'status': 'error', 'error': 'الرفع غير موجود'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse({'status': 'success', **_upload_state(upload)})
+    if request.method not in ('PUT', 'POST'):
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    try:
+        offset = int(request.GET.get('offset', ''))
+        length = request.META.get('CONTENT_LENGTH')
+        length = int(length) if length else None
+        uploads.write_chunk(upload, offset, request, length)
+    except uploads.OffsetConflict as e:
+        return JsonResponse({'status': 'error', 'error': str(e), 'offset': e.offset}, status=409)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'error': str(e)}, status=400)
+    return JsonResponse({'status': 'success', **_upload_state(upload)})
+
+@login_required
+def complete_upload(request, upload_id):
+    """إنهاء الرفع: إنشاء رسالة الملف - إعادة الطلب تُرجع نفس الرسالة"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    upload = _get_own_upload(request, upload_id)
+    if upload is None:
+        return JsonResponse({'status': 'error', 'error': 'الرفع غير موجود'}, status=404)
+    try:
+        message, created = uploads.complete_upload(upload)
+    except uploads.OffsetConflict as e:
+        return JsonResponse({'status': 'error', 'error': 'الملف غير مكتمل', 'offset': e.offset}, status=409)
+    except Exception as e:
+        print(f"Error in complete_upload: {e}")
+        return JsonResponse({'status': 'error', 'error': str(e)}, status=500)
+    return JsonResponse({
+        'status': 'success',
+        'message_id': str(message.id),
+        'sender': request.user.email,
+        'file_url': message.file.url,
+        'file_name': message.file_name,
+        'timestamp': message.timestamp.strftime("%H:%M")
+    }, status=201 if created else 200)
+
+@login_required
+def sync_messages(request, room_id):
+    """كل التغييرات في الغرفة بعد رقم تسلسل: رسائل جديدة وتعديلات وحذف
+
+    العميل يحفظ last_seq من الرد ويطلب ?after_seq=<last_seq> بعد إعادة الاتصال
+    حتى يصبح has_more = false.
+    """
+    room = _get_streamable_room(request.user, room_id)
+    if room is None:
+        return JsonResponse({'error': 'غير مصرح بالدخول'}, status=403)
+    
+    try:
+        after = int(request.GET.get('after_seq', 0))
+        if after < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'after_seq غير صالح'}, status=400)
+    limit = parse_limit(request.GET.get('limit'), sequence.SYNC_PAGE_SIZE)
+    events, last_seq, has_more = sequence.sync_events(room, request.user, after, limit)
+    return JsonResponse({
+        'events': events,
+        'last_seq': last_seq,
+        'has_more': has_more,
+    })
+
+def _get_own_message(request, message_id):
+    """رسالة المستخدم الحالي في غرفة يستطيع دخولها، وإلا None"""
+    try:
+        message = Message.objects.select_related('room').get(id=uuid.UUID(message_id), sender=request.user)
+    except (ValueError, Message.DoesNotExist):
+        return None
+    if not message.room.can_join(request.user):
+        return None
+    return message
+
+@login_required
+def edit_message(request, message_id):
+    """تعديل نص رسالة (المرسل فقط)"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    message = _get_own_message(request, message_id)
+    if message is None:
+        return JsonResponse({'status': 'error', 'error': 'الرسالة غير موجودة'}, status=404)
+    try:
+        content = json.loads(request.body).get('message', '').strip()
+    except (ValueError, AttributeError):
+        content = ''
+    if not content:
+        return JsonResponse({'status': 'error', 'error': 'الرسالة فارغة'}, status=400)
+    
+    sequence.edit_message(message, content)
+    broadcast_message_change('edit', message)
+    return JsonResponse({'status': 'success', 'seq': message.changed_seq})
+
+@login_required
+def delete_message(request, message_id):
+    """حذف رسالة للجميع (المرسل فقط)"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    message = _get_own_message(request, message_id)
+    if message is None:
+        return JsonResponse({'status': 'error', 'error': 'الرسالة غير موجودة'}, status=404)
+    
+    message_pk = message.pk
+    message.delete()
+    # delete() يمسح pk - الحدث يحتاج المعرف ورقم الحذف من الأثر
+    message.pk = message_pk
+    tombstone = MessageTombstone.objects.filter(message_id=message_pk).order_by('-seq').first()
+    message.changed_seq = tombstone.seq if tombstone else None
+    broadcast_message_change('delete', message)
+    return JsonResponse({'status': 'success', 'seq': message.changed_seq})
+
+@login_required
+def hide_message(request, message_id):
+    """حذف رسالة لدي فقط (لا تتغير عند باقي المشاركين)"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    try:
+        message = Message.objects.select_related('room').get(id=uuid.UUID(message_id))
+    except (ValueError, Message.DoesNotExist):
+        return JsonResponse({'status': 'error', 'error': 'الرسالة غير موجودة'}, status=404)
+    if not message.room.can_join(request.user):
+        return JsonResponse({'status': 'error', 'error': 'الرسالة غير موجودة'}, status=404)
+    
+    hiding.hide_messages(request.user, message.room_id, [message.id])
+    return JsonResponse({'status': 'success'})
+
+@login_required
+def clear_history(request, room_id):
+    """مسح المحادثة لدي - كل الرسائل الحالية تختفي والجديدة تظهر"""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'error': 'Method not allowed'}, status=405)
+    room = _get_streamable_room(request.user, room_id)
+    if room is None:
+        return JsonResponse({'status': 'error', 'error': 'غير مصرح بالدخول'}, status=403)
+    
+    hiding.clear_history(request.user, room.id)
+    return JsonResponse({'status': 'success'})
+
+@login_required
+def unread_counts(request):
+    """عدد الرسائل غير المقروءة لكل غرف المستخدم في استعلام واحد"""
+    counts = get_unread_counts(request.user)
+    return JsonResponse({
+        'status': 'success',
+        'cap': UNREAD_CAP,
+        'rooms': {
+            room_id: {'count': count, 'display': format_unread(count)}
+            for room_id, count in counts.items()
+        }
+    })
+
+@login_required
+def realtime_metrics(request):
+    """مقاييس طوابير الإرسال في هذه العملية (للمشرفين فقط)"""
+    if not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'error': 'غير مصرح'}, status=403)
+    return JsonResponse({
+        'status': 'success',
+        'send_queue': outbox.metrics(),
+        'replay': replay.stats(),
+        'message_cache': message_cache.stats(),
+    })
+
 @login_required
 def search_rooms(request):
-    """بحث الغرف"""
+    """بحث الغرف أثناء الكتابة - من الفهرس النصي ونتائج محفوظة لكل نص بحث"""
     query = request.GET.get('q', '')
+    return JsonResponse(directory.search_rooms(request.user, query), safe=False)
+
+@login_required
+def room_directory(request):
+    """دليل الغرف العامة: ?sort=active|online|newest&cursor=...&limit=N"""
+    sort = request.GET.get('sort', 'active')
+    limit = parse_limit(request.GET.get('limit'), default=None)
+    try:
+        rooms_data, next_cursor = directory.directory_page(
+            request.user, sort=sort, cursor=request.GET.get('cursor'), limit=limit
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'rooms': rooms_data,
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None,
+    })
+
+@login_required
+def search_messages(request):
+    """البحث في الرسائل: ?q=...&room=<room_id> (اختياري)&before=<cursor>&limit=N
+
+    بدون room يبحث في كل الغرف التي يستطيع المستخدم دخولها. النتائج الأحدث
+    أولاً، و next_cursor يُرسل كـ before لجلب النتائج الأقدم.
+    """
+    query = request.GET.get('q', '').strip()
+    room_id = request.GET.get('room')
+    before = request.GET.get('before')
+    limit = parse_limit(request.GET.get('limit'))
     
-    if query:
-        rooms = ChatRoom.objects.filter(
-            Q(name__icontains=query) | 
-            Q(description__icontains=query),
-            is_active=True
-        ).filter(
-            Q(room_type='public') | 
-            Q(participants=request.user) |
-            Q(created_by=request.user)
-        ).distinct()
-    else:
-        rooms = ChatRoom.objects.none()
+    room = None
+    if room_id:
+        room = _get_streamable_room(request.user, room_id)
+        if room is None:
+            return JsonResponse({'status': 'error', 'error': 'غير مصرح بالدخول'}, status=403)
     
-    rooms_data = []
-    for room in rooms:
-        rooms_data.append({
-            'id': str(room.id),
-            'name': room.name,
-            'description': room.description,
-            'room_type': room.get_room_type_display(),
-            'online_count': room.get_online_count(),
-            'created_by': room.created_by.email
-        })
+    try:
+        results, has_more = search.search_messages(request.user, query, room=room, before=before, limit=limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    messages_data = []
+    for message in results:
+        data = serialize_message(message)
+        data['room_id'] = str(message.room_id)
+        data['room_name'] = message.room.name
+        data['date'] = message.timestamp.strftime("%Y-%m-%d")
+        messages_data.append(data)
     
-    return JsonResponse(rooms_data, safe=False)
+    return JsonResponse({
+        'messages': messages_data,
+        'has_more': has_more,
+        'next_cursor': messages_data[-1]['cursor'] if messages_data else None,
+    })
 
 @login_required
 def user_profile(request):
@@ -678,12 +1006,13 @@ def accept_invitation(request, token):
         invitation.save()
         
         # إنشاء رسالة نظام
-        Message.objects.create(
+        system_message = Message.objects.create(
             room=invitation.room,
             sender=request.user,
             content=f'انضم {request.user.email} إلى الغرفة',
             message_type='system'
         )
+        broadcast_message(system_message)
         
         messages.success(request, f'تم الانضمام إلى غرفة {invitation.room.name}')
         return redirect('chat:room_detail', room_id=invitation.room.id)
@@ -0,0 +1,244 @@
+# chat/writebehind.py
+"""حفظ الرسائل بشكل مؤجل (write-behind) على دفعات عبر bulk_create
+
+عند التفعيل يُنشئ ChatConsumer الرسالة في الذاكرة (المعرف UUID جاهز)، يبثها
+فوراً ثم يضعها في طابور. مهمة في الخلفية تحفظ الطابور كل بضع ملّي ثوانٍ أو
+كل N رسالة. الطابور محدود الحجم: عند امتلائه ينتظر المرسل (back-pressure)
+بدلاً من استهلاك الذاكرة بلا حد، وما تبقى يُحفظ في مسار التفريغ عند SIGTERM
+(chat/drain.py) قبل إيقاف العملية.
+
+بدون التفعيل يحفظ المستهلك الرسالة فوراً (الإدراج وحجز seq فقط)، ونفس الطابور
+بدالة record_saved يطبق الباقي على دفعات: عدادات الغرفة وفهرس البحث ونافذة
+الذاكرة (إشارة messages_bulk_created).
+
+الإعدادات في settings.CHAT_WRITE_BEHIND:
+    ENABLED: تفعيل الوضع (معطل افتراضياً)
+    BATCH_SIZE: أقصى عدد رسائل في الدفعة الواحدة
+    FLUSH_INTERVAL: أقصى انتظار بالثواني قبل حفظ دفعة غير مكتملة
+    MAX_QUEUE: أقصى عدد رسائل تنتظر الحفظ
+"""
+import asyncio
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+DEFAULTS = {
+    'ENABLED': False,
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_QUEUE': 10000,
+}
+
+
+def write_behind_settings():
+    return {**DEFAULTS, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+def is_enabled():
+    return write_behind_settings()['ENABLED']
+
+
+def save_batch(batch):
+    """حفظ دفعة رسائل في معاملة واحدة - يُرجع الرسائل المحفوظة فعلاً"""
+    from .models import Message
+    from .sequence import assign_seqs
+    from .signals import messages_bulk_created
+
+    if not batch:
+        return []
+
+    # الرد على رسالة محذوفة لا يجب أن يُفشل الدفعة كاملة - تحقق باستعلام واحد
+    reply_ids = {message.reply_to_id for message in batch if message.reply_to_id}
+    if reply_ids:
+        known = set(Message.objects.filter(id__in=reply_ids).values_list('id', flat=True))
+        known.update(message.id for message in batch)
+        for message in batch:
+            if message.reply_to_id and message.reply_to_id not in known:
+                message.reply_to_id = None
+
+    try:
+        with transaction.atomic():
+            # أرقام التسلسل تُحجز في نفس المعاملة - التراجع لا يترك فجوة
+            assign_seqs(batch)
+            Message.objects.bulk_create(batch)
+        saved = batch
+    except Exception as e:
+        # حفظ كل رسالة منفردة حتى لا تضيع الدفعة بسبب رسالة واحدة
+        print(f"Error in bulk message flush, retrying one by one: {e}")
+        saved = []
+        for message in batch:
+            message.seq = message.changed_seq = None
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    assign_seqs([message])
+                    Message.objects.bulk_create([message])
+                saved.append(message)
+            except Exception as e:
+                print(f"Dropping message {message.id}: {e}")
+
+    messages_bulk_created.send(sender=Message, messages=saved)
+    return saved
+
+
+def record_saved(batch):
+    """عدادات الغرفة وفهرس البحث ونافذة الذاكرة لرسائل حفظها المستهلك منفردة"""
+    from .models import Message
+    from .signals import messages_bulk_created
+
+    if batch:
+        messages_bulk_created.send(sender=Message, messages=batch)
+    return batch
+
+
+class MessageWriter:
+    """طابور الرسائل ومهمة الحفظ لكل event loop
+
+    كل رسالة يملكها طرف واحد في كل لحظة: الطابور، ثم الدفعة قيد التجميع
+    (_pending)، ثم الحفظ الجاري (_saving). الانتقال من التجميع إلى الحفظ يتم
+    تحت القفل، فالإيقاف (close) ينتظر الحفظ الجاري ولا يحفظه مرة ثانية، ويحفظ
+    الدفعة قيد التجميع وما بقي في الطابور بدون فقدان.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_queue, save=None):
+        self.save = save
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.task = None
+        self.closed = False
+        self._pending = []
+        self._saving = None
+        self._lock = threading.Lock()
+
+    def _save(self, batch):
+        # save_batch يُقرأ عند الاستدعاء حتى يمكن استبداله في الاختبارات
+        return (self.save or save_batch)(batch)
+
+    def start(self):
+        if self.closed:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def enqueue(self, message):
+        """إضافة رسالة للطابور - ينتظر إذا كان الطابور ممتلئاً"""
+        if self.closed:
+            # بعد الإيقاف لا توجد مهمة - حفظ مباشر
+            await database_sync_to_async(self._save)([message])
+            return
+        self.start()
+        await self.queue.put(message)
+
+    def _hold(self, message):
+        with self._lock:
+            self._pending.append(message)
+
+    def _take(self):
+        """نقل الدفعة قيد التجميع إلى من سيحفظها"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        return batch
+
+    async def _collect(self):
+        """انتظار أول رسالة ثم تجميع دفعة حتى الحجم الأقصى أو انتهاء المهلة"""
+        self._hold(await self.queue.get())
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(self._pending) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                self._hold(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self):
+        while True:
+            await self._collect()
+            batch = self._take()
+            # الحفظ يكمل حتى لو أُلغيت المهمة - close ينتظره
+            self._saving = asyncio.ensure_future(database_sync_to_async(self._save)(batch))
+            try:
+                await asyncio.shield(self._saving)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error flushing messages: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def flush(self):
+        """انتظار حفظ كل ما في الطابور"""
+        if self.task is not None and not self.task.done():
+            await self.queue.join()
+
+    async def close(self):
+        """إيقاف المهمة وحفظ كل ما تبقى مرة واحدة - يُرجع عدد الرسائل المحفوظة هنا"""
+        self.closed = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self._saving is not None and not self._saving.done():
+            try:
+                await self._saving
+            except Exception as e:
+                print(f"Error flushing messages: {e}")
+
+        pending = self._take()
+        for _ in pending:
+            self.queue.task_done()
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+            self.queue.task_done()
+        for start in range(0, len(pending), self.batch_size):
+            await database_sync_to_async(self._save)(pending[start:start + self.batch_size])
+        return len(pending)
+
+
+_writers = {}
+
+
+def get_writer(save=None):
+    """كاتب الرسائل الخاص بالـ event loop الحالي
+
+    save=None يحفظ الرسائل (save_batch)، و record_saved لرسائل محفوظة مسبقاً.
+    """
+    key = (asyncio.get_running_loop(), save)
+    writer = _writers.get(key)
+    if writer is None:
+        config = write_behind_settings()
+        writer = _writers[key] = MessageWriter(
+            config['BATCH_SIZE'],
+            config['FLUSH_INTERVAL'],
+            config['MAX_QUEUE'],
+            save
+        )
+    return writer
+
+
+async def close_writer():
+    """حفظ ما تبقى في طوابير الـ event loop الحالي - من مسار التفريغ (chat/drain.py)
+
+    يعمل داخل نفس الـ event loop قبل إيقاف العملية، بدلاً من atexit حيث
+    الـ loop مغلق والدفعة الجارية قد تُحفظ مرتين.
+    """
+    loop = asyncio.get_running_loop()
+    total = 0
+    for key, writer in list(_writers.items()):
+        if key[0] is not loop:
+            continue
+        try:
+            total += await writer.close()
+        except Exception as e:
+            print(f"Error in final message flush: {e}")
+    return total
@@ -34,6 +34,22 @@ CHANNEL_LAYERS = {
     }
 }
 
+# تتبع المتصلين في الذاكرة (chat/presence.py)
+# لعدة عمال: 'chat.presence.CachePresenceBackend' مع cache مشترك مثل Redis
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.LocalPresenceBackend',
+    'TTL': 90,
+    'CHECKPOINT_INTERVAL': 30,
+}
+
+# حفظ رسائل WebSocket بشكل مؤجل على دفعات (chat/writebehind.py)
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CHAT_WRITE_BEHIND', 'False').lower() == 'true',
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_QUEUE': 10000,
+}
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',